@@ -1,19 +1,80 @@
 import logging
+import os
 import json
+import queue
+import threading
+import warnings
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
+import orjson
+from pydantic import BaseModel, ConfigDict, ValidationError, ValidationInfo, field_validator, model_validator
+from pydantic_core import from_json
 from api_client import APIClient
+import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import train_test_split
 import config
 
+def _plan_json_schema(status: str) -> str:
+    return json.dumps({
+        "analysis_steps": [
+            {
+                "name": "string",
+                "description": "string",
+                "expected_insights": "string",
+                "focus": "string",
+                "status": status
+            }
+        ]
+    }, indent=4)
+
+# Response formats requested from the API, built once at import
+_PLAN_JSON_SCHEMA = _plan_json_schema("pending")
+_UPDATED_PLAN_JSON_SCHEMA = _plan_json_schema("string")
+
+class AnalysisStep(BaseModel):
+    """A single step of an analysis plan as returned by the API."""
+    # The model may add its own keys to a step; keep them
+    model_config = ConfigDict(extra='allow')
+
+    name: str = ""
+    description: Any = ""
+    expected_insights: Any = ""
+    focus: Any = ""
+    status: str = "pending"
+
+    @field_validator('name', 'status', mode='before')
+    @classmethod
+    def coerce_to_str(cls, value: Any, info: ValidationInfo) -> str:
+        # A null or non-string value in one step must not discard the whole plan
+        if value is None:
+            return cls.model_fields[info.field_name].default
+        return value if isinstance(value, str) else str(value)
+
+class AnalysisPlan(BaseModel):
+    """An analysis plan as returned by the API."""
+    analysis_steps: List[AnalysisStep] = []
+
+    @model_validator(mode='after')
+    def name_unnamed_steps(self) -> 'AnalysisPlan':
+        for i, step in enumerate(self.analysis_steps):
+            if not step.name:
+                step.name = f"Analysis Step {i+1}"
+        return self
+
 class AnalysisPlanner:
     def __init__(self, api_client: APIClient, output_path: str):
         self.api_client = api_client
         self.output_path = output_path
         self.plan_file = Path(self.output_path) / "analysis_plan.json"
+        # Prompt fragments for the data dictionary and sample, keyed by object id.
+        # The object is kept alongside its string so the id cannot be reused while cached.
+        self._data_dict_cache: Dict[int, tuple] = {}
+        self._sample_meta_cache: Dict[int, tuple] = {}
+        # Intermediate plan checkpoints are written by a background thread, started on first use
+        self._write_queue: "queue.Queue[bytes]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        # Last intermediate checkpoint queued for writing, to skip rewriting an unchanged plan
+        self._last_checkpoint: Optional[bytes] = None
 
     def generate_initial_plan(self, data_dict: Dict, data_sample: Any, full_data_row_count: int) -> List[Dict]:
         logging.info("Generating initial analysis plan")
@@ -21,20 +82,13 @@ class AnalysisPlanner:
         statistical_features = self.extract_statistical_features(data_sample)
         ranked_analyses = self.rank_analysis_steps(statistical_features)
 
-        data_dict_str = json.dumps(data_dict, indent=2)
-        data_dict_safe = data_dict_str.replace('"', '\"')
+        system_prompt = self._build_data_context(data_dict, data_sample)
 
         prompt = f"""
-        Given the following data dictionary and production data characteristics:
-
-        Data Dictionary:
-        {data_dict_safe}
+        Given the data dictionary and production data characteristics above, and:
 
-        Production Data Characteristics:
         - Total number of rows: {full_data_row_count}
-        - Number of columns: {len(data_sample.columns)}
-        - Column names: {', '.join(data_sample.columns)}
-        - Data types: {self.serialize_object(data_sample.dtypes.to_dict())}
+        - Most variable numeric columns: {', '.join(ranked_analyses) or 'none'}
 
         Generate a comprehensive analysis plan with up to {config.MAX_ANALYSES} steps. Each step should include:
         1. A name for the analysis
@@ -44,21 +98,11 @@ class AnalysisPlanner:
         5. Set the status as "pending" for all steps
 
         Provide your response in the following JSON format:
-        {{
-            "analysis_steps": [
-                {{
-                    "name": "string",
-                    "description": "string",
-                    "expected_insights": "string",
-                    "focus": "string",
-                    "status": "pending"
-                }}
-            ]
-        }}
+        {_PLAN_JSON_SCHEMA}
         """
         
         logging.info(f"Prompt for initial plan generation:\n{prompt}")
-        response = self.api_client.call_api(prompt, use_json_mode=True)
+        response = self.api_client.call_api(prompt, use_json_mode=True, system_prompt=system_prompt, allow_similar=True)
         plan_json = self.api_client.parse_json_response(response)
         plan = plan_json.get("analysis_steps", [])
         logging.info(f"Initial analysis plan: {json.dumps(plan, indent=2)}")
@@ -69,17 +113,7 @@ class AnalysisPlanner:
         
         prompt = f"""
         Provide your response in the following JSON format:
-        {{
-            "analysis_steps": [
-                {{
-                    "name": "string",
-                    "description": "string",
-                    "expected_insights": "string",
-                    "focus": "string",
-                    "status": "pending"
-                }}
-            ]
-        }}
+        {_PLAN_JSON_SCHEMA}
         
         Given the following data dictionary and initial analysis plan, please reflect on ways we can improve this plan and include enhanced and more comprehensive and complex analysis. Consider the relationships between variables, potential advanced analyses, and any insights that could be derived from the data structure.
 
@@ -100,12 +134,12 @@ class AnalysisPlanner:
         """
 
         try:
-            response = self.api_client.call_api(prompt, use_json_mode=True)
+            response = self.api_client.call_api(prompt, use_json_mode=True, allow_similar=True)
             enhanced_plan_json = self.api_client.parse_json_response(response)
             enhanced_plan = enhanced_plan_json.get("analysis_steps", initial_plan)
             logging.info("Analysis plan successfully enhanced")
             return enhanced_plan
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             logging.error(f"Error parsing enhanced plan: {str(e)}. Check API response format.")
             return initial_plan
         except Exception as e:
@@ -117,23 +151,9 @@ class AnalysisPlanner:
         logging.info("Updating analysis plan")
 
         summarized_data = self.summarize_data(current_plan, completed_analyses, key_findings)
-        data_dict_str = json.dumps(data_dict, indent=2)
-        data_dict_safe = data_dict_str.replace('"', '\"')
+        system_prompt = self._build_data_context(data_dict, data_sample)
 
         prompt = f"""
-        Provide your response in the following JSON format:
-        {{
-            "analysis_steps": [
-                {{
-                    "name": "string",
-                    "description": "string",
-                    "expected_insights": "string",
-                    "focus": "string",
-                    "status": "string"
-                }}
-            ]
-        }}
-        
         Given the summarized current analysis plan, completed analyses, and key findings:
 
         {summarized_data}
@@ -145,99 +165,159 @@ class AnalysisPlanner:
         4. Prioritize the most promising directions
         5. Ensure new analysis tasks have the status: "pending"
 
-        Consider the following data context:
-
-        Data Dictionary:
-        {data_dict_safe}
-
-        Production Data Characteristics:
+        Consider the data dictionary and production data characteristics above, and:
         - Total number of rows: {full_data_row_count}
-        - Number of columns: {len(data_sample.columns)}
-        - Column names: {', '.join(data_sample.columns)}
-        - Data types: {self.serialize_object(data_sample.dtypes.to_dict())}
 
         Provide your response in the following JSON format:
-        {{
-            "analysis_steps": [
-                {{
-                    "name": "string",
-                    "description": "string",
-                    "expected_insights": "string",
-                    "focus": "string",
-                    "status": "string"
-                }}
-            ]
-        }}
+        {_UPDATED_PLAN_JSON_SCHEMA}
 
         ONLY RETURN JSON FORMAT with no other ornamentation or expressed information.
         """
 
         logging.info(f"Prompt for plan update:\n{prompt}")
-        response = self.api_client.call_api(prompt, use_json_mode=True)
+        response = self.api_client.call_api(prompt, use_json_mode=True, system_prompt=system_prompt, allow_similar=True)
         updated_plan_json = self.api_client.parse_json_response(response)
         updated_plan = updated_plan_json.get("analysis_steps", current_plan)
         logging.info(f"Updated analysis plan: {json.dumps(updated_plan, indent=2)}")
         return updated_plan
 
+    def _build_data_context(self, data_dict: Dict, data_sample: pd.DataFrame) -> str:
+        """Build the system prompt shared by plan requests, holding only context that is fixed for the run."""
+        num_columns, column_names, dtypes_str = self._sample_meta(data_sample)
+        return f"""
+        You plan data analyses.
+
+        Data Dictionary:
+        {self._serialize_data_dict(data_dict)}
+
+        Production Data Characteristics:
+        - Number of columns: {num_columns}
+        - Column names: {column_names}
+        - Data types: {dtypes_str}
+        """
+
+    def _serialize_data_dict(self, data_dict: Dict) -> str:
+        cached = self._data_dict_cache.get(id(data_dict))
+        if cached is None:
+            cached = (data_dict, json.dumps(data_dict, separators=(',', ':')))
+            self._data_dict_cache[id(data_dict)] = cached
+        return cached[1]
+
+    def _sample_meta(self, data_sample: pd.DataFrame) -> Tuple[int, str, str]:
+        """Return the column count, joined column names and serialized dtypes of a data sample."""
+        cached = self._sample_meta_cache.get(id(data_sample))
+        if cached is None:
+            meta = (
+                len(data_sample.columns),
+                ', '.join(data_sample.columns),
+                str(self.serialize_object(data_sample.dtypes.to_dict()))
+            )
+            cached = (data_sample, meta)
+            self._sample_meta_cache[id(data_sample)] = cached
+        return cached[1]
+
     def _get_analysis_plan(self, prompt: str) -> List[Dict]:
-        response = self.api_client.call_api(prompt, use_json_mode=True)
+        response = self.api_client.call_api(prompt, use_json_mode=True, allow_similar=True)
         
         try:
-            plan_data = self.api_client.parse_json_response(response)
-            if isinstance(plan_data, str):
-                plan_data = json.loads(plan_data)
+            try:
+                # Parse and validate in a single pass when the response is plain JSON
+                plan_model = AnalysisPlan.model_validate_json(response)
+            except ValidationError as e:
+                if e.errors()[0]['type'] != 'json_invalid':
+                    raise
+                plan_data = self.api_client.parse_json_response(response)
+                if isinstance(plan_data, str):
+                    plan_data = from_json(plan_data)
+                plan_model = AnalysisPlan.model_validate(plan_data)
             
-            plan = plan_data.get("analysis_steps", [])
+            plan = [step.model_dump() for step in plan_model.analysis_steps]
             
             logging.debug("API response: %s", json.dumps(plan, indent=2))
             
-            if not isinstance(plan, list):
-                raise ValueError("API response is not a list of analysis steps")
-            
-            for i, step in enumerate(plan):
-                if not isinstance(step, dict):
-                    raise ValueError(f"Step {i} is not a dictionary")
-                if 'name' not in step or not step['name']:
-                    step['name'] = f"Analysis Step {i+1}"
-                if 'status' not in step:
-                    step['status'] = 'pending'
-            
             self.save_plan_to_file(plan)
             logging.info(f"Analysis plan generated/updated with {len(plan)} steps")
             return plan
         
-        except (json.JSONDecodeError, ValueError) as e:
+        except ValueError as e:
             logging.error("Failed to parse API response. Error: %s. Response content: %s", str(e), response)
             return []
         except Exception as e:
             logging.error("Unexpected error while processing API response: %s.", str(e))
             return []
 
-    def save_plan_to_file(self, tasks: List[Dict]):
-        serializable_tasks = json.loads(json.dumps(tasks, default=str))
-        with open(self.plan_file, 'w', encoding='utf-8') as f:
-            json.dump({"tasks": serializable_tasks}, f, indent=4)
+    def save_plan_to_file(self, tasks: List[Dict], final: bool = False):
+        """
+        Write the plan to the plan file.
+
+        The plan is serialized right away, but intermediate checkpoints are
+        written to disk by a background thread so the caller can go on to its
+        next API call. A checkpoint identical to the previous one is skipped.
+        The final plan is written before returning, after any pending checkpoints.
+
+        Args:
+        tasks (List[Dict]): The analysis steps to save.
+        final (bool): Whether this is the end-of-run artifact. Intermediate
+            checkpoints are written compact; only the final file is indented.
+        """
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if final:
+            option |= orjson.OPT_INDENT_2
+        plan_json = orjson.dumps({"tasks": tasks}, default=self.serialize_object, option=option)
+        if final:
+            self.flush()
+            self._write_plan_file(plan_json)
+            self._last_checkpoint = None
+            return
+        if plan_json == self._last_checkpoint:
+            logging.debug("Plan unchanged since the last checkpoint; not rewriting it")
+            return
+        self._last_checkpoint = plan_json
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._writer_loop, name="plan-writer", daemon=True)
+            self._writer.start()
+        self._write_queue.put(plan_json)
+
+    def flush(self):
+        """Wait until all queued plan checkpoints have been written."""
+        if self._writer is not None:
+            self._write_queue.join()
+
+    def _writer_loop(self):
+        while True:
+            plan_json = self._write_queue.get()
+            try:
+                self._write_plan_file(plan_json)
+            except Exception as e:
+                logging.error(f"Error writing plan checkpoint: {str(e)}")
+            finally:
+                self._write_queue.task_done()
+
+    def _write_plan_file(self, plan_json: bytes):
+        # Write to a temporary file and rename it over the plan, so a crash mid-write never leaves a truncated plan
+        tmp_file = self.plan_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(plan_json)
+        os.replace(tmp_file, self.plan_file)
 
     def summarize_data(self, current_plan: List[Dict], completed_analyses: List[Dict], key_findings: List[str]) -> str:
-        max_length = 1000000
-        summary = "Current Plan Summary:\n"
-        for step in current_plan:
-            summary += f"- {step['name']} (Status: {step['status']})\n"
-        summary += "\nCompleted Analyses Summary:\n"
-        for analysis in completed_analyses:
-            summary += f"- {analysis['name']}: {analysis.get('interpretation', 'No interpretation available')[:200]}...\n"
-        summary += "\nKey Findings:\n"
-        for finding in key_findings:
-            summary += f"- {finding[:200]}...\n"
-        if len(summary) > max_length:
-            summary = summary[:max_length] + "...(truncated)"
-        return summary
+        parts = ["Current Plan Summary:\n"]
+        parts.extend(f"- {step['name']} (Status: {step['status']})\n" for step in current_plan)
+        parts.append("\nCompleted Analyses Summary:\n")
+        parts.extend(f"- {analysis['name']}: {analysis.get('interpretation', 'No interpretation available')[:200]}...\n"
+                     for analysis in completed_analyses)
+        parts.append("\nKey Findings:\n")
+        parts.extend(f"- {finding[:200]}...\n" for finding in key_findings)
+        # Budgeted separately from the model's context window, which for current models would allow tens of thousands of tokens
+        max_tokens = min(config.PLAN_SUMMARY_MAX_TOKENS, self.api_client.get_max_tokens() // 4)
+        return self.api_client.truncate_to_tokens("".join(parts), max_tokens)
 
     def serialize_object(self, obj):
         if isinstance(obj, (pd.Series, pd.DataFrame)):
-            return obj.to_dict()
+            return self.serialize_object(obj.to_dict())
         elif isinstance(obj, dict):
-            return {k: self.serialize_object(v) for k, v in obj.items()}
+            return {k if isinstance(k, (str, int, float, bool, type(None))) else str(k): self.serialize_object(v)
+                    for k, v in obj.items()}
         elif isinstance(obj, list):
             return [self.serialize_object(v) for v in obj]
         elif isinstance(obj, (int, float, str, bool, type(None))):
@@ -245,21 +325,75 @@ class AnalysisPlanner:
         else:
             return str(obj)
 
-    def extract_statistical_features(self, data_sample: pd.DataFrame) -> pd.DataFrame:
+    def extract_statistical_features(self, data_sample: pd.DataFrame) -> Dict[str, Any]:
         numeric_data = data_sample.select_dtypes(include=["number"])
-        features = {
+        numeric_columns = numeric_data.columns.tolist()
+
+        # Compute all numeric statistics from a single float64 block
+        values = numeric_data.to_numpy(dtype=np.float64, na_value=np.nan)
+        missing_mask = np.isnan(values)
+        missing_counts = dict(zip(numeric_columns, missing_mask.sum(axis=0).tolist()))
+        other_columns = data_sample.columns.difference(numeric_data.columns, sort=False)
+        missing_counts.update(data_sample[other_columns].isnull().sum().to_dict())
+
+        if numeric_columns:
+            with warnings.catch_warnings():
+                # All-NaN or constant columns legitimately produce NaN statistics
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                means = np.nanmean(values, axis=0)
+                medians = np.nanmedian(values, axis=0)
+                stds = np.nanstd(values, axis=0, ddof=1)
+                if missing_mask.any():
+                    # Pairwise-complete correlations need pandas when values are missing
+                    correlations = numeric_data.corr().to_dict()
+                else:
+                    corr_matrix = np.atleast_2d(np.corrcoef(values, rowvar=False))
+                    correlations = pd.DataFrame(corr_matrix, index=numeric_columns, columns=numeric_columns).to_dict()
+        else:
+            means = medians = stds = np.empty(0)
+            correlations = {}
+
+        return {
             'num_rows': len(data_sample),
             'num_columns': len(data_sample.columns),
-            'mean_values': numeric_data.mean().to_dict(),
-            'median_values': numeric_data.median().to_dict(),
-            'std_values': numeric_data.std().to_dict(),
-            'missing_values': data_sample.isnull().sum().to_dict(),
-            'correlations': numeric_data.corr().to_dict()
+            'mean_values': dict(zip(numeric_columns, means.tolist())),
+            'median_values': dict(zip(numeric_columns, medians.tolist())),
+            'std_values': dict(zip(numeric_columns, stds.tolist())),
+            'missing_values': {column: missing_counts[column] for column in data_sample.columns},
+            'correlations': correlations
         }
-        return pd.DataFrame(features)
 
-    def rank_analysis_steps(self, features: pd.DataFrame) -> List[str]:
-        return features.columns[:5].tolist()
+    def rank_analysis_steps(self, features: Dict[str, Any], top_n: int = 5) -> List[str]:
+        """
+        Rank numeric columns by coefficient of variation, most variable first.
+
+        Args:
+        features (Dict[str, Any]): Features from extract_statistical_features.
+        top_n (int): The number of columns to return.
+
+        Returns:
+        List[str]: Up to top_n column names; columns without a finite coefficient of variation are left out.
+        """
+        columns = list(features['std_values'])
+        if not columns:
+            return []
+
+        stds = np.array([features['std_values'][column] for column in columns], dtype=np.float64)
+        means = np.abs(np.array([features['mean_values'][column] for column in columns], dtype=np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = stds / means
+        # Columns with a zero mean or missing statistics have no coefficient of variation to rank by
+        finite = np.flatnonzero(np.isfinite(scores))
+        if finite.size == 0:
+            return []
+
+        # Select the top_n in linear time, then sort only those
+        if finite.size > top_n:
+            top = finite[np.argpartition(scores[finite], -top_n)[-top_n:]]
+        else:
+            top = finite
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [columns[i] for i in top]
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG,
@@ -1,50 +1,226 @@
 import os
 import logging
 import time
-from typing import Dict, Any
+import asyncio
+import hashlib
+import importlib.util
+import random
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Any, Iterator, List, Optional, Tuple
 import json
-from openai import OpenAI
-from openai import APIError, RateLimitError, BadRequestError
-from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
 import backoff
 import httpx
+import orjson
+import config
+from response_cache import ResponseCache
+from semantic_cache import SemanticCache
+from rate_limiter import RateLimiter
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from anthropic import AsyncAnthropic
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    """Load (once per model) the tiktoken encoding used for token counting."""
+    # Imported lazily: building the BPE tables is slow and only needed when tokens are counted
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Non-OpenAI models have no tiktoken encoding; cl100k_base is a close approximation
+        return tiktoken.get_encoding("cl100k_base")
+
+# Model name and maximum supported tokens for each API type
+_MODEL_INFO: Dict[str, Tuple[str, int]] = {
+    'openai': ("gpt-4o-2024-08-06", 128_000),
+    'anthropic': ("claude-3-5-sonnet-20240620", 200_000),
+}
+
+# System prompt used when the caller has no stable context of its own to send
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Opening and closing markdown code fences around a JSON response
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.MULTILINE)
+
+# A fenced code block, up to its closing fence or the end of the text
+_FENCED_BLOCK_RE = re.compile(r"```.*?(?:```|\Z)", re.DOTALL)
+
+# Ask streamed completions to end with a usage chunk; the pinned SDK has no stream_options argument
+_STREAM_USAGE_OPTIONS = {"stream_options": {"include_usage": True}}
+
+def _openai_extra_body(system_prompt: str) -> Dict[str, Any]:
+    """
+    Request fields the pinned SDK has no arguments for: the usage chunk, and a
+    prompt_cache_key derived from the system prompt so that requests sharing
+    it are routed to the same prompt cache.
+    """
+    prompt_cache_key = hashlib.blake2b(system_prompt.encode('utf-8'), digest_size=8).hexdigest()
+    return {**_STREAM_USAGE_OPTIONS, "prompt_cache_key": prompt_cache_key}
+
+# Errors worth retrying. Each SDK's APIError (which covers rate limit and connection errors) is
+# registered by APIClient.setup_client, so an SDK is only imported when its API is used.
+_retriable_errors: Tuple[type, ...] = (httpx.TimeoutException,)
+
+def _register_retriable_error(error_type: type):
+    global _retriable_errors
+    if error_type not in _retriable_errors:
+        _retriable_errors += (error_type,)
+
+def _is_permanent_error(error: Exception) -> bool:
+    """Return True for client errors (bad request, auth, not found, ...) that will fail again on retry."""
+    status_code = getattr(error, 'status_code', None)
+    return status_code is not None and status_code < 500 and status_code not in (408, 409, 429)
+
+def _should_give_up(error: Exception) -> bool:
+    """Return True for errors that should not be retried."""
+    return not isinstance(error, _retriable_errors) or _is_permanent_error(error)
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return the delay the API asked for in its retry-after headers, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # retry-after may also be an HTTP date; fall back to exponential backoff
+        return None
+    return None
+
+def _retry_wait(max_value: float = 30):
+    """
+    backoff wait generator: honours the API's retry-after delay when given,
+    otherwise waits exponentially with full jitter.
+    """
+    exponential = backoff.expo(max_value=max_value)
+    next(exponential)
+    error = yield
+    while True:
+        delay = next(exponential)
+        retry_after = _retry_after_seconds(error)
+        error = yield retry_after if retry_after is not None else random.uniform(0, delay)
 
 class APIClient:
+    # Only curly double quotes: curly apostrophes are common inside generated string literals, e.g. 'Customer\u2019s spend'
+    _QUOTE_TABLE = str.maketrans({'\u201c': '"', '\u201d': '"'})
+
     def __init__(self, api_type: str = 'openai', timeout: float = 30.0):
         self.api_type = api_type
         self.timeout = timeout
         self.setup_client()
+        # One request budget for every call this client makes, sync, streamed or batched
+        self.rate_limiter = RateLimiter(config.API_REQUESTS_PER_MINUTE)
         self.max_retries = 3
         self.retry_delay = 1  # in seconds
+        self.cache = ResponseCache(config.LLM_CACHE_PATH, ttl=config.LLM_CACHE_TTL) if config.LLM_CACHE_ENABLED else None
+        # Embeddings come from the OpenAI API, so the semantic tier is only available there.
+        # It backs the exact cache, so turning response caching off disables both.
+        self.semantic_cache = None
+        if config.LLM_CACHE_ENABLED and config.LLM_SEMANTIC_CACHE_ENABLED and self.api_type == 'openai':
+            self.semantic_cache = SemanticCache(config.LLM_SEMANTIC_CACHE_PATH, config.LLM_SEMANTIC_CACHE_THRESHOLD)
     
     def setup_client(self):
         """Set up the API client based on the specified API type."""
-        if self.api_type == 'openai':
-            openai_api_key = os.getenv("OPENAI_API_KEY")
-            if not openai_api_key:
-                raise ValueError("OPENAI_API_KEY not found in environment variables")
-            self.client = OpenAI(api_key=openai_api_key)
-        elif self.api_type == 'anthropic':
-            anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-            if not anthropic_api_key:
-                raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-            self.client = Anthropic(api_key=anthropic_api_key)
-        else:
+        if self.api_type not in _MODEL_INFO:
             raise ValueError(f"Unsupported API type: {self.api_type}")
-        
-        logging.info(f"API client set up for {self.api_type}")
+        # Check the key before opening the connection pool, so a misconfigured client leaves nothing open
+        api_key_var = f"{self.api_type.upper()}_API_KEY"
+        self.api_key = os.getenv(api_key_var)
+        if not self.api_key:
+            raise ValueError(f"{api_key_var} not found in environment variables")
 
-    @backoff.on_exception(backoff.expo, 
-                          (RateLimitError, APIError, httpx.TimeoutException),
-                          max_tries=5)
-    def call_api(self, prompt: str, max_tokens: int = 1000, use_json_mode: bool = False) -> str:
+        # One pooled HTTP client per APIClient, so keep-alive connections are reused across calls
+        self._http_limits = httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS,
+                                         max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                         keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY)
+        # HTTP/2 multiplexes concurrent requests over one connection; httpx needs the optional h2 package for it
+        self._http2 = importlib.util.find_spec('h2') is not None
+        self._http_client = httpx.Client(limits=self._http_limits, timeout=self.timeout, http2=self._http2)
+        try:
+            if self.api_type == 'openai':
+                from openai import OpenAI, APIError
+                _register_retriable_error(APIError)
+                self.client = OpenAI(api_key=self.api_key, http_client=self._http_client)
+                self._call_provider = self._call_openai_api
+                self._acall_provider = self._acall_openai_api
+                self._open_provider_stream = self._open_openai_stream
+                self._iter_provider_stream = self._iter_openai_stream
+            else:
+                from anthropic import Anthropic, APIError
+                _register_retriable_error(APIError)
+                self.client = Anthropic(api_key=self.api_key, http_client=self._http_client)
+                self._call_provider = self._call_anthropic_api
+                self._acall_provider = self._acall_anthropic_api
+                self._open_provider_stream = self._open_anthropic_stream
+                self._iter_provider_stream = self._iter_anthropic_stream
+        except BaseException:
+            # The provider SDK is missing or rejected its arguments; nothing else owns the pool yet
+            self._http_client.close()
+            raise
+        # Resolved once here, so calls do not look them up by API type each time
+        self._model_name, self._max_tokens = _MODEL_INFO[self.api_type]
+
+        logger.info(f"API client set up for {self.api_type}")
+
+    def close(self):
+        """Close the pooled HTTP connections and the response cache, and persist the semantic cache."""
+        self._http_client.close()
+        if self.cache is not None:
+            logger.info(f"LLM response cache stats: {self.cache.stats()}")
+            self.cache.close()
+        if self.semantic_cache is not None:
+            self.semantic_cache.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _create_async_client(self):
+        """Create an async client for the configured API, to be used within a single event loop."""
+        # httpx async pools are bound to the event loop they were first used in, so each batch gets its own
+        http_client = httpx.AsyncClient(limits=self._http_limits, timeout=self.timeout, http2=self._http2)
+        if self.api_type == 'openai':
+            from openai import AsyncOpenAI
+            return AsyncOpenAI(api_key=self.api_key, http_client=http_client)
+        from anthropic import AsyncAnthropic
+        return AsyncAnthropic(api_key=self.api_key, http_client=http_client)
+
+    def call_api(self, prompt: str, max_tokens: int = 1000, use_json_mode: bool = False, system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+                 force_refresh: bool = False, allow_similar: bool = False) -> str:
         """
         Call the API with error handling and retrying.
 
+        Responses are looked up in the response cache first; a cached response
+        for the same model, prompt and parameters is returned without calling
+        the API. When allow_similar is set and the semantic cache is enabled, a
+        response to a sufficiently similar earlier prompt is reused as well.
+        Code generation prompts must not set it: they share a long plan and data
+        dictionary prefix, so another step's prompt can look similar enough.
+        Neither may prompts about analysis results: two runs whose prompts
+        differ only in the numbers embed almost identically.
+
+        Context that stays the same across calls (data dictionary, guidelines,
+        response schemas) belongs in system_prompt: it is sent first, so
+        OpenAI's server-side prompt cache can reuse it between requests.
+
         Args:
         prompt (str): The prompt to send to the API.
         max_tokens (int): The maximum number of tokens to generate.
         use_json_mode (bool): Whether to use JSON mode for structured output.
+        system_prompt (str): The system prompt sent ahead of the prompt.
+        force_refresh (bool): Whether to skip the cache lookups and call the API;
+            the new response replaces any cached one.
+        allow_similar (bool): Whether a response to a similar prompt may be used, through the semantic cache.
 
         Returns:
         str: The API response.
@@ -52,65 +228,505 @@ class APIClient:
         Raises:
         Exception: If the API call fails after max retries.
         """
-        logging.debug(f"Sending prompt to {self.api_type} API: {prompt}")
-        if self.api_type == 'openai':
-            return self._call_openai_api(prompt, max_tokens, use_json_mode)
-        elif self.api_type == 'anthropic':
-            return self._call_anthropic_api(prompt, max_tokens)
+        model_name = self.get_model_name()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(prompt, max_tokens, use_json_mode, system_prompt)
+            cached_response = None if force_refresh else self.cache.get(model_name, cache_key)
+            if cached_response is not None:
+                logger.info(f"Using cached {self.api_type} API response")
+                return cached_response
+
+        embedding = None
+        system_prompt_hash = hashlib.blake2b(system_prompt.encode('utf-8'), digest_size=8).hexdigest()
+        semantic_model_key = f"{model_name}:{max_tokens}:{int(use_json_mode)}:{system_prompt_hash}"
+        if self.semantic_cache is not None and allow_similar:
+            embedding = self._embed(prompt)
+            if embedding is not None and not force_refresh:
+                cached_response = self.semantic_cache.lookup(semantic_model_key, embedding)
+                if cached_response is not None:
+                    logger.info(f"Using semantically cached {self.api_type} API response")
+                    return cached_response
+
+        response = self._call_api_with_retry(prompt, max_tokens, use_json_mode, system_prompt)
+        if cache_key is not None:
+            self.cache.set(model_name, cache_key, response)
+        if embedding is not None:
+            self.semantic_cache.add(semantic_model_key, embedding, response)
+        return response
+
+    def call_api_with_images(self, prompt: str, images: List[str], max_tokens: int = 1000, use_json_mode: bool = False,
+                             system_prompt: str = DEFAULT_SYSTEM_PROMPT, force_refresh: bool = False) -> str:
+        """
+        Call the API with a prompt followed by PNG images.
+
+        Goes through the same response cache, rate limiter and retries as
+        call_api. The images are part of the cache key; the semantic cache is
+        not used.
+
+        Args:
+        prompt (str): The text of the prompt, sent ahead of the images.
+        images (List[str]): Base64-encoded PNG images.
+        max_tokens (int): The maximum number of tokens to generate.
+        use_json_mode (bool): Whether to use JSON mode for structured output.
+        system_prompt (str): The system prompt sent ahead of the prompt.
+        force_refresh (bool): Whether to skip the cache lookup and call the API.
+
+        Returns:
+        str: The API response.
+
+        Raises:
+        ValueError: If the client is not using the OpenAI API; the Anthropic text completions API takes no images.
+        Exception: If the API call fails after max retries.
+        """
+        if self.api_type != 'openai':
+            raise ValueError(f"Image input is not supported for {self.api_type}")
+
+        model_name = self.get_model_name()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key("\x00".join([prompt, *images]), max_tokens, use_json_mode, system_prompt)
+            cached_response = None if force_refresh else self.cache.get(model_name, cache_key)
+            if cached_response is not None:
+                logger.info(f"Using cached {self.api_type} API response")
+                return cached_response
+
+        # Chat completions take a list of content parts in place of the prompt text
+        content = [{"type": "text", "text": prompt},
+                   *({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}} for image in images)]
+        response = self._call_api_with_retry(content, max_tokens, use_json_mode, system_prompt)
+        if cache_key is not None:
+            self.cache.set(model_name, cache_key, response)
+        return response
+
+    def _embed(self, prompt: str):
+        """Embed a prompt for the semantic cache, or return None if the embedding call fails."""
+        # Indentation and line breaks carry no meaning in prompts; leave them out so they cannot lower similarity
+        normalized_prompt = " ".join(prompt.split())
+        try:
+            response = self.client.embeddings.create(model=config.LLM_SEMANTIC_CACHE_EMBEDDING_MODEL, input=normalized_prompt)
+            return response.data[0].embedding
+        except Exception as e:
+            logger.warning(f"Could not embed prompt for the semantic cache: {str(e)}")
+            return None
+
+    def call_api_batch(self, prompts: List[str], max_tokens: int = 1000, use_json_mode: bool = False, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> List[Any]:
+        """
+        Call the API for several independent prompts concurrently.
+
+        At most config.MAX_API_CONCURRENCY requests are in flight at once. Each
+        prompt goes through the same response cache and retry logic as call_api;
+        the semantic cache is not used.
+
+        Args:
+        prompts (List[str]): The prompts to send to the API.
+        max_tokens (int): The maximum number of tokens to generate per prompt.
+        use_json_mode (bool): Whether to use JSON mode for structured output.
+        system_prompt (str): The system prompt shared by all prompts.
+
+        Returns:
+        List[Any]: The responses in prompt order. A prompt whose call failed
+        after all retries has the raised exception in its position instead.
+        """
+        return asyncio.run(self._call_api_batch(prompts, max_tokens, use_json_mode, system_prompt))
+
+    def call_api_packed(self, items: List[str], instruction: str, max_tokens_per_item: int = 1000,
+                        structured_output: bool = False) -> List[Optional[Any]]:
+        """
+        Answer several independent prompts with a single structured API request.
+
+        The shared instruction is sent as the system prompt and the items as a
+        JSON list in the user prompt, and the model is asked to reply with one JSON output per item. Items are
+        split into requests of at most config.MAX_BATCH_ITEMS.
+
+        Args:
+        items (List[str]): The per-item prompts.
+        instruction (str): The instruction and context shared by all items.
+        max_tokens_per_item (int): The token budget for each item's output.
+        structured_output (bool): Whether each output is a JSON object, described by the instruction,
+            instead of a string.
+
+        Returns:
+        List[Optional[Any]]: The output for each item, in order; None for items
+        whose output is missing because the request or its parsing failed.
+        """
+        outputs: List[Optional[Any]] = [None] * len(items)
+        output_type = dict if structured_output else str
+        output_placeholder = "<JSON object for that item>" if structured_output else '"<output for that item>"'
+        for start in range(0, len(items), config.MAX_BATCH_ITEMS):
+            batch = list(enumerate(items[start:start + config.MAX_BATCH_ITEMS], start))
+            prompt = f"""
+        Respond with a JSON object of the form {{"results": [{{"id": <item id>, "output": {output_placeholder}}}]}},
+        with exactly one result for each item.
+
+        Items:
+        {json.dumps({"items": [{"id": i, "prompt": item} for i, item in batch]})}
+        """
+            try:
+                response = self.call_api(prompt, max_tokens=max_tokens_per_item * len(batch), use_json_mode=True,
+                                         system_prompt=instruction)
+                results = self.parse_json_response(response).get("results", [])
+                batch_ids = {i for i, _ in batch}
+                for result in results:
+                    if result.get("id") in batch_ids and isinstance(result.get("output"), output_type):
+                        outputs[result["id"]] = result["output"]
+            except Exception as e:
+                logger.error(f"Batched API request for items {start}-{start + len(batch) - 1} failed: {str(e)}")
+        return outputs
+
+    def submit_batch(self, prompts: List[str], max_tokens: int = 1000, use_json_mode: bool = False, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> str:
+        """
+        Submit prompts to the OpenAI Batch API, which completes them asynchronously at a discount.
+
+        Args:
+        prompts (List[str]): The prompts to send to the API.
+        max_tokens (int): The maximum number of tokens to generate per prompt.
+        use_json_mode (bool): Whether to use JSON mode for structured output.
+        system_prompt (str): The system prompt shared by all prompts.
+
+        Returns:
+        str: The ID of the submitted batch, to pass to poll_batch.
+
+        Raises:
+        ValueError: If the client is not using the OpenAI API.
+        """
+        if self.api_type != 'openai':
+            raise ValueError(f"Batch API is not supported for {self.api_type}")
 
-    def _call_openai_api(self, prompt: str, max_tokens: int, use_json_mode: bool) -> str:
+        lines = []
+        for i, prompt in enumerate(prompts):
+            body = self._openai_request_params(prompt, max_tokens, use_json_mode, system_prompt)
+            # Batch requests are not streamed, and timeouts are a client-side setting
+            del body["stream"], body["timeout"]
+            lines.append(json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body}))
+
+        input_file = self.client.files.create(file=("batch_input.jsonl", "\n".join(lines).encode('utf-8')), purpose="batch")
+        # The pinned openai SDK predates its batches resource, so call the endpoint directly
+        batch = self.client.post(
+            "/batches",
+            body={"input_file_id": input_file.id, "endpoint": "/v1/chat/completions",
+                  "completion_window": config.BATCH_COMPLETION_WINDOW},
+            cast_to=object
+        )
+        logger.info(f"Submitted batch {batch['id']} with {len(prompts)} requests")
+        return batch['id']
+
+    def poll_batch(self, batch_id: str, num_prompts: int) -> List[Optional[str]]:
+        """
+        Wait for a batch submitted with submit_batch to finish and return its responses.
+
+        Args:
+        batch_id (str): The ID returned by submit_batch.
+        num_prompts (int): The number of prompts in the batch.
+
+        Returns:
+        List[Optional[str]]: The response for each prompt, in submission order;
+        None for requests that failed within the batch.
+
+        Raises:
+        RuntimeError: If the batch fails, expires or is cancelled.
+        """
+        poll_interval = config.BATCH_POLL_INTERVAL
+        while True:
+            batch = self.client.get(f"/batches/{batch_id}", cast_to=object)
+            status = batch['status']
+            if status == 'completed':
+                break
+            if status in ('failed', 'expired', 'cancelled'):
+                raise RuntimeError(f"Batch {batch_id} ended with status {status}")
+            logger.info(f"Batch {batch_id} is {status}; checking again in {poll_interval} seconds")
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, config.BATCH_MAX_POLL_INTERVAL)
+
+        responses: List[Optional[str]] = [None] * num_prompts
+        if batch.get('output_file_id'):
+            output = self.client.files.content(batch['output_file_id']).text
+            for line in output.splitlines():
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if response.get('status_code') == 200:
+                    content = response['body']['choices'][0]['message']['content']
+                    responses[int(result['custom_id'])] = self._preprocess_response(content)
+        logger.info(f"Batch {batch_id} completed with {sum(r is not None for r in responses)}/{num_prompts} successful responses")
+        return responses
+
+    def call_api_offline(self, prompts: List[str], max_tokens: int = 1000, use_json_mode: bool = False, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> List[Optional[str]]:
+        """
+        Run prompts through the Batch API and wait for the results.
+
+        Cached responses are reused and only the remaining prompts are
+        submitted; their responses are added to the cache.
+
+        Args:
+        prompts (List[str]): The prompts to send to the API.
+        max_tokens (int): The maximum number of tokens to generate per prompt.
+        use_json_mode (bool): Whether to use JSON mode for structured output.
+        system_prompt (str): The system prompt shared by all prompts.
+
+        Returns:
+        List[Optional[str]]: The response for each prompt, in order; None for failed requests.
+        """
+        model_name = self.get_model_name()
+        responses: List[Optional[str]] = [None] * len(prompts)
+        cache_keys = [None] * len(prompts)
+        if self.cache is not None:
+            for i, prompt in enumerate(prompts):
+                cache_keys[i] = self.cache.make_key(prompt, max_tokens, use_json_mode, system_prompt)
+                responses[i] = self.cache.get(model_name, cache_keys[i])
+
+        pending = [i for i, response in enumerate(responses) if response is None]
+        if not pending:
+            return responses
+
+        batch_id = self.submit_batch([prompts[i] for i in pending], max_tokens, use_json_mode, system_prompt)
+        for i, response in zip(pending, self.poll_batch(batch_id, len(pending))):
+            responses[i] = response
+            if response is not None and cache_keys[i] is not None:
+                self.cache.set(model_name, cache_keys[i], response)
+        return responses
+
+    def stream_api(self, prompt: str, max_tokens: int = 1000, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> Iterator[str]:
+        """
+        Call the API and yield the response text as it is generated.
+
+        Opening the stream is retried like call_api; a failure after text has
+        started arriving is raised to the caller. A cached response is yielded
+        as a single chunk, and a completed response is added to the cache.
+
+        Args:
+        prompt (str): The prompt to send to the API.
+        max_tokens (int): The maximum number of tokens to generate.
+        system_prompt (str): The system prompt sent ahead of the prompt.
+
+        Yields:
+        str: Consecutive pieces of the response.
+        """
+        model_name = self.get_model_name()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(prompt, max_tokens, False, system_prompt)
+            cached_response = self.cache.get(model_name, cache_key)
+            if cached_response is not None:
+                logger.info(f"Using cached {self.api_type} API response")
+                yield cached_response
+                return
+
+        stream = self._open_stream_with_retry(prompt, max_tokens, system_prompt)
+
+        parts = []
+        for chunk in self._iter_provider_stream(stream):
+            chunk = self._preprocess_response(chunk)
+            parts.append(chunk)
+            yield chunk
+
+        if cache_key is not None:
+            self.cache.set(model_name, cache_key, ''.join(parts))
+
+    @backoff.on_exception(_retry_wait,
+                          Exception,
+                          max_tries=5,
+                          jitter=None,
+                          giveup=_should_give_up)
+    def _open_stream_with_retry(self, prompt: str, max_tokens: int, system_prompt: str):
+        """Start a streamed completion, retrying transient failures."""
+        logger.debug("Streaming prompt to %s API: %s", self.api_type, prompt)
+        with self.rate_limiter:
+            return self._open_provider_stream(prompt, max_tokens, False, system_prompt)
+
+    async def _call_api_batch(self, prompts: List[str], max_tokens: int, use_json_mode: bool, system_prompt: str) -> List[Any]:
+        semaphore = asyncio.Semaphore(config.MAX_API_CONCURRENCY)
+        async with self._create_async_client() as async_client:
+            async def call(prompt: str) -> str:
+                async with semaphore:
+                    return await self._acall_api(async_client, prompt, max_tokens, use_json_mode, system_prompt)
+
+            return await asyncio.gather(*(call(prompt) for prompt in prompts), return_exceptions=True)
+
+    async def _acall_api(self, async_client, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str) -> str:
+        """Async counterpart of call_api, sharing the same response cache."""
+        if self.cache is None:
+            return await self._acall_api_with_retry(async_client, prompt, max_tokens, use_json_mode, system_prompt)
+
+        model_name = self.get_model_name()
+        cache_key = self.cache.make_key(prompt, max_tokens, use_json_mode, system_prompt)
+        cached_response = self.cache.get(model_name, cache_key)
+        if cached_response is not None:
+            logger.info(f"Using cached {self.api_type} API response")
+            return cached_response
+
+        response = await self._acall_api_with_retry(async_client, prompt, max_tokens, use_json_mode, system_prompt)
+        self.cache.set(model_name, cache_key, response)
+        return response
+
+    @backoff.on_exception(_retry_wait,
+                          Exception,
+                          max_tries=5,
+                          jitter=None,
+                          giveup=_should_give_up)
+    def _call_api_with_retry(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> str:
+        """Dispatch the prompt to the configured API, retrying transient failures."""
+        logger.debug("Sending prompt to %s API: %s", self.api_type, prompt)
+        # Space out request starts so the client stays under the per-minute quota instead of hitting 429s
+        with self.rate_limiter:
+            return self._call_provider(prompt, max_tokens, use_json_mode, system_prompt)
+
+    @backoff.on_exception(_retry_wait,
+                          Exception,
+                          max_tries=5,
+                          jitter=None,
+                          giveup=_should_give_up)
+    async def _acall_api_with_retry(self, async_client, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str) -> str:
+        """Async counterpart of _call_api_with_retry."""
+        logger.debug("Sending prompt to %s API: %s", self.api_type, prompt)
+        async with self.rate_limiter:
+            return await self._acall_provider(async_client, prompt, max_tokens, use_json_mode, system_prompt)
+
+    def _openai_request_params(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> Dict[str, Any]:
+        """Build the chat completion request for the OpenAI API."""
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ]
+        api_params = {
+            "model": self._model_name,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "timeout": self.timeout,
+            "stream": True,
+        }
+        
+        if use_json_mode:
+            api_params["response_format"] = {"type": "json_object"}
+            logger.debug("Using JSON mode for structured output")
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API request parameters: %s", json.dumps(api_params))
+        return api_params
+
+    def _anthropic_request_params(self, prompt: str, max_tokens: int, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> Dict[str, Any]:
+        """Build the completion request for the Anthropic API."""
+        from anthropic import HUMAN_PROMPT, AI_PROMPT
+        # The text completions API takes a system prompt as text ahead of the first human turn
+        return {
+            "model": self._model_name,
+            "prompt": f"{system_prompt}{HUMAN_PROMPT} {prompt}{AI_PROMPT}",
+            "max_tokens_to_sample": max_tokens,
+            "timeout": self.timeout,
+            "stream": True,
+        }
+
+    def _open_openai_stream(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str):
+        """Start a streamed OpenAI chat completion that ends with a usage chunk."""
+        return self.client.chat.completions.create(**self._openai_request_params(prompt, max_tokens, use_json_mode, system_prompt),
+                                                   extra_body=_openai_extra_body(system_prompt))
+
+    def _open_anthropic_stream(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str):
+        """Start a streamed Anthropic completion. The completions API has no JSON mode, so use_json_mode is ignored."""
+        return self.client.completions.create(**self._anthropic_request_params(prompt, max_tokens, system_prompt))
+
+    def _iter_openai_stream(self, stream) -> Iterator[str]:
+        """Yield the text of a streamed OpenAI completion, logging token usage once it ends."""
+        usage = None
+        for chunk in stream:
+            if chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+        self._log_openai_usage(usage)
+
+    def _iter_anthropic_stream(self, stream) -> Iterator[str]:
+        """Yield the text of a streamed Anthropic completion."""
+        for event in stream:
+            if event.completion:
+                yield event.completion
+
+    def _log_openai_usage(self, usage: Any):
+        """Log token usage, including how much of the prompt was served from OpenAI's prompt cache."""
+        if usage is None:
+            return
+        # Depending on the SDK version the usage chunk is parsed into a model or left as a dict
+        if hasattr(usage, 'model_dump'):
+            usage = usage.model_dump()
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        cache_ratio = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        logger.info(f"OpenAI usage: {prompt_tokens} prompt tokens ({cached_tokens} cached, {cache_ratio:.0%}), "
+                     f"{usage.get('completion_tokens')} completion tokens")
+
+    def _log_openai_error(self, error: Exception):
+        from openai import APIError, BadRequestError
+        if isinstance(error, httpx.TimeoutException):
+            logger.error(f"OpenAI API call timed out after {self.timeout} seconds")
+        elif isinstance(error, BadRequestError):
+            logger.error(f"Bad Request Error: {error.response.json()}")
+        elif isinstance(error, APIError):
+            logger.error(f"API Error: {str(error)}")
+        else:
+            logger.error(f"Unexpected error in OpenAI API call: {str(error)}")
+
+    def _log_anthropic_error(self, error: Exception):
+        if isinstance(error, httpx.TimeoutException):
+            logger.error(f"Anthropic API call timed out after {self.timeout} seconds")
+        else:
+            logger.error(f"Anthropic API error: {str(error)}")
+
+    def _call_openai_api(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> str:
         """Call the OpenAI API."""
         try:
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ]
-            api_params = {
-                "model": self.get_model_name(),
-                "messages": messages,
-                "max_tokens": max_tokens,
-                "timeout": self.timeout,
-            }
-            
-            if use_json_mode:
-                api_params["response_format"] = {"type": "json_object"}
-                logging.debug("Using JSON mode for structured output")
-
-            logging.debug(f"API request parameters: {json.dumps(api_params)}")
-            response = self.client.chat.completions.create(**api_params)
-            logging.debug(f"Received raw response from OpenAI API: {response}")
-            processed_response = self._preprocess_response(response.choices[0].message.content)
+            # Stream the completion so the read timeout applies per chunk rather than to the whole generation
+            stream = self._open_openai_stream(prompt, max_tokens, use_json_mode, system_prompt)
+            content = ''.join(self._iter_openai_stream(stream))
+            logger.debug("Received streamed response from OpenAI API: %s", content)
+            processed_response = self._preprocess_response(content)
             return processed_response
-        except httpx.TimeoutException:
-            logging.error(f"OpenAI API call timed out after {self.timeout} seconds")
-            raise
-        except BadRequestError as e:
-            logging.error(f"Bad Request Error: {e.response.json()}")
-            raise
-        except APIError as e:
-            logging.error(f"API Error: {str(e)}")
+        except Exception as e:
+            self._log_openai_error(e)
             raise
+
+    async def _acall_openai_api(self, async_client: 'AsyncOpenAI', prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str) -> str:
+        """Call the OpenAI API asynchronously."""
+        try:
+            stream = await async_client.chat.completions.create(**self._openai_request_params(prompt, max_tokens, use_json_mode, system_prompt),
+                                                                extra_body=_openai_extra_body(system_prompt))
+            parts, usage = [], None
+            async for chunk in stream:
+                if chunk.choices:
+                    parts.append(chunk.choices[0].delta.content or '')
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+            content = ''.join(parts)
+            self._log_openai_usage(usage)
+            logger.debug("Received streamed response from OpenAI API: %s", content)
+            processed_response = self._preprocess_response(content)
+            return processed_response
         except Exception as e:
-            logging.error(f"Unexpected error in OpenAI API call: {str(e)}")
+            self._log_openai_error(e)
             raise
 
-    def _call_anthropic_api(self, prompt: str, max_tokens: int) -> str:
+    def _call_anthropic_api(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str = DEFAULT_SYSTEM_PROMPT) -> str:
         """Call the Anthropic API."""
         try:
-            response = self.client.completions.create(
-                model="claude-3-sonnet-20240229",
-                prompt=f"{HUMAN_PROMPT} {prompt}{AI_PROMPT}",
-                max_tokens_to_sample=max_tokens,
-                timeout=self.timeout
-            )
-            logging.debug(f"Received raw response from Anthropic API: {response}")
-            processed_response = self._preprocess_response(response.completion)
+            stream = self._open_anthropic_stream(prompt, max_tokens, use_json_mode, system_prompt)
+            completion = ''.join(self._iter_anthropic_stream(stream))
+            logger.debug("Received streamed response from Anthropic API: %s", completion)
+            processed_response = self._preprocess_response(completion)
             return processed_response
-        except httpx.TimeoutException:
-            logging.error(f"Anthropic API call timed out after {self.timeout} seconds")
+        except Exception as e:
+            self._log_anthropic_error(e)
             raise
+
+    async def _acall_anthropic_api(self, async_client: 'AsyncAnthropic', prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str) -> str:
+        """Call the Anthropic API asynchronously. The completions API has no JSON mode, so use_json_mode is ignored."""
+        try:
+            stream = await async_client.completions.create(**self._anthropic_request_params(prompt, max_tokens, system_prompt))
+            completion = ''.join([event.completion async for event in stream])
+            logger.debug("Received streamed response from Anthropic API: %s", completion)
+            processed_response = self._preprocess_response(completion)
+            return processed_response
         except Exception as e:
-            logging.error(f"Anthropic API error: {str(e)}")
+            self._log_anthropic_error(e)
             raise
 
     def _preprocess_response(self, response: str) -> str:
@@ -123,13 +739,18 @@ class APIClient:
         Returns:
         str: The preprocessed response.
         """
-        # Replace smart quotes with straight quotes
-        processed_response = response.replace('“', '"').replace('”', '"')
-        
-        # Log the preprocessing step
-        logging.info("Preprocessed API response to handle smart quotes")
-        logging.debug(f"Preprocessed response: {processed_response}")
-        
+        # Replace smart double quotes with straight quotes in a single pass, leaving fenced code as generated
+        if '```' in response:
+            parts, end = [], 0
+            for block in _FENCED_BLOCK_RE.finditer(response):
+                parts.append(response[end:block.start()].translate(self._QUOTE_TABLE))
+                parts.append(block.group(0))
+                end = block.end()
+            parts.append(response[end:].translate(self._QUOTE_TABLE))
+            processed_response = ''.join(parts)
+        else:
+            processed_response = response.translate(self._QUOTE_TABLE)
+        logger.debug("Preprocessed response: %s", processed_response)
         return processed_response
 
     def parse_json_response(self, response: str) -> Any:
@@ -143,21 +764,20 @@ class APIClient:
         Any: The parsed JSON data.
         
         Raises:
-        json.JSONDecodeError: If the response cannot be parsed as JSON.
+        ValueError: If the response cannot be parsed as JSON.
         """
         try:
             # For structured output, the response should already be in JSON format
-            return json.loads(response)
-        except json.JSONDecodeError:
-            # Fallback to the previous method for non-structured responses
-            try:
-                # Strip the markdown code block delimiters
-                json_str = response.strip("```json").strip("\n```")
-                return json.loads(json_str)
-            except json.JSONDecodeError as e:
-                logging.error(f"Failed to parse API response as JSON. Error: {str(e)}")
-                logging.error(f"Problematic response content: {response}")
-                raise
+            return orjson.loads(response)
+        except orjson.JSONDecodeError:
+            pass
+        try:
+            # Fallback for responses wrapped in a markdown code block
+            return orjson.loads(_FENCE_RE.sub("", response))
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Failed to parse API response as JSON. Error: {str(e)}")
+            logger.error(f"Problematic response content: {response}")
+            raise
 
     def get_token_count(self, text: str) -> int:
         """
@@ -169,22 +789,37 @@ class APIClient:
         Returns:
         int: The number of tokens in the text.
         """
-        # Using a simple estimation for both OpenAI and Anthropic
-        return len(text.split())
+        if self.api_type == 'anthropic':
+            return self.client.count_tokens(text)
+        return len(_get_encoding(self._model_name).encode(text))
+
+    def truncate_to_tokens(self, text: str, max_tokens: int) -> str:
+        """
+        Truncate text to at most max_tokens tokens.
+
+        Args:
+        text (str): The text to truncate.
+        max_tokens (int): The maximum number of tokens to keep.
+
+        Returns:
+        str: The text unchanged if it fits, otherwise its first max_tokens tokens followed by "...(truncated)".
+        """
+        # Every token covers at least one UTF-8 byte, so short text cannot exceed the budget
+        if len(text.encode('utf-8')) <= max_tokens:
+            return text
+        encoding = _get_encoding(self._model_name)
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens]) + "...(truncated)"
 
     def get_model_name(self) -> str:
         """Get the name of the current model being used."""
-        if self.api_type == 'openai':
-            return "gpt-4o-2024-08-06"  # Updated to use the specified model name
-        elif self.api_type == 'anthropic':
-            return "claude-3-sonnet-20240229"
+        return self._model_name
 
     def get_max_tokens(self) -> int:
         """Get the maximum number of tokens supported by the current model."""
-        if self.api_type == 'openai':
-            return 4096  # Assuming the same token limit as GPT-4
-        elif self.api_type == 'anthropic':
-            return 200000  # for claude-3-sonnet-20240229
+        return self._max_tokens
 
 if __name__ == "__main__":
     # This block is for testing purposes and will not be executed when imported
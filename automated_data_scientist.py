@@ -1,183 +1,378 @@
 import logging
 import json
+import asyncio
+import threading
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 import time
 import traceback
+from functools import cached_property
+import orjson
 
 import config
 from data_handling import DataHandler
 from analysis_planning import AnalysisPlanner
 from code_generation import CodeGenerator
-from execution import CodeExecutor
+from execution import CodeExecutor, EXECUTION_ERROR_MARKER
 from interpretation import ResultInterpreter
 from api_client import APIClient
 from notebook_manager import NotebookManager
-import pandas as pd  # Added to read the full CSV file
+
+logger = logging.getLogger(__name__)
 
 class AutomatedDataScientist:
     def __init__(self, production_csv_path: str = None, output_path: str = None, data_dict_path: str = None, 
                  api_type: str = None, code_generator: CodeGenerator = None, notebook_manager: NotebookManager = None,
-                 data_handler: DataHandler = None):
+                 data_handler: DataHandler = None, batch_mode: bool = False, api_client: APIClient = None):
         # Use config values, but allow overrides
         self.production_csv_path = Path(production_csv_path or config.PRODUCTION_CSV_PATH)
         self.output_path = Path(output_path or config.DEFAULT_OUTPUT_DIR)
         self.data_dict_path = Path(data_dict_path or config.DATA_DICT_PATH)
         self.api_type = api_type or config.DEFAULT_API_TYPE
+        # Generate code through the slower but cheaper Batch API
+        self.batch_mode = batch_mode
 
         # Create output directory
         self.output_path.mkdir(parents=True, exist_ok=True)
 
-        # Initialize components
-        self.api_client = APIClient(self.api_type)
-        self.data_handler = data_handler or DataHandler(self.data_dict_path, self.production_csv_path)
-        self.analysis_planner = AnalysisPlanner(self.api_client, self.output_path)
-        self.code_generator = code_generator or CodeGenerator(self.api_client)
-        self.code_executor = CodeExecutor(self.output_path)
-        self.result_interpreter = ResultInterpreter(self.api_client)
-        self.notebook_manager = notebook_manager or NotebookManager(config.NOTEBOOK_PATH)
+        # Components are created on first use; injected ones take the place of the defaults.
+        # An injected code generator's API client is shared, so all components use one connection pool.
+        if api_client is None and code_generator is not None:
+            api_client = code_generator.api_client
+        if api_client is not None:
+            self.api_client = api_client
+        if data_handler is not None:
+            self.data_handler = data_handler
+        if code_generator is not None:
+            self.code_generator = code_generator
+        if notebook_manager is not None:
+            self.notebook_manager = notebook_manager
 
         # Initialize data structures
         self.analysis_plan = []
         self.completed_analyses = []
         self.key_findings = []
         self.analysis_plan_version = 0
+        self._full_row_count = None
+        # Generated code runs in this process with global stdout and pyplot state, one analysis at a time
+        self._execution_lock = threading.Lock()
+
+        logger.info("Automated Data Scientist initialized")
+
+    @cached_property
+    def api_client(self) -> APIClient:
+        return APIClient(self.api_type)
+
+    @cached_property
+    def data_handler(self) -> DataHandler:
+        return DataHandler(self.data_dict_path, self.production_csv_path)
+
+    @cached_property
+    def analysis_planner(self) -> AnalysisPlanner:
+        return AnalysisPlanner(self.api_client, self.output_path)
 
-        logging.info("Automated Data Scientist initialized")
+    @cached_property
+    def code_generator(self) -> CodeGenerator:
+        return CodeGenerator(self.api_client)
+
+    @cached_property
+    def code_executor(self) -> CodeExecutor:
+        return CodeExecutor(self.output_path)
+
+    @cached_property
+    def result_interpreter(self) -> ResultInterpreter:
+        return ResultInterpreter(self.api_client)
+
+    @cached_property
+    def notebook_manager(self) -> NotebookManager:
+        return NotebookManager(config.NOTEBOOK_PATH)
 
     def run(self):
-        logging.info("Starting automated data science process")
+        logger.info("Starting automated data science process")
 
         try:
             # Start new analysis (removed resume feature)
-            logging.info("Starting new analysis")
+            logger.info("Starting new analysis")
             self.initialize_data_and_plan()
 
+            # Generate code for the pending analyses up front, with concurrent API calls
+            pregenerated_code = self.pregenerate_code()
+
             # Execute analyses
+            pending = []
             for i, analysis in enumerate(self.analysis_plan):
                 if i >= config.MAX_ANALYSES:
-                    logging.info(f"Reached maximum number of analyses ({config.MAX_ANALYSES}). Stopping.")
+                    logger.info(f"Reached maximum number of analyses ({config.MAX_ANALYSES}). Stopping.")
                     break
 
                 if analysis['status'] == 'completed':
-                    logging.info(f"Skipping completed analysis: {analysis['name']}")
+                    logger.info(f"Skipping completed analysis: {analysis['name']}")
                     continue
 
-                logging.info(f"Executing analysis {i+1}/{len(self.analysis_plan)}: {analysis['name']}")
+                pending.append((i, analysis))
 
-                self.execute_single_analysis(analysis)
+            if pending:
+                pipeline_results = asyncio.run(self.execute_analyses(pending, pregenerated_code))
+                # Record results in plan order so the notebook does not depend on which analysis finished first
+                for (_, analysis), (code, key_findings) in zip(pending, pipeline_results):
+                    self._record_analysis(analysis, code, key_findings)
+                # One checkpoint of the updated statuses for the whole wave
+                self.analysis_planner.save_plan_to_file(self.analysis_plan)
+                self._update_plan()
 
-                # Optionally save progress after each analysis (can be commented out if not needed)
+                # Optionally save progress after each batch of analyses (can be commented out if not needed)
                 # self.save_progress()
 
+            self.analysis_planner.save_plan_to_file(self.analysis_plan, final=True)
+
             # Generate final report
-            logging.info("Generating final report...")
+            logger.info("Generating final report...")
             self.generate_final_report()
 
             # Save the notebook
             self.notebook_manager.save_notebook()
-            logging.info("Notebook has been saved with all analysis steps.")
+            logger.info("Notebook has been saved with all analysis steps.")
 
-            logging.info("Automated data science process completed")
+            logger.info("Automated data science process completed")
 
         except Exception as e:
-            logging.error(f"An error occurred during the automated data science process: {str(e)}")
-            logging.error(traceback.format_exc())
+            logger.error(f"An error occurred during the automated data science process: {str(e)}")
+            logger.error(traceback.format_exc())
             # Attempt to save any progress made
             # self.save_progress() (optionally remove this if saving progress is not desired)
+            # Let queued plan checkpoints and notebook journal appends reach disk before the error propagates
+            self.analysis_planner.flush()
+            self.notebook_manager.flush()
             raise
 
     def initialize_data_and_plan(self):
         # Initialize data
-        logging.info("Initializing data...")
+        logger.info("Initializing data...")
         self.data_handler.initialize_data()
 
         # Determine the full data row count
-        logging.info("Reading full dataset to determine row count...")
+        logger.info("Counting rows in full dataset...")
         try:
-            full_data = pd.read_csv(self.production_csv_path)
-            full_data_row_count = full_data.shape[0]
-            logging.info(f"Full dataset has {full_data_row_count} rows")
+            full_data_row_count = self._count_csv_rows()
+            logger.info(f"Full dataset has {full_data_row_count} rows")
         except Exception as e:
-            logging.error(f"Error reading full dataset: {str(e)}")
+            logger.error(f"Error reading full dataset: {str(e)}")
             raise
 
         # Generate the initial analysis plan
-        logging.info("Generating initial analysis plan...")
+        logger.info("Generating initial analysis plan...")
         self.analysis_plan = self.analysis_planner.generate_initial_plan(
             self.data_handler.data_dict,
             self.data_handler.production_data_sample,
             full_data_row_count
         )
-        logging.info(f"Initial analysis plan generated: {len(self.analysis_plan)} steps")
+        logger.info(f"Initial analysis plan generated: {len(self.analysis_plan)} steps")
 
         # Enhance the analysis plan
-        logging.info("Enhancing analysis plan...")
+        logger.info("Enhancing analysis plan...")
         self.analysis_plan = self.analysis_planner.enhance_analysis_plan(
             self.data_handler.data_dict_content,
             self.analysis_plan
         )
-        logging.info("Analysis plan enhanced")
-
-    def execute_single_analysis(self, analysis: Dict[str, Any]):
-        # Generate code
-        logging.info("Generating code...")
+        logger.info("Analysis plan enhanced")
+
+    def _count_csv_rows(self) -> int:
+        """
+        Count the data rows of the production CSV without parsing it.
+
+        The file is read in 1 MiB blocks and only newlines are counted, so memory
+        use stays constant however large the dataset is. Quoted fields spanning
+        several lines are counted once per line. The count is cached.
+
+        Returns:
+        int: The number of rows, excluding the header.
+        """
+        if self._full_row_count is None:
+            block_size = 1 << 20
+            newlines = 0
+            last_block = b''
+            with open(self.production_csv_path, 'rb', buffering=block_size) as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    newlines += block.count(b'\n')
+                    last_block = block
+            # A last line without a trailing newline is still a row
+            lines = newlines + (1 if last_block and not last_block.endswith(b'\n') else 0)
+            self._full_row_count = max(lines - 1, 0)
+        return self._full_row_count
+
+    def pregenerate_code(self) -> Dict[int, Tuple[str, str]]:
+        """
+        Generate code for the pending analyses that run() will execute, concurrently.
+
+        Returns:
+        Dict[int, Tuple[str, str]]: Generated code and its interpretation template
+        keyed by the analysis index in the plan. The template is empty in batch
+        mode, where only code is generated. Analyses whose generation failed are
+        left out, so their code is generated again when they are executed.
+        """
+        pending = [(i, analysis) for i, analysis in enumerate(self.analysis_plan[:config.MAX_ANALYSES])
+                   if analysis.get('status') != 'completed']
+        if not pending:
+            return {}
+
+        logger.info("Generating code for pending analyses...")
         start_time = time.time()
-        code = self.code_generator.generate_code(
-            analysis,
+        generate = self.code_generator.generate_code_offline if self.batch_mode else self.code_generator.generate_code_batch
+        codes = generate(
+            [analysis for _, analysis in pending],
             self.data_handler.data_dict,
             self.analysis_plan,
             self.data_handler.data_dict_content
         )
-        logging.info(f"Code generation took {time.time() - start_time:.2f} seconds")
+        logger.info(f"Code generation took {time.time() - start_time:.2f} seconds")
+
+        pregenerated = {}
+        for (i, _), generated in zip(pending, codes):
+            if isinstance(generated, str):
+                pregenerated[i] = (generated, "")
+            elif isinstance(generated, tuple):
+                pregenerated[i] = generated
+        return pregenerated
+
+    async def execute_analyses(self, pending: List[Tuple[int, Dict[str, Any]]], pregenerated_code: Dict[int, Tuple[str, str]]) -> List[Tuple[str, List[str]]]:
+        """
+        Run the pipelines of several analyses concurrently.
+
+        Each pipeline runs in a worker thread, with at most
+        config.MAX_PARALLEL_ANALYSES at a time, so their API calls overlap.
+        Code execution itself stays serialized. The analyses are interpreted
+        against the analyses completed before this call, not against each other.
+
+        Args:
+        pending (List[Tuple[int, Dict[str, Any]]]): The analyses to run, with their index in the plan.
+        pregenerated_code (Dict[int, Tuple[str, str]]): Already generated code and interpretation templates keyed by plan index.
+
+        Returns:
+        List[Tuple[str, List[str]]]: The final code and key findings of each analysis, in order.
+        """
+        semaphore = asyncio.Semaphore(config.MAX_PARALLEL_ANALYSES)
+
+        async def run_pipeline(i: int, analysis: Dict[str, Any]) -> Tuple[str, List[str]]:
+            async with semaphore:
+                logger.info(f"Executing analysis {i+1}/{len(self.analysis_plan)}: {analysis['name']}")
+                return await asyncio.to_thread(self._run_analysis_pipeline, analysis, *pregenerated_code.get(i, (None, None)))
+
+        async with asyncio.TaskGroup() as task_group:
+            tasks = [task_group.create_task(run_pipeline(i, analysis)) for i, analysis in pending]
+        return [task.result() for task in tasks]
+
+    def execute_single_analysis(self, analysis: Dict[str, Any], code: str = None):
+        code, key_findings = self._run_analysis_pipeline(analysis, code)
+        self._record_analysis(analysis, code, key_findings)
+        self.analysis_planner.save_plan_to_file(self.analysis_plan)  # Save updated status
+        self._update_plan()
+
+    def _run_analysis_pipeline(self, analysis: Dict[str, Any], code: str = None, interpretation_stub: str = None) -> Tuple[str, List[str]]:
+        """
+        Generate, execute and interpret the code of an analysis, storing the results on it.
+
+        Args:
+        analysis (Dict[str, Any]): The analysis to run.
+        code (str): Already generated code; generated here when None.
+        interpretation_stub (str): Template for interpreting the result, generated along with code.
+
+        Returns:
+        Tuple[str, List[str]]: The code that was last executed and the key findings of its interpretation.
+        """
+        if code is None:
+            # Generate code
+            logger.info("Generating code...")
+            start_time = time.time()
+            try:
+                code, interpretation_stub = self.code_generator.generate_code_and_interpretation_scaffold(
+                    analysis,
+                    self.data_handler.data_dict,
+                    self.analysis_plan,
+                    self.data_handler.data_dict_content
+                )
+            except Exception as e:
+                logger.warning(f"Error generating code with interpretation scaffold, generating code only: {str(e)}")
+                code = self.code_generator.generate_code(
+                    analysis,
+                    self.data_handler.data_dict,
+                    self.analysis_plan,
+                    self.data_handler.data_dict_content
+                )
+            logger.info(f"Code generation took {time.time() - start_time:.2f} seconds")
 
         # Execute code with error handling and refinement
         max_attempts = 3
+        # (code, error) pairs already seen; a refinement that reproduces one will not be fixed by refining again
+        failed_attempts = set()
         for attempt in range(max_attempts):
             try:
-                logging.info(f"Executing code (attempt {attempt+1}/{max_attempts})...")
+                logger.info(f"Executing code (attempt {attempt+1}/{max_attempts})...")
                 start_time = time.time()
-                result, output, figure_paths = self.code_executor.execute_code(
-                    code,
-                    self.data_handler.production_data_sample
-                )
-                logging.info(f"Code execution took {time.time() - start_time:.2f} seconds")
+                with self._execution_lock:
+                    result, output, figure_paths = self.code_executor.execute_code(
+                        code,
+                        self.data_handler.production_data_sample
+                    )
+                logger.info(f"Code execution took {time.time() - start_time:.2f} seconds")
 
                 # Additional verification of generated plots
                 for path in figure_paths:
                     assert Path(path).is_file(), f"Expected plot file not created: {path}"
+                error = self._execution_error(result, output)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                error = str(e)
+
+            if error is None:
                 # Update status to completed
                 analysis['status'] = 'completed'
-                logging.info(f"Updated status for {analysis['name']} to completed.")
+                logger.info(f"Updated status for {analysis['name']} to completed.")
                 break
-            except Exception as e:
-                logging.error(f"Error during code execution (attempt {attempt + 1}/{max_attempts}): {str(e)}")
-                logging.error(traceback.format_exc())
-                if attempt < max_attempts - 1:
-                    logging.info("Attempting to refine the code...")
-                    code = self.code_generator.refine_code(
-                        code,
-                        error_message=str(e),
-                        data_dict=self.data_handler.data_dict,
-                        analysis_plan=self.analysis_plan,
-                        data_dict_content=self.data_handler.data_dict_content
-                    )
+
+            logger.error(f"Error during code execution (attempt {attempt + 1}/{max_attempts}): {error}")
+            # The scaffold no longer describes the code once it is refined
+            interpretation_stub = None
+            failure = (code, error)
+            repeated_failure = failure in failed_attempts
+            failed_attempts.add(failure)
+            if attempt < max_attempts - 1 and not repeated_failure:
+                logger.info("Attempting to refine the code...")
+                code = self.code_generator.refine_code(
+                    code,
+                    error_message=error,
+                    data_dict=self.data_handler.data_dict,
+                    analysis_plan=self.analysis_plan,
+                    data_dict_content=self.data_handler.data_dict_content
+                )
+            else:
+                if repeated_failure:
+                    logger.error("Refined code failed again with the same error. Moving to next analysis step.")
                 else:
-                    logging.error("Max attempts reached. Moving to next analysis step.")
-                    result, output, figure_paths = None, f"Execution failed: {str(e)}", []
+                    logger.error("Max attempts reached. Moving to next analysis step.")
+                result, output, figure_paths = None, f"Execution failed: {error}", []
+                break
 
         # Interpret results
-        logging.info("Interpreting results...")
-        start_time = time.time()
-        interpretation = self.result_interpreter.interpret_results(
-            analysis,
-            result,
-            output,
-            figure_paths,
-            self.completed_analyses,
-            self.key_findings
-        )
-        logging.info(f"Result interpretation took {time.time() - start_time:.2f} seconds")
+        if interpretation_stub:
+            logger.info("Filling in interpretation scaffold...")
+            # Only reached after a successful run; values are cut to the length interpret_all sends
+            interpretation = (interpretation_stub
+                              .replace('{result}', str(result)[:config.MAX_INTERPRETED_RESULT_CHARS])
+                              .replace('{output}', str(output)[:config.MAX_INTERPRETED_OUTPUT_CHARS]))
+            key_findings = self.result_interpreter.extract_key_findings(interpretation)
+        else:
+            logger.info("Interpreting results...")
+            start_time = time.time()
+            # One API call returns both the interpretation and its key findings
+            interpretation, key_findings = self.result_interpreter.interpret_all(
+                analysis,
+                result,
+                output,
+                figure_paths,
+                self.completed_analyses,
+                self.key_findings
+            )
+            logger.info(f"Result interpretation took {time.time() - start_time:.2f} seconds")
 
         # Store results
         analysis['result'] = result
@@ -185,8 +380,39 @@ class AutomatedDataScientist:
         analysis['figure_paths'] = figure_paths
         analysis['interpretation'] = interpretation
 
-        self.completed_analyses.append(analysis)
-        self.key_findings.extend(self.result_interpreter.extract_key_findings(interpretation))
+        return code, key_findings
+
+    @staticmethod
+    def _execution_error(result: Any, output: str) -> Optional[str]:
+        """
+        Return the error the analysis code ran into, or None if it ran successfully.
+
+        CodeExecutor.execute_code does not raise when the code fails; it reports
+        the error and its traceback at the end of the captured output instead.
+        Code that runs without storing its result in 'result' has failed as well.
+        """
+        marker = output.rfind(EXECUTION_ERROR_MARKER)
+        if marker != -1:
+            return output[marker:]
+        if result is None:
+            return "The code ran without storing its main result in a variable named 'result'."
+        return None
+
+    def _record_analysis(self, analysis: Dict[str, Any], code: str, key_findings: List[str]):
+        record_path = self._save_analysis_record(len(self.completed_analyses), analysis, code)
+        # Raw results and output can be large; only the record on disk keeps them
+        analysis.pop('result', None)
+        analysis.pop('output', None)
+        analysis['record_path'] = str(record_path)
+
+        self.completed_analyses.append({
+            'name': analysis['name'],
+            'description': analysis.get('description', ''),
+            'interpretation': analysis.get('interpretation', ''),
+            'figure_paths': analysis.get('figure_paths', []),
+            'record_path': str(record_path)
+        })
+        self.key_findings.extend(key_findings)
 
         # Add analysis step to notebook
         self.notebook_manager.add_analysis_step(
@@ -196,11 +422,31 @@ class AutomatedDataScientist:
             code
         )
 
-        self.analysis_planner.save_plan_to_file(self.analysis_plan)  # Save updated status
-
+    def _save_analysis_record(self, step_id: int, analysis: Dict[str, Any], code: str) -> Path:
+        """
+        Write the full record of a completed analysis, including its raw result and output, to disk.
+
+        Args:
+        step_id (int): The position of the analysis among the completed analyses.
+        analysis (Dict[str, Any]): The completed analysis.
+        code (str): The code that produced its result.
+
+        Returns:
+        Path: The path of the written record.
+        """
+        steps_path = self.output_path / 'steps'
+        steps_path.mkdir(parents=True, exist_ok=True)
+        record_path = steps_path / f"{step_id}.json"
+        record = orjson.dumps({**analysis, 'code': code}, default=str,
+                              option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        with open(record_path, 'wb') as f:
+            f.write(record)
+        return record_path
+
+    def _update_plan(self):
         # Update analysis plan
         try:
-            logging.info("Updating analysis plan...")
+            logger.info("Updating analysis plan...")
             start_time = time.time()
             self.analysis_plan = self.analysis_planner.update_plan(
                 self.analysis_plan,
@@ -208,21 +454,22 @@ class AutomatedDataScientist:
                 self.key_findings,
                 self.data_handler.data_dict,
                 self.data_handler.production_data_sample,
-                self.data_handler.production_data_sample.shape[0]
+                self._count_csv_rows()
             )
-            logging.info(f"Analysis plan update took {time.time() - start_time:.2f} seconds")
+            logger.info(f"Analysis plan update took {time.time() - start_time:.2f} seconds")
         except Exception as e:
-            logging.error(f"Error updating analysis plan: {str(e)}")
-            logging.error(traceback.format_exc())
-            logging.info("Continuing with the current plan...")
+            logger.error(f"Error updating analysis plan: {str(e)}")
+            logger.error(traceback.format_exc())
+            logger.info("Continuing with the current plan...")
 
     def generate_final_report(self):
-        report = self.result_interpreter.generate_summary_report(self.completed_analyses, self.key_findings)
         file_extension = 'md' if config.OUTPUT_FORMAT.lower() == 'markdown' else 'html'
         report_path = self.output_path / f"final_report.{file_extension}"
+        # Write the report as it is generated instead of waiting for the whole response
         with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(report)
-        logging.info(f"Final report generated and saved to {report_path}")
+            for chunk in self.result_interpreter.stream_summary_report(self.completed_analyses, self.key_findings):
+                f.write(chunk)
+        logger.info(f"Final report generated and saved to {report_path}")
 
     # Removed save_progress and load_progress methods
 
@@ -243,5 +490,5 @@ if __name__ == "__main__":
         ads = AutomatedDataScientist()
         ads.run()
     except Exception as e:
-        logging.critical(f"Critical error in main execution: {str(e)}")
-        logging.critical(traceback.format_exc())
+        logger.critical(f"Critical error in main execution: {str(e)}")
+        logger.critical(traceback.format_exc())
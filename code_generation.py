@@ -1,33 +1,18 @@
 import logging
-from typing import Dict, Any, List
-from api_client import APIClient
+from typing import Dict, Any, List, Tuple
+from api_client import APIClient, DEFAULT_SYSTEM_PROMPT
 import config
-from config import ALLOWED_LIBRARIES
-import ast
-import traceback
+from config import ALLOWED_LIBRARIES_STR
+import re
+import textwrap
 
-class CodeGenerator:
-    def __init__(self, api_client: APIClient):
-        self.api_client = api_client
-
-    def generate_code(self, analysis: Dict[str, Any], data_dict: Dict[str, Any], analysis_plan: List[Dict[str, Any]], data_dict_content: str) -> str:
-        logging.info(f"Generating code for analysis: {analysis['name']}")
-
-        prompt = f"""
-        Generate Python code for the following analysis:
-
-        Current Analysis Step:
-        {analysis}
-
-        Complete Analysis Plan:
-        {analysis_plan}
+logger = logging.getLogger(__name__)
 
-        Data Dictionary:
-        {data_dict}
-
-        Full Data Dictionary Content:
-        {data_dict_content}
+# Static prompt text is built and dedented once at import, so each call only fills in the
+# dynamic parts and every request carries a byte-identical prefix
 
+# Guidelines closing every code generation system prompt
+_CODE_GUIDELINES = textwrap.dedent(f"""
         Please follow these guidelines:
         1. The main DataFrame should be loaded from '{config.PRODUCTION_CSV_PATH}' and named 'df'
         2. Use pandas, numpy, and matplotlib for data manipulation and visualization
@@ -42,40 +27,277 @@ class CodeGenerator:
            df = pd.read_csv(config.PRODUCTION_CSV_PATH)
         10. Consider the complete analysis plan when generating code for this step
         11. You may only use the following libraries in your code:
-            {', '.join(ALLOWED_LIBRARIES)}
+            {ALLOWED_LIBRARIES_STR}
         12. Ensure plots are well-labeled, including titles, axis labels, and legends where appropriate.
         13. Test for data readiness before plotting and consider showing plots inline if necessary for review.
+        14. When fitting scikit-learn estimators that support it (e.g. RandomForestClassifier), pass n_jobs=-1 so training uses all CPU cores, and avoid oob_score=True.
+        """)
 
-        Return only the well formed Python code, without any explanations or markdown formatting.
-        """
+# Opening of every code generation system prompt; filled with the data dictionary once per run
+_CODE_CONTEXT_TEMPLATE = textwrap.dedent("""
+        You write Python code for data analyses.
+
+        Data Dictionary:
+        {data_dict}
+
+        Full Data Dictionary Content:
+        {data_dict_content}
+        """)
+
+# Per-analysis code generation request
+_CODE_PROMPT_TEMPLATE = textwrap.dedent("""
+        Complete Analysis Plan:
+        {analysis_plan}
+
+        Generate Python code for the following analysis:
+
+        Current Analysis Step:
+        {analysis}
+
+        {response_instructions}
+        """)
+
+_CODE_ONLY_INSTRUCTIONS = "Return only the well formed Python code, without any explanations or markdown formatting."
+
+# Keys of a code and interpretation scaffold response, for single and packed requests alike
+_SCAFFOLD_KEYS = textwrap.dedent("""\
+        - "code": the well formed Python code, without any explanations or markdown formatting
+        - "interpretation_stub": a short interpretation of what the code's result will show, using the
+          placeholders {result} and {output} where the value of 'result' and the printed output belong
+        """)
+
+_SCAFFOLD_INSTRUCTIONS = "Respond with a JSON object with two keys:\n" + _SCAFFOLD_KEYS
+
+# Closing reminder of refine_code prompts
+_REFINE_LIBRARIES_REMINDER = textwrap.dedent(f"""
+        Remember to only use the following libraries in your code:
+        {ALLOWED_LIBRARIES_STR}
+        """)
+
+# Sections of refine_code prompts, in the order they appear
+_REFINE_DATA_DICT_TEMPLATE = textwrap.dedent("""
+        Data Dictionary:
+        {data_dict}
+        """)
+_REFINE_DATA_DICT_CONTENT_TEMPLATE = textwrap.dedent("""
+        Full Data Dictionary Content:
+        {data_dict_content}
+        """)
+_REFINE_PLAN_TEMPLATE = textwrap.dedent("""
+        Complete Analysis Plan:
+        {analysis_plan}
+        """)
+_REFINE_CODE_TEMPLATE = textwrap.dedent("""
+        Please refine the following Python code:
+
+        {code}
+
+        """)
+_REFINE_ERROR_TEMPLATE = textwrap.dedent("""
+        The code produced the following error:
+        {error_message}
+
+        Please fix the error and improve the code.
+        """)
+_REFINE_REQUIREMENTS_TEMPLATE = textwrap.dedent("""
+        Please also incorporate the following requirements:
+        {additional_requirements}
+        """)
+
+# Python code block markers, written with backticks or apostrophes, and stray backticks
+_CODE_MARKUP_RE = re.compile(r"```python|```|'''python|'''|`")
+
+# Calls that generated code must not make; whole words only, so e.g. "evaluate" is allowed
+_FORBIDDEN_RE = re.compile(r"\b(?:eval|exec|os\.system|subprocess\.run|__import__)\b")
+
+def _replace_code_markup(match: re.Match) -> str:
+    # Backticks become apostrophes; code block markers are dropped
+    return "'" if match.group(0) == '`' else ""
+
+class CodeGenerator:
+    def __init__(self, api_client: APIClient):
+        self.api_client = api_client
+        self._code_context_cache = None
+
+    def generate_code(self, analysis: Dict[str, Any], data_dict: Dict[str, Any], analysis_plan: List[Dict[str, Any]], data_dict_content: str) -> str:
+        logger.info(f"Generating code for analysis: {analysis['name']}")
+
+        prompt = self._build_code_prompt(analysis, analysis_plan)
+        system_prompt = self._build_code_context(data_dict, data_dict_content)
 
         try:
-            code = self.api_client.call_api(prompt)
-            logging.info(f"Code generated for analysis: {analysis['name']}")
+            code = self.api_client.call_api(prompt, system_prompt=system_prompt)
+            logger.info(f"Code generated for analysis: {analysis['name']}")
             
             # Sanitize and prepare code
             sanitized_code = self.sanitize_code(code)
             parameterized_code = self.parameterize_code(sanitized_code)
             
             return parameterized_code
-        except Exception as e:
-            logging.error(f"Error generating code for analysis {analysis['name']}: {str(e)}")
-            logging.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error generating code for analysis %s", analysis['name'])
             raise
 
+    def generate_code_and_interpretation_scaffold(self, analysis: Dict[str, Any], data_dict: Dict[str, Any], analysis_plan: List[Dict[str, Any]], data_dict_content: str) -> Tuple[str, str]:
+        """
+        Generate the code for an analysis together with a template for interpreting its result.
+
+        Both come from a single JSON mode API call. The template may contain the
+        placeholders {result} and {output}, to be filled in once the code has run.
+
+        Args:
+        analysis (Dict[str, Any]): The analysis step to generate code for.
+        data_dict (Dict[str, Any]): The data dictionary.
+        analysis_plan (List[Dict[str, Any]]): The complete analysis plan.
+        data_dict_content (str): The full data dictionary content.
+
+        Returns:
+        Tuple[str, str]: The generated code and the interpretation template,
+        which is empty if the response did not include one.
+
+        Raises:
+        ValueError: If the response does not contain any code.
+        """
+        logger.info(f"Generating code and interpretation scaffold for analysis: {analysis['name']}")
+
+        prompt = self._build_code_prompt(analysis, analysis_plan, response_instructions=_SCAFFOLD_INSTRUCTIONS)
+        system_prompt = self._build_code_context(data_dict, data_dict_content)
+
+        response = self.api_client.parse_json_response(
+            self.api_client.call_api(prompt, use_json_mode=True, system_prompt=system_prompt)
+        )
+        scaffold = self._prepare_scaffold(analysis, response)
+
+        logger.info(f"Code and interpretation scaffold generated for analysis: {analysis['name']}")
+        return scaffold
+
+    def _prepare_scaffold(self, analysis: Dict[str, Any], response: Any) -> Tuple[str, str]:
+        """
+        Sanitize the code of a parsed scaffold response and return it with its interpretation template.
+
+        Raises:
+        ValueError: If the response does not contain any code.
+        """
+        code = response.get('code') if isinstance(response, dict) else None
+        if not isinstance(code, str) or not code.strip():
+            raise ValueError(f"No code in scaffold response for analysis {analysis['name']}")
+        interpretation_stub = response.get('interpretation_stub')
+        return self.parameterize_code(self.sanitize_code(code)), interpretation_stub if isinstance(interpretation_stub, str) else ""
+
+    def generate_code_batch(self, analyses: List[Dict[str, Any]], data_dict: Dict[str, Any], analysis_plan: List[Dict[str, Any]], data_dict_content: str) -> List[Any]:
+        """
+        Generate code and interpretation scaffolds for several analyses with as few API round-trips as possible.
+
+        The analyses are first packed into shared requests, so the plan and
+        data dictionary are sent once per request instead of once per analysis.
+        Analyses missing from the packed responses are retried with one
+        concurrent API call each.
+
+        Args:
+        analyses (List[Dict[str, Any]]): The analysis steps to generate code for.
+        data_dict (Dict[str, Any]): The data dictionary.
+        analysis_plan (List[Dict[str, Any]]): The complete analysis plan.
+        data_dict_content (str): The full data dictionary content.
+
+        Returns:
+        List[Any]: The generated code and interpretation template of each analysis, in order,
+        as returned by generate_code_and_interpretation_scaffold. An analysis
+        whose generation failed has the raised exception in its position instead.
+        """
+        logger.info(f"Generating code for {len(analyses)} analyses in batches")
+        system_prompt = self._build_code_context(data_dict, data_dict_content)
+        instruction = f"""{system_prompt}
+        Complete Analysis Plan:
+        {analysis_plan}
+
+        Generate Python code for each of the analysis steps given as items.
+        Each output must be a JSON object with two keys:
+        {_SCAFFOLD_KEYS}
+        """
+        responses = self.api_client.call_api_packed([str(analysis) for analysis in analyses], instruction,
+                                                    structured_output=True)
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            logger.info(f"Generating code for {len(missing)} analyses missing from the batched responses individually")
+            prompts = [self._build_code_prompt(analyses[i], analysis_plan, response_instructions=_SCAFFOLD_INSTRUCTIONS)
+                       for i in missing]
+            for i, response in zip(missing, self.api_client.call_api_batch(prompts, use_json_mode=True, system_prompt=system_prompt)):
+                responses[i] = response
+
+        results = []
+        for analysis, response in zip(analyses, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Error generating code for analysis {analysis['name']}: {str(response)}")
+                results.append(response)
+                continue
+            try:
+                if isinstance(response, str):
+                    response = self.api_client.parse_json_response(response)
+                results.append(self._prepare_scaffold(analysis, response))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def generate_code_offline(self, analyses: List[Dict[str, Any]], data_dict: Dict[str, Any], analysis_plan: List[Dict[str, Any]], data_dict_content: str) -> List[Any]:
+        """
+        Generate code for several analyses through the discounted Batch API.
+
+        Args:
+        analyses (List[Dict[str, Any]]): The analysis steps to generate code for.
+        data_dict (Dict[str, Any]): The data dictionary.
+        analysis_plan (List[Dict[str, Any]]): The complete analysis plan.
+        data_dict_content (str): The full data dictionary content.
+
+        Returns:
+        List[Any]: The generated code for each analysis, in order; None for
+        analyses whose request failed, or the raised exception if its code
+        could not be sanitized.
+        """
+        logger.info(f"Generating code for {len(analyses)} analyses with the Batch API")
+        prompts = [self._build_code_prompt(analysis, analysis_plan) for analysis in analyses]
+        system_prompt = self._build_code_context(data_dict, data_dict_content)
+        results = []
+        for response in self.api_client.call_api_offline(prompts, system_prompt=system_prompt):
+            if response is None:
+                results.append(None)
+                continue
+            try:
+                results.append(self.parameterize_code(self.sanitize_code(response)))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _build_code_prompt(self, analysis: Dict[str, Any], analysis_plan: List[Dict[str, Any]],
+                           response_instructions: str = _CODE_ONLY_INSTRUCTIONS) -> str:
+        return _CODE_PROMPT_TEMPLATE.format(analysis_plan=analysis_plan, analysis=analysis,
+                                            response_instructions=response_instructions)
+
+    def _build_code_context(self, data_dict: Dict[str, Any], data_dict_content: str) -> str:
+        """
+        Build the system prompt shared by all code generation requests.
+
+        It holds only context that stays the same for the whole run, so that
+        every request starts with an identical prefix. The prompt is built once
+        per data dictionary and reused.
+        """
+        cached = self._code_context_cache
+        if cached is None or cached[0] is not data_dict or cached[1] is not data_dict_content:
+            context = _CODE_CONTEXT_TEMPLATE.format(data_dict=data_dict, data_dict_content=data_dict_content) + _CODE_GUIDELINES
+            # The inputs are kept alongside the prompt so an identity match cannot be a recycled object
+            cached = self._code_context_cache = (data_dict, data_dict_content, context)
+        return cached[2]
+
     def sanitize_code(self, code: str) -> str:
         try:
-            # Handle characters that might be formatted wrongly
-            sanitized_code = code.replace('`', "'")
-            # Remove Python code block markers
-            sanitized_code = sanitized_code.replace("'''python", "").replace("'''", "")
+            # Remove Python code block markers and handle characters that might be formatted wrongly, in one pass
+            sanitized_code = _CODE_MARKUP_RE.sub(_replace_code_markup, code)
             
-            # Parse the code and fix any indentation issues
+            # Check the code compiles; its formatting and comments are kept as generated
             try:
-                tree = ast.parse(sanitized_code)
-                sanitized_code = ast.unparse(tree)
+                compile(sanitized_code, "<generated>", "exec", dont_inherit=True)
             except IndentationError as ie:
-                logging.error("Indentation error detected: attempting automatic correction.")
+                logger.error("Indentation error detected: attempting automatic correction.")
                 # Implement correction logic if needed
                 raise ie
             
@@ -83,18 +305,16 @@ class CodeGenerator:
             if not sanitized_code.endswith('\n'):
                 sanitized_code += '\n'
             return sanitized_code
-        except Exception as e:
-            logging.error(f"Error sanitizing code: {str(e)}")
-            logging.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error sanitizing code")
             raise
 
     def parameterize_code(self, code: str) -> str:
         try:
             parameterized_code = code.replace('data.plot(', 'plot_data(data, plot_type=plot_type, ')
             return parameterized_code
-        except Exception as e:
-            logging.error(f"Error parameterizing code: {str(e)}")
-            logging.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error parameterizing code")
             raise
 
     def generate_code_structure(self, analysis: Dict[str, Any]) -> str:
@@ -117,75 +337,62 @@ class CodeGenerator:
         try:
             structure = self.api_client.call_api(prompt)
             return structure
-        except Exception as e:
-            logging.error(f"Error generating code structure for analysis {analysis['name']}: {str(e)}")
-            logging.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error generating code structure for analysis %s", analysis['name'])
             raise
 
     def refine_code(self, code: str, error_message: str = None, data_dict: Dict[str, Any] = None, analysis_plan: List[Dict[str, Any]] = None, data_dict_content: str = None, additional_requirements: str = None) -> str:
-        prompt = f"""
-        Please refine the following Python code:
-
-        {code}
-
         """
+        Ask the API for an improved version of code, typically after it failed to run.
 
-        if error_message:
-            prompt += f"""
-            The code produced the following error:
-            {error_message}
+        Given both data_dict and data_dict_content, the request uses the same
+        system prompt as generate_code, so the provider's prompt cache covers
+        the static context. The parts that change between calls (plan, code,
+        error) come last.
+        """
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+        parts = []
+        if data_dict and data_dict_content:
+            system_prompt = self._build_code_context(data_dict, data_dict_content)
+        else:
+            if data_dict:
+                parts.append(_REFINE_DATA_DICT_TEMPLATE.format(data_dict=data_dict))
 
-            Please fix the error and improve the code.
-            """
+            if data_dict_content:
+                parts.append(_REFINE_DATA_DICT_CONTENT_TEMPLATE.format(data_dict_content=data_dict_content))
 
-        if data_dict:
-            prompt += f"""
-            Data Dictionary:
-            {data_dict}
-            """
+            parts.append(_REFINE_LIBRARIES_REMINDER)
 
         if analysis_plan:
-            prompt += f"""
-            Complete Analysis Plan:
-            {analysis_plan}
-            """
+            parts.append(_REFINE_PLAN_TEMPLATE.format(analysis_plan=analysis_plan))
+
+        parts.append(_REFINE_CODE_TEMPLATE.format(code=code))
 
-        if data_dict_content:
-            prompt += f"""
-            Full Data Dictionary Content:
-            {data_dict_content}
-            """
+        if error_message:
+            parts.append(_REFINE_ERROR_TEMPLATE.format(error_message=error_message))
 
         if additional_requirements:
-            prompt += f"""
-            Please also incorporate the following requirements:
-            {additional_requirements}
-            """
+            parts.append(_REFINE_REQUIREMENTS_TEMPLATE.format(additional_requirements=additional_requirements))
 
-        prompt += f"""
-        Remember to only use the following libraries in your code:
-        {', '.join(ALLOWED_LIBRARIES)}
-        """
+        prompt = "".join(parts)
 
         try:
-            refined_code = self.api_client.call_api(prompt)
+            refined_code = self.api_client.call_api(prompt, system_prompt=system_prompt)
             sanitized_code = self.sanitize_code(refined_code)
             parameterized_code = self.parameterize_code(sanitized_code)
             return parameterized_code
-        except Exception as e:
-            logging.error(f"Error refining code: {str(e)}")
-            logging.error(traceback.format_exc())
+        except Exception:
+            logger.exception("Error refining code")
             raise
 
     def validate_code(self, code: str) -> bool:
         """
         Validate the generated code for potential security issues.
         """
-        forbidden_functions = ['eval', 'exec', 'os.system', 'subprocess.run', '__import__']
-        for func in forbidden_functions:
-            if func in code:
-                logging.warning(f"Potential security risk: {func} found in generated code")
-                return False
+        match = _FORBIDDEN_RE.search(code)
+        if match:
+            logger.warning(f"Potential security risk: {match.group(0)} found in generated code")
+            return False
         return True
 
 if __name__ == "__main__":
@@ -222,6 +429,5 @@ if __name__ == "__main__":
             refined_code = code_gen.refine_code(generated_code, additional_requirements="Remove any potentially unsafe functions.")
             print("Refined Code:")
             print(refined_code)
-    except Exception as e:
-        logging.error(f"Error in code generation test: {str(e)}")
-        logging.error(traceback.format_exc())
+    except Exception:
+        logging.exception("Error in code generation test")
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 # Base Directory
 BASE_DIR = Path(__file__).resolve().parent
@@ -9,16 +9,37 @@ BASE_DIR = Path(__file__).resolve().parent
 MAX_SAMPLE_ROWS = 20000  # Maximum number of rows to load from the production CSV for analysis
 DATA_ENCODING = 'utf-8'  # Encoding to use when reading CSV files
 MISSING_VALUE_THRESHOLD = 0.2  # Maximum proportion of missing values allowed in a column
+MAX_SUMMARY_CATEGORIES = 50  # Most frequent values reported per categorical column in the data summary
 
 # API Configuration
 DEFAULT_API_TYPE = 'openai'  # Default API to use ('openai' or 'anthropic')
 MAX_API_RETRIES = 3  # Maximum number of times to retry a failed API call
 API_RETRY_DELAY = 1  # Delay (in seconds) between API call retries
 MAX_TOKENS = 4000  # Maximum number of tokens for API requests
+MAX_API_CONCURRENCY = 4  # Maximum number of API requests in flight during a batched call
+API_REQUESTS_PER_MINUTE = 500  # Maximum number of API requests an API client starts per minute
+MAX_BATCH_ITEMS = 8  # Maximum number of prompts packed into a single structured API request
+BATCH_COMPLETION_WINDOW = '24h'  # Completion window requested from the OpenAI Batch API
+BATCH_POLL_INTERVAL = 30  # Initial delay (in seconds) between Batch API status checks
+BATCH_MAX_POLL_INTERVAL = 300  # Maximum delay (in seconds) between Batch API status checks
+HTTP_MAX_CONNECTIONS = 64  # Maximum number of pooled HTTP connections per API client
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32  # Maximum number of idle connections kept alive for reuse
+HTTP_KEEPALIVE_EXPIRY = 300  # Seconds an idle connection is kept open; long enough to outlast code execution between calls
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_DISABLE', '').lower() not in ('1', 'true', 'yes')  # Reuse stored responses for identical prompts instead of calling the API again (set LLM_CACHE_DISABLE=1 to turn off)
+LLM_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds before a cached response expires (None to keep responses forever)
+LLM_SEMANTIC_CACHE_ENABLED = False  # Also reuse responses to near-duplicate prompts, matched by embedding similarity (OpenAI only)
+LLM_SEMANTIC_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity between prompts for a semantic cache hit
+LLM_SEMANTIC_CACHE_EMBEDDING_MODEL = 'text-embedding-3-small'  # Model used to embed prompts for the semantic cache
 
 # Analysis Configuration
 MAX_ANALYSES = 3  # Maximum number of analyses to perform in a single run
+PLAN_SUMMARY_MAX_TOKENS = 1024  # Token budget of the plan, analysis and findings summary sent in plan update prompts
+MAX_PARALLEL_ANALYSES = 3  # Maximum number of analyses whose pipelines run concurrently
 MIN_CONFIDENCE_THRESHOLD = 0.7  # Minimum confidence level required for an insight to be included 
+MAX_INTERPRETED_FIGURES = 4  # Maximum number of figures sent together in one image interpretation request
+MAX_INTERPRETED_IMAGE_SIZE = 1024  # Longest side (in pixels) of a figure sent for image interpretation; larger figures are downscaled
+MAX_INTERPRETED_RESULT_CHARS = 2000  # Characters of an analysis's result value included in its interpretation
+MAX_INTERPRETED_OUTPUT_CHARS = 4000  # Characters of an analysis's printed output included in its interpretation
 
 # Code Execution Configuration
 CODE_EXECUTION_TIMEOUT = 300  # Maximum time (in seconds) allowed for a single code execution 
@@ -33,11 +54,8 @@ MAX_REPORT_LENGTH = 100000  # Maximum length (in words) for the final report
 DEFAULT_OUTPUT_DIR = BASE_DIR / 'output' 
 DEFAULT_FIGURE_DIR = DEFAULT_OUTPUT_DIR / 'figures' 
 LOGS_DIR = BASE_DIR / 'logs' 
-
-# Ensure output directories exist
-DEFAULT_OUTPUT_DIR.mkdir(parents=True, exist_ok=True) 
-DEFAULT_FIGURE_DIR.mkdir(parents=True, exist_ok=True) 
-LOGS_DIR.mkdir(parents=True, exist_ok=True) 
+LLM_CACHE_PATH = DEFAULT_OUTPUT_DIR / 'llm_cache.sqlite'  # SQLite file backing the LLM response cache
+LLM_SEMANTIC_CACHE_PATH = DEFAULT_OUTPUT_DIR / 'llm_semantic_cache.npz'  # File backing the semantic LLM response cache
 
 # Environment variable names
 ENV_OPENAI_API_KEY = 'OPENAI_API_KEY' 
@@ -59,13 +77,25 @@ def get_env_variable(var_name: str, default: str = None) -> str:
         )
     return value
 
-# API Keys (to be set in environment variables)
-OPENAI_API_KEY = get_env_variable(ENV_OPENAI_API_KEY) 
-ANTHROPIC_API_KEY = get_env_variable(ENV_ANTHROPIC_API_KEY) 
+# Settings read from environment variables on first access rather than at import, so importing
+# config has no side effects and a missing API key only fails the code path that needs it
+_ENV_SETTINGS = {
+    # API Keys (to be set in environment variables)
+    'OPENAI_API_KEY': lambda: get_env_variable(ENV_OPENAI_API_KEY),
+    'ANTHROPIC_API_KEY': lambda: get_env_variable(ENV_ANTHROPIC_API_KEY),
+    # File Paths (can be overridden by environment variables)
+    'PRODUCTION_CSV_PATH': lambda: Path(get_env_variable(ENV_PRODUCTION_CSV_PATH, str(BASE_DIR / 'data' / 'production_data.csv'))),
+    'DATA_DICT_PATH': lambda: Path(get_env_variable(ENV_DATA_DICT_PATH, str(BASE_DIR / 'data' / 'data_dictionary.md'))),
+}
+
+def __getattr__(name: str) -> Any:
+    """Resolve an environment-backed setting on first access and cache it as a module attribute."""
+    if name not in _ENV_SETTINGS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = _ENV_SETTINGS[name]()
+    globals()[name] = value
+    return value
 
-# File Paths (can be overridden by environment variables)
-PRODUCTION_CSV_PATH = Path(get_env_variable(ENV_PRODUCTION_CSV_PATH, str(BASE_DIR / 'data' / 'production_data.csv'))) 
-DATA_DICT_PATH = Path(get_env_variable(ENV_DATA_DICT_PATH, str(BASE_DIR / 'data' / 'data_dictionary.md'))) 
 NOTEBOOK_PATH = DEFAULT_OUTPUT_DIR / 'analysis_notebook.ipynb' 
 
 # Logging Configuration
@@ -91,6 +121,7 @@ LOGGING_CONFIG = {
             'filename': str(LOGS_DIR / 'automated_data_scientist.log'),
             'maxBytes': 10485760,  # 10MB
             'backupCount': 5,
+            'delay': True,  # Open the log file on first record, after main.setup_directories has created LOGS_DIR
         },
     },
     'loggers': {
@@ -103,14 +134,15 @@ LOGGING_CONFIG = {
 } 
 
 # List of allowed libraries for dynamic import in code execution
-ALLOWED_LIBRARIES: List[str] = [
+ALLOWED_LIBRARIES: Tuple[str, ...] = (
     'pandas', 'numpy', 'matplotlib', 'seaborn', 'scipy', 'sklearn', 'statsmodels',
     'plotly', 'altair', 'bokeh', 'dask', 'pyjanitor', 'xgboost', 'lightgbm',
     'catboost', 'tensorflow', 'keras', 'pytorch', 'holoviews', 'geopandas',
     'folium', 'dash', 'nltk', 'spacy', 'transformers', 'pyarrow', 'openpyxl',
     'xlrd', 'pydantic', 'great_expectations', 'tsfresh', 'prophet', 'networkx',
     'cvxpy', 'sympy', 'joblib', 'numba', 'h5py', 'zarr'
-] 
+)
+ALLOWED_LIBRARIES_STR = ", ".join(ALLOWED_LIBRARIES)  # Joined once for embedding in prompts
 
 # Visualization settings
 VISUALIZATION_SETTINGS: Dict[str, Any] = {
@@ -141,7 +173,8 @@ def get_config() -> Dict[str, Any]:
     Returns a dictionary containing all configuration settings.
     This can be useful for passing configuration to other parts of the application.
     """
-    return {key: value for key, value in globals().items() if not key.startswith('__') and key.isupper()} 
+    env_settings = {name: globals()[name] if name in globals() else __getattr__(name) for name in _ENV_SETTINGS}
+    return {**{key: value for key, value in globals().items() if not key.startswith('_') and key.isupper()}, **env_settings} 
 
 if __name__ == "__main__":
     import json
@@ -1,19 +1,98 @@
 import logging
-import json
 from pathlib import Path
 import pandas as pd
 import numpy as np
+import orjson
 import re
-from typing import Dict, Any, Optional
+import sys
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional, Tuple
 import traceback
+import warnings
+import config
+
+# Any run of whitespace, newlines included, collapses to a single space
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def _describe_numeric(df: pd.DataFrame) -> Dict[str, Dict[str, float]]:
+    """
+    Compute the same statistics as df.describe().to_dict() for the numeric columns of df,
+    in a few vectorized passes over a single 2-D array instead of one pass per column and statistic.
+    """
+    numeric = df.select_dtypes(include=np.number)
+    values = numeric.to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        # All-NaN and single-value columns produce NaN statistics, as describe() does
+        warnings.simplefilter('ignore', RuntimeWarning)
+        count = (~np.isnan(values)).sum(axis=0)
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0, ddof=1)
+        quantiles = np.nanpercentile(values, [0, 25, 50, 75, 100], axis=0)
+    stats = np.vstack([count, mean, std, quantiles])
+    labels = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+    return {
+        column: dict(zip(labels, stats[:, i].tolist()))
+        for i, column in enumerate(numeric.columns)
+    }
+
+@lru_cache(maxsize=8)
+def _load_data_dict(path: str, mtime_ns: int) -> Tuple[str, Dict[str, Dict[str, str]]]:
+    """
+    Read and parse a Markdown data dictionary, memoized on the file's path and modification time.
+
+    The content is interned so every prompt built from it embeds the identical string,
+    keeping prompt prefixes byte-stable across runs in the same process.
+
+    Args:
+    path (str): Path to the data dictionary file.
+    mtime_ns (int): The file's modification time, so an edited file is read again.
+
+    Returns:
+    Tuple[str, Dict[str, Dict[str, str]]]: The raw content and the parsed column entries.
+    """
+    with open(path, 'r') as file:
+        content = sys.intern(file.read())
+
+    # Parse the Markdown table content one line at a time
+    data_dict = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line.startswith('|'):
+            continue
+        parts = [part.strip() for part in line.split('|')[1:-1]]
+        if len(parts) < 3:
+            continue
+        column_name, data_type, description = parts[:3]
+        if column_name == "Column Name" or column_name.startswith(('-', ':')):  # Skip header and separator rows
+            continue
+        data_dict[column_name] = {
+            "Type": data_type,
+            "Description": description
+        }
+    return content, data_dict
+
+# Conversions applied to columns whose data dictionary type is the key
+_TYPE_CONVERTERS = {
+    'int64': lambda frame: frame.apply(pd.to_numeric, errors='coerce').astype('Int64'),
+    'float64': lambda frame: frame.apply(pd.to_numeric, errors='coerce'),
+    'object': lambda frame: frame.astype('object'),
+}
 
 class DataHandler:
+    __slots__ = ('data_dict_path', 'production_csv_path', 'data_dict', 'data_dict_content',
+                 'production_data_sample', '_expected_types', '_summary_cache', 'logger')
+
     def __init__(self, data_dict_path: Path, production_csv_path: Path):
         self.data_dict_path = data_dict_path
         self.production_csv_path = production_csv_path
         self.data_dict: Dict[str, Dict[str, str]] = {}
         self.data_dict_content: str = ""
         self.production_data_sample: Optional[pd.DataFrame] = None
+        # Lowercased data dictionary type of each column, built once per dictionary load for _validate_data
+        self._expected_types: Mapping[str, str] = MappingProxyType({})
+        # Last summary with the sample it was computed from and that sample's (rows, columns) shape
+        self._summary_cache: Optional[Tuple[pd.DataFrame, Tuple, Dict[str, Any]]] = None
         self.logger = logging.getLogger(__name__)
 
     def initialize_data(self):
@@ -40,21 +119,14 @@ class DataHandler:
         """
         self.logger.info(f"Reading data dictionary from {self.data_dict_path}")
         try:
-            with open(self.data_dict_path, 'r') as file:
-                self.data_dict_content = file.read()
-            
-            # Parse the Markdown table content
-            table_pattern = r'\|(.+?)\|(.+?)\|(.+?)\|'
-            for match in re.finditer(table_pattern, self.data_dict_content, re.MULTILINE):
-                column_name = match.group(1).strip()
-                data_type = match.group(2).strip()
-                description = match.group(3).strip()
-                if column_name != "Column Name" and column_name != "---":  # Skip header and separator rows
-                    self.data_dict[column_name] = {
-                        "Type": data_type,
-                        "Description": description
-                    }
-            
+            path = Path(self.data_dict_path)
+            content, parsed = _load_data_dict(str(path), path.stat().st_mtime_ns)
+            self.data_dict_content = content
+            self.data_dict = {column: dict(entry) for column, entry in parsed.items()}
+            self._expected_types = MappingProxyType(
+                {column: entry.get('Type', '').lower() for column, entry in parsed.items()}
+            )
+
             self.logger.info("Data dictionary loaded successfully")
             return self.data_dict
         except FileNotFoundError:
@@ -74,7 +146,8 @@ class DataHandler:
         """
         self.logger.info(f"Loading production data sample from {self.production_csv_path}")
         try:
-            self.production_data_sample = pd.read_csv(self.production_csv_path, nrows=sample_size)
+            self.production_data_sample = self._read_csv_head(sample_size)
+            self._summary_cache = None
             self.logger.info(f"Loaded {len(self.production_data_sample)} rows as a sample")
             self._validate_data()
             self._clean_text_data()
@@ -87,32 +160,60 @@ class DataHandler:
             self.logger.error(f"Traceback: {traceback.format_exc()}")
             raise
 
+    def _read_csv_head(self, nrows: int) -> pd.DataFrame:
+        """
+        Read the first nrows rows of the production CSV.
+
+        pandas' C parser stops after nrows rows, so only the head of the file is parsed. The sample must
+        have the same dtypes and missing values as the full file, which the generated code is run against.
+
+        Args:
+        nrows (int): Number of rows to read.
+
+        Returns:
+        pd.DataFrame: The first nrows rows.
+        """
+        return pd.read_csv(self.production_csv_path, nrows=nrows)
+
     def _validate_data(self):
         """Validate the loaded data against the data dictionary, enforcing data types and identifying missing values."""
         if self.production_data_sample is None:
             self.logger.error("Production data sample is None. Cannot validate.")
             return
 
-        for column in self.production_data_sample.columns:
-            if column not in self.data_dict:
-                self.logger.warning(f"Column '{column}' not found in data dictionary.")
-            else:
-                expected_type = self.data_dict[column].get('Type', '').lower()
-                actual_type = str(self.production_data_sample[column].dtype)
-                try:
-                    # Attempt type conversion if there's a mismatch
-                    if expected_type == 'int64':
-                        self.production_data_sample[column] = pd.to_numeric(self.production_data_sample[column], errors='coerce').astype('Int64')
-                    elif expected_type == 'float64':
-                        self.production_data_sample[column] = pd.to_numeric(self.production_data_sample[column], errors='coerce')
-                    elif expected_type == 'object':
-                        self.production_data_sample[column] = self.production_data_sample[column].astype('object')
-
-                    if actual_type != str(self.production_data_sample[column].dtype):
-                        self.logger.info(f"Column '{column}' type converted from {actual_type} to {self.production_data_sample[column].dtype}")
-
-                except Exception as e:
-                    self.logger.error(f"Could not convert column '{column}' to {expected_type}: {str(e)}")
+        df = self.production_data_sample
+        original_types = df.dtypes.astype(str)
+        actual = original_types.str.lower()
+        expected = pd.Series(dict(self._expected_types), dtype=object).reindex(actual.index)
+
+        unknown_columns = actual.index[expected.isna()].tolist()
+        if unknown_columns:
+            self.logger.warning(f"Columns not found in data dictionary: {unknown_columns}")
+
+        # Only columns whose dtype differs from the expected one need converting; compare all columns at once
+        mismatched = expected[expected.notna() & (expected != actual)]
+        for expected_type in _TYPE_CONVERTERS:
+            # Each group is converted with one call
+            columns = mismatched.index[mismatched == expected_type].tolist()
+            if not columns:
+                continue
+            convert = _TYPE_CONVERTERS[expected_type]
+            try:
+                df[columns] = convert(df[columns])
+            except Exception:
+                # One unconvertible column fails the whole group, so retry the columns individually
+                for column in columns:
+                    try:
+                        df[[column]] = convert(df[[column]])
+                    except Exception as e:
+                        self.logger.error(f"Could not convert column '{column}' to {expected_type}: {str(e)}")
+
+        converted = {
+            column: f"{original_types[column]} -> {df[column].dtype}"
+            for column in df.columns if str(df[column].dtype) != original_types[column]
+        }
+        if converted:
+            self.logger.info(f"Converted column types: {converted}")
 
     def _clean_text_data(self):
         """Clean up text data fields in the production data sample to remove unwanted characters."""
@@ -120,19 +221,18 @@ class DataHandler:
             self.logger.error("Production data sample is None. Cannot clean text data.")
             return
 
-        text_columns = self.production_data_sample.select_dtypes(include=['object']).columns
+        text_columns = self.production_data_sample.select_dtypes(include=['object', 'string']).columns
         for column in text_columns:
             try:
+                # Missing values pass through the string methods unchanged and are imputed in _handle_missing_data
                 self.production_data_sample[column] = (
                     self.production_data_sample[column]
-                    .fillna('')  # Replace NaN with empty string to avoid errors
-                    .str.replace('\n', ' ', regex=False)  # Remove newlines
-                    .str.replace(r'\s+', ' ', regex=True)  # Remove excessive whitespace
+                    .str.replace(_WHITESPACE_RE, ' ', regex=True)  # Collapse newlines and excessive whitespace
                     .str.strip()  # Remove leading/trailing whitespace
                 )
-                self.logger.info(f"Cleaned text data in column: {column}")
             except Exception as e:
                 self.logger.error(f"Error cleaning text data in column '{column}': {str(e)}")
+        self.logger.info(f"Cleaned text data in {len(text_columns)} columns")
 
     def _handle_missing_data(self):
         """Handle missing data by imputing or removing based on rules."""
@@ -140,19 +240,24 @@ class DataHandler:
             self.logger.error("Production data sample is None. Cannot handle missing data.")
             return
 
-        for column in self.production_data_sample.columns:
-            missing_count = self.production_data_sample[column].isnull().sum()
-            if missing_count > 0:
-                self.logger.info(f"Column '{column}' has {missing_count} missing values")
-                if pd.api.types.is_numeric_dtype(self.production_data_sample[column]):
-                    # Impute numeric columns with the median
-                    median_value = self.production_data_sample[column].median()
-                    self.production_data_sample[column].fillna(median_value, inplace=True)
-                    self.logger.info(f"Imputed missing values in '{column}' with median: {median_value}")
-                else:
-                    # Impute categorical/text columns with 'Unknown'
-                    self.production_data_sample[column].fillna('Unknown', inplace=True)
-                    self.logger.info(f"Imputed missing values in '{column}' with 'Unknown'")
+        df = self.production_data_sample
+        missing_counts = df.isna().sum()
+        missing_counts = missing_counts[missing_counts > 0]
+        if missing_counts.empty:
+            return
+        self.logger.info(f"Missing values per column: {missing_counts.to_dict()}")
+
+        numeric_columns = [column for column in missing_counts.index if pd.api.types.is_numeric_dtype(df[column])]
+        other_columns = [column for column in missing_counts.index if column not in numeric_columns]
+        if numeric_columns:
+            # Impute numeric columns with the median
+            medians = df[numeric_columns].median()
+            df[numeric_columns] = df[numeric_columns].fillna(medians)
+            self.logger.info(f"Imputed missing values with medians: {medians.to_dict()}")
+        if other_columns:
+            # Impute categorical/text columns with 'Unknown'
+            df[other_columns] = df[other_columns].fillna('Unknown')
+            self.logger.info(f"Imputed missing values with 'Unknown' in: {other_columns}")
 
     def get_data_summary(self) -> Dict[str, Any]:
         """
@@ -164,20 +269,28 @@ class DataHandler:
         if self.production_data_sample is None:
             self.logger.error("Production data sample is None. Cannot generate summary.")
             return {}
-        
+
+        df = self.production_data_sample
+        # The sample is kept in the cache, so an identity match cannot be a recycled object
+        fingerprint = (len(df), tuple(df.columns))
+        cached = self._summary_cache
+        if cached is not None and cached[0] is df and cached[1] == fingerprint:
+            return cached[2]
+
         try:
             summary = {
                 "num_rows": len(self.production_data_sample),
                 "num_columns": len(self.production_data_sample.columns),
                 "column_types": self.production_data_sample.dtypes.astype(str).to_dict(),
-                "missing_values": self.production_data_sample.isnull().sum().to_dict(),
-                "numeric_summary": self.production_data_sample.describe().to_dict(),
+                "missing_values": self.production_data_sample.isna().sum().to_dict(),
+                "numeric_summary": self._numeric_summary(),
                 "categorical_summary": {
-                    col: self.production_data_sample[col].value_counts().to_dict()
+                    col: self.production_data_sample[col].value_counts().head(config.MAX_SUMMARY_CATEGORIES).to_dict()
                     for col in self.production_data_sample.select_dtypes(include=['object', 'category']).columns
                 }
             }
             
+            self._summary_cache = (df, fingerprint, summary)
             self.logger.info("Generated data summary successfully")
             return summary
         except Exception as e:
@@ -185,6 +298,27 @@ class DataHandler:
             self.logger.error(f"Traceback: {traceback.format_exc()}")
             return {}
 
+    def get_data_summary_json(self) -> bytes:
+        """
+        Serialize the data summary to JSON.
+
+        orjson writes NumPy scalars natively, so counts and statistics need no conversion to Python types first.
+
+        Returns:
+        bytes: The summary from get_data_summary as indented UTF-8 JSON.
+        """
+        return orjson.dumps(
+            self.get_data_summary(),
+            default=str,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2
+        )
+
+    def _numeric_summary(self) -> Dict[str, Dict[str, float]]:
+        """Summarize the numeric columns, falling back to describe() when there are none."""
+        if self.production_data_sample.select_dtypes(include=np.number).empty:
+            return self.production_data_sample.describe().to_dict()
+        return _describe_numeric(self.production_data_sample)
+
     def save_processed_data(self, output_path: Path):
         """Save the processed data sample to a CSV file."""
         if self.production_data_sample is None:
@@ -214,8 +348,7 @@ if __name__ == "__main__":
         data_handler.initialize_data()
         
         # Test data summary
-        summary = data_handler.get_data_summary()
-        print(json.dumps(summary, indent=2))
+        print(data_handler.get_data_summary_json().decode())
         
         # Test saving processed data
         output_path = Path("test_output")
@@ -3,26 +3,76 @@ import io
 import sys
 import contextlib
 from pathlib import Path
-from typing import Any, Tuple, List, Dict
+from typing import Any, Tuple, List, Dict, Optional
 import importlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import itertools
+import types
 import subprocess
 import pandas as pd
 import numpy as np
+import matplotlib
+# Figures are only ever saved to files, so use the non-interactive backend and skip GUI setup
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
 import ast
 import traceback
 
+# Starts the error report execute_code adds to the captured output when the code raises
+EXECUTION_ERROR_MARKER = "Error during code execution:"
+
+# Builtins and module functions generated code may not call
+_FORBIDDEN_CALLS = {'eval', 'exec', '__import__'}
+_FORBIDDEN_ATTRIBUTE_CALLS = {('os', 'system'), ('subprocess', 'run')}
+
+def _forbidden_call_name(tree: ast.AST):
+    """Return the name of the first forbidden call in a parsed module, or None if there is none."""
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in _FORBIDDEN_CALLS:
+            return func.id
+        if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name)
+                and (func.value.id, func.attr) in _FORBIDDEN_ATTRIBUTE_CALLS):
+            return f"{func.value.id}.{func.attr}"
+    return None
+
+@contextlib.contextmanager
+def _no_trace():
+    """Suspend any trace function (debugger, coverage) on this thread while generated code runs."""
+    old_trace = sys.gettrace()
+    sys.settrace(None)
+    try:
+        yield
+    finally:
+        sys.settrace(old_trace)
+
 # Set Seaborn plot theme
 sns.set_theme(context='notebook', style='darkgrid', palette='pastel')
 
 class CodeExecutor:
+    __slots__ = ('output_path', 'figure_dir', 'installed_packages', '_module_cache',
+                 '_install_pool', '_install_futures', '_install_lock', '_code_cache', '_execution_ids')
+
     def __init__(self, output_path: Path):
         self.output_path = output_path
         self.figure_dir = output_path / "figures"
         self.figure_dir.mkdir(parents=True, exist_ok=True)
         self.installed_packages = set()
-        self.notebook_path = self.output_path / 'analysis_notebook.ipynb'
+        # Modules already returned by import_library, by name
+        self._module_cache: Dict[str, Any] = {}
+        # pip installs run on a small pool; callers asking for a library that is already being installed share its future
+        self._install_pool: Optional[ThreadPoolExecutor] = None
+        self._install_futures: Dict[str, Future] = {}
+        self._install_lock = threading.RLock()
+        # Compiled code objects keyed by a digest of the sanitized code, so re-running the same code skips parsing
+        self._code_cache: Dict[bytes, types.CodeType] = {}
+        # Numbers each execution, so its figure files do not overwrite those of an earlier analysis still being interpreted
+        self._execution_ids = itertools.count()
 
     def execute_code(self, sanitized_code: str, data: pd.DataFrame) -> Tuple[Any, str, List[str]]:
         logging.info("Executing sanitized code")
@@ -31,27 +81,29 @@ class CodeExecutor:
         # Capturing output
         output_buffer = io.StringIO()
         figure_paths = []
+        execution_id = next(self._execution_ids)
 
         global_vars = self._prepare_global_namespace(data, figure_paths)
 
         with contextlib.redirect_stdout(output_buffer), contextlib.redirect_stderr(output_buffer):
             try:
-                prepared_code = self._prepare_code(sanitized_code)
-                logging.debug(f"Prepared code for execution:\n{prepared_code}")  # Log the prepared code
-                
-                exec(prepared_code, global_vars)
+                compiled_code = self._compile_code(sanitized_code)
+                with _no_trace():
+                    exec(compiled_code, global_vars)
 
                 # Suggest code refinements based on feedback
-                self.review_and_refine(global_vars)
+                self.review_and_refine(global_vars, execution_id)
 
                 result = global_vars.get('result', None)
             except Exception as e:
                 logging.error(f"Error during code execution: {str(e)}")
                 logging.error(f"Detailed traceback:\n{traceback.format_exc()}")
+                # Also report the error in the captured output, which is passed on for interpretation
+                print(f"{EXECUTION_ERROR_MARKER} {str(e)}")
+                print(f"Traceback: {traceback.format_exc()}")
                 result = None
 
         output = output_buffer.getvalue()
-        self.save_to_notebook(sanitized_code, output, result)
         logging.info("Sanitized code execution completed")
         return result, output, figure_paths
 
@@ -67,30 +119,42 @@ class CodeExecutor:
             'import_library': self.import_library
         }
 
-    def _prepare_code(self, code: str) -> str:
-        # Standardize code indentation
-        indented_code = '\n'.join('    ' + line for line in code.splitlines())
-
-        # Properly creating try-except block
-        code_block = f"""
-try:
-{indented_code}
-except Exception as e:
-    print(f"Error during code execution: {{str(e)}}")
-    print(f"Traceback: {{traceback.format_exc()}}")
-    raise
-"""
-        return code_block
+    def _compile_code(self, sanitized_code: str) -> types.CodeType:
+        """Check and compile sanitized code, reusing the code object if the same code was compiled before."""
+        key = hashlib.blake2b(sanitized_code.encode(), digest_size=16).digest()
+        compiled_code = self._code_cache.get(key)
+        if compiled_code is None:
+            tree = self._prepare_code(sanitized_code)
+            # The digest in the file name tells tracebacks from different analyses apart
+            compiled_code = self._code_cache[key] = compile(tree, f"<analysis-{key.hex()}>", 'exec')
+        return compiled_code
+
+    def _prepare_code(self, code: str) -> ast.Module:
+        """
+        Parse code and check it makes no forbidden calls.
+
+        The code is executed as written, so line numbers in tracebacks match the generated code.
+
+        Raises:
+        SyntaxError: If the code does not parse.
+        ValueError: If the code calls a forbidden function.
+        """
+        tree = ast.parse(code)
+        forbidden = _forbidden_call_name(tree)
+        if forbidden:
+            raise ValueError(f"Forbidden call to {forbidden} in generated code")
+        return tree
 
     def _sanitize_text(self, text: str) -> str:
         return text.replace('\r', '')
 
-    def _save_figures(self, figure_paths: List[str]) -> List[Dict]:
+    def _save_figures(self, figure_paths: List[str], execution_id: int) -> List[Dict]:
         figure_metadata = []
         for i, fig in enumerate(plt.get_fignums()):
             figure = plt.figure(fig)
-            file_path = self.figure_dir / f"figure_{i}.png"
-            figure.savefig(file_path)
+            file_path = self.figure_dir / f"figure_{execution_id}_{i}.png"
+            # Low zlib compression encodes PNGs several times faster for slightly larger files
+            figure.savefig(file_path, pil_kwargs={'compress_level': 1})
             figure_paths.append(str(file_path))
 
             logging.info(f"Figure saved: {file_path}")
@@ -109,8 +173,8 @@ except Exception as e:
             plt.close(fig)
         return figure_metadata
 
-    def review_and_refine(self, global_vars: Dict[str, Any]):
-        figure_metadata = self._save_figures(global_vars['figure_paths'])
+    def review_and_refine(self, global_vars: Dict[str, Any], execution_id: int):
+        figure_metadata = self._save_figures(global_vars['figure_paths'], execution_id)
 
         feedback = self.review_visualizations(figure_metadata)
         logging.info(f"Visualization Feedback: {feedback}")  
@@ -141,28 +205,55 @@ except Exception as e:
         logging.info(f"Refining visualization based on feedback: {feedback}")
         # Add your refinement logic here
 
-    def save_to_notebook(self, sanitized_code: str, output: str, result: Any):
-        with open(self.notebook_path, 'a') as notebook:
-            notebook.write(f"### Sanitized Code:\n{sanitized_code}\n\n")
-            notebook.write(f"### Output:\n{output}\n\n")
-            notebook.write(f"### Result:\n{result}\n\n")
-        logging.info(f"Saved results to notebook {self.notebook_path}.")
-
     def import_library(self, library_name: str) -> Any:
+        module = self._module_cache.get(library_name)
+        if module is None:
+            module = self._module_cache[library_name] = self._import_or_install(library_name)
+        return module
+
+    def _import_or_install(self, library_name: str) -> Any:
         try:
             return importlib.import_module(library_name)
         except ImportError:
             if library_name not in self.installed_packages:
-                logging.info(f"Attempting to install {library_name}")
-                try:
-                    subprocess.check_call([sys.executable, "-m", "pip", "install", library_name])
-                    self.installed_packages.add(library_name)
-                    logging.info(f"Successfully installed {library_name}")
-                except subprocess.CalledProcessError:
-                    logging.error(f"Failed to install {library_name}")
-                    raise ImportError(f"Could not import or install {library_name}")
+                self.install_library(library_name).result()
             return importlib.import_module(library_name)
 
+    def install_library(self, library_name: str) -> Future:
+        """
+        Start installing a library with pip in the background, unless an install of it is already running.
+
+        Args:
+        library_name (str): The package to install.
+
+        Returns:
+        Future: Completes when the install finishes; its result raises ImportError if the install failed.
+        """
+        with self._install_lock:
+            future = self._install_futures.get(library_name)
+            if future is None:
+                if self._install_pool is None:
+                    self._install_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pip-install")
+                future = self._install_futures[library_name] = self._install_pool.submit(self._install, library_name)
+                # Forget the install once done, so a failed one can be retried later
+                future.add_done_callback(lambda _: self._forget_install(library_name))
+            return future
+
+    def _forget_install(self, library_name: str):
+        with self._install_lock:
+            self._install_futures.pop(library_name, None)
+
+    def _install(self, library_name: str):
+        logging.info(f"Attempting to install {library_name}")
+        try:
+            subprocess.check_call([sys.executable, "-m", "pip", "install", library_name])
+        except subprocess.CalledProcessError:
+            logging.error(f"Failed to install {library_name}")
+            raise ImportError(f"Could not import or install {library_name}")
+        self.installed_packages.add(library_name)
+        importlib.invalidate_caches()
+        logging.info(f"Successfully installed {library_name}")
+
     def get_execution_summary(self, result: Any, output: str, figure_paths: List[str]) -> dict:
         return {
             "result_type": type(result).__name__,
@@ -173,13 +264,16 @@ except Exception as e:
 
     def generate_report(self, figure_paths, report_path='output/final_report.pdf'):
         from matplotlib.backends.backend_pdf import PdfPages
+        from matplotlib.figure import Figure
+        from PIL import Image
         with PdfPages(report_path) as pdf:
             for fig_path in figure_paths:
-                plt.figure()
-                img_data = plt.imread(fig_path)
-                plt.imshow(img_data)
-                pdf.savefig()
-                plt.close()
+                with Image.open(fig_path) as image:
+                    dpi = image.info.get('dpi', (100, 100))[0]
+                    # A page the exact size of the image, with the pixels placed unscaled and without axes
+                    page = Figure(figsize=(image.width / dpi, image.height / dpi), dpi=dpi)
+                    page.figimage(np.asarray(image), 0, 0, origin='upper')
+                pdf.savefig(page, dpi=dpi)
         logging.info(f"Generated report saved to {report_path}")
 
 if __name__ == "__main__":
@@ -1,196 +1,343 @@
 import logging
 import base64
+import io
+import mmap
 import os
 import pandas as pd
 import numpy as np
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 from api_client import APIClient
-import json
+import config
+import orjson
+import re
+import textwrap
 import traceback
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, pd.Series):
-            return obj.to_list()
-        elif isinstance(obj, pd.core.dtypes.base.ExtensionDtype):
-            return str(obj)
-        elif pd.api.types.is_categorical_dtype(obj):
-            return str(obj)
-        elif isinstance(obj, pd.Timestamp):
-            return obj.isoformat()
-        elif isinstance(obj, pd.Timedelta):
-            return obj.total_seconds()
-        return super(NumpyEncoder, self).default(obj)
+logger = logging.getLogger(__name__)
+
+# A dash bullet item of a list in an API response, capturing the item's text
+_BULLET_RE = re.compile(r'^[ \t]*-[ \t]*(\S.*?)[ \t\r]*$', re.MULTILINE)
+
+# Prompt templates, dedented once at import and filled with str.format
+_INTERPRET_ALL_TEMPLATE = textwrap.dedent("""
+        Interpret the results of the following analysis step.
+
+        Analysis:
+        {name}: {description}
+
+        Result:
+        {result}
+
+        Printed output:
+        {output}
+
+        Number of figures saved: {num_figures} ({num_attached} attached below)
+
+        Analyses completed earlier: {completed_names}
+
+        Key findings so far:
+        {earlier_findings}
+
+        Respond with a JSON object with two keys:
+        - "interpretation": a detailed interpretation of the results, including what the attached figures show
+        - "key_findings": a list of concise new findings that are data-driven, critical to project success
+          and aligned with the project's strategic goals; do not repeat the key findings so far
+        """)
+
+# Most recent key findings given as context when interpreting another analysis
+_MAX_CONTEXT_FINDINGS = 20
+
+_IMAGE_ANALYSIS_SYSTEM_PROMPT = ("You are an image analysis system. Analyze the following images and provide detailed insights. "
+                                 "Consider the analysis summary and data dictionary for further context.")
+
+_KEY_FINDINGS_TEMPLATE = textwrap.dedent("""
+        Given the following interpretation of an analysis:
+
+        {interpretation}
+
+        Extract key findings that are concise and critical to project success. Each finding should:
+        1. Be data-driven
+        2. Align with the project's strategic goals
+
+        Respond with a JSON object with a "key_findings" key holding the list of findings.
+        """)
+
+_SUMMARY_REPORT_TEMPLATE = textwrap.dedent("""
+        Generate a comprehensive project report including the following:
+
+        Completed Analyses:
+        {analyses_json}
+
+        Key Findings:
+        {key_findings_json}
+
+        Report must include:
+        1. Executive Summary
+        2. Detailed Analysis Results
+        3. Key Insights and Based Recommendations
+        4. Conclusions and Future Suggestions
+
+        Format the report using Markdown with clear headings.
+        """)
+
+# The readers below are memoized on the file's path and modification time, so a file is
+# read again only after it changes
+
+@lru_cache(maxsize=2)
+def _read_text_file(path: str, mtime_ns: int, max_chars: Optional[int]) -> str:
+    with open(path, "r") as file:
+        return file.read(max_chars)
+
+@lru_cache(maxsize=1)
+def _read_csv_preview(path: str, mtime_ns: int, rows: int) -> str:
+    return pd.read_csv(path, nrows=rows).to_string(index=False)
+
+@lru_cache(maxsize=64)
+def _encode_file(path: str, mtime_ns: int) -> str:
+    from PIL import Image
+    with Image.open(path) as image:
+        if max(image.size) > config.MAX_INTERPRETED_IMAGE_SIZE:
+            # Pixels beyond what the model looks at only add upload bytes
+            image.thumbnail((config.MAX_INTERPRETED_IMAGE_SIZE, config.MAX_INTERPRETED_IMAGE_SIZE))
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG", optimize=True)
+            return base64.b64encode(buffer.getbuffer()).decode('ascii')
+    # Encode straight from a read-only mapping of the file rather than a copy of its bytes
+    with open(path, "rb") as image_file, mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return base64.b64encode(mapped).decode('ascii')
+
+# orjson writes NumPy scalars and contiguous arrays itself; _prompt_json_default covers the rest
+_PROMPT_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def _prompt_json_default(obj):
+    """Convert the pandas and NumPy values orjson cannot serialize natively."""
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    elif isinstance(obj, pd.Timedelta):
+        return obj.total_seconds()
+    elif isinstance(obj, pd.Series):
+        return obj.to_list()
+    elif isinstance(obj, np.ndarray):
+        # Non-contiguous arrays, such as column slices
+        return obj.tolist()
+    elif isinstance(obj, pd.api.extensions.ExtensionDtype):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 class ResultInterpreter:
+    __slots__ = ('api_client', 'api_key')
+
     def __init__(self, api_client: APIClient):
         self.api_client = api_client
         self.api_key = os.getenv("OPENAI_API_KEY")
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s - %(levelname)s - %(message)s',
-                            handlers=[
-                                logging.FileHandler("debug.log"),
-                                logging.StreamHandler()
-                            ])
 
     def encode_image(self, file_path: str) -> bytes:
         try:
-            with open(file_path, "rb") as image_file:
-                encoded = base64.b64encode(image_file.read()).decode('utf-8')
-                return encoded
+            return _encode_file(file_path, os.stat(file_path).st_mtime_ns)
         except Exception as e:
-            logging.error(f"Error encoding image {file_path}: {str(e)}")
+            logger.error(f"Error encoding image {file_path}: {str(e)}")
             return ""
 
-    def read_data_dictionary(self) -> str:
+    def read_data_dictionary(self, max_chars: Optional[int] = None) -> str:
         try:
-            with open("data/data_dictionary.md", "r") as file:
-                return file.read()
+            path = "data/data_dictionary.md"
+            return _read_text_file(path, os.stat(path).st_mtime_ns, max_chars)
         except FileNotFoundError:
-            logging.error("Data dictionary file not found.")
+            logger.error("Data dictionary file not found.")
             return ""
         except Exception as e:
-            logging.error(f"Error reading data dictionary: {str(e)}")
+            logger.error(f"Error reading data dictionary: {str(e)}")
             return ""
 
     def read_production_data_sample(self) -> str:
         try:
-            df = pd.read_csv("data/production_data.csv")
-            return df.head(10).to_string(index=False)
+            path = "data/production_data.csv"
+            return _read_csv_preview(path, os.stat(path).st_mtime_ns, 10)
         except FileNotFoundError:
-            logging.error("Production data file not found.")
+            logger.error("Production data file not found.")
             return ""
         except Exception as e:
-            logging.error(f"Error reading production data: {str(e)}")
+            logger.error(f"Error reading production data: {str(e)}")
             return ""
 
+    def _encode_figures(self, figure_paths: List[str]) -> List[str]:
+        """Encode up to config.MAX_INTERPRETED_FIGURES figures for an API request, skipping those that cannot be read."""
+        images = []
+        for figure_path in figure_paths[:config.MAX_INTERPRETED_FIGURES]:
+            base64_image = self.encode_image(figure_path)
+            if base64_image:
+                images.append(base64_image)
+        return images
+
     def interpret_results(self, analysis: Dict[str, Any], result: Any, output: str, figure_paths: List[str], completed_analyses: List[Dict], key_findings: List[str]) -> str:
-        logging.info(f"Interpreting results for analysis: {analysis['name']}")
+        logger.info("Interpreting results for analysis: %s", analysis['name'])
 
         if not figure_paths or len(figure_paths) == 0:
-            logging.error("No figure paths provided for image analysis.")
+            logger.error("No figure paths provided for image analysis.")
             return "Error: No figure paths provided for image analysis."
 
+        if self.api_client.api_type != 'openai':
+            logger.error(f"Image analysis is not supported for the {self.api_client.api_type} API.")
+            return f"Error: Image analysis is not supported for the {self.api_client.api_type} API."
+
         try:
             # Contextual information
             analysis_summary = analysis.get("summary", "No summary available")[:1000]
             
             # Read data dictionary content
-            data_dictionary_content = self.read_data_dictionary()
-
-            # Encode the first image
-            base64_image = self.encode_image(figure_paths[0])
-            base64_prefixed_image = f"data:image/png;base64,{base64_image}"
-
-            # Prepare messages payload
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are an image analysis system. Analyze the following image and provide detailed insights. Consider the analysis summary and data dictionary for further context."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": f"Analysis Summary: {analysis_summary}"},
-                        {"type": "text", "text": "Analyze this image."},
-                        {"type": "text", "text": f"Data Dictionary: {data_dictionary_content[:2000]}"},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": base64_prefixed_image
-                            }
-                        }
-                    ]
-                }
-            ]
-
-            # Call API using self.api_client
-            response = self.api_client.chat.completions.create(
-                model="gpt-4o-2024-08-06",
-                messages=messages,
-                max_tokens=300
+            data_dictionary_content = self.read_data_dictionary(max_chars=2000)
+
+            # All figures go in one request, so interpreting them costs a single round trip
+            images = self._encode_figures(figure_paths)
+            if not images:
+                logger.error("None of the figures could be encoded for image analysis.")
+                return "Error: No figures could be encoded for image analysis."
+
+            prompt = (f"Analysis Summary: {analysis_summary}\n"
+                      "Analyze these images.\n"
+                      f"Data Dictionary: {data_dictionary_content}")
+            interpretation = self.api_client.call_api_with_images(
+                prompt,
+                images,
+                max_tokens=300 * len(images),
+                system_prompt=_IMAGE_ANALYSIS_SYSTEM_PROMPT
             )
-            
-            interpretation = response.choices[0].message.content
-            logging.info("API Response: %s", interpretation)
+            logger.info("API Response: %s", interpretation)
             return interpretation
 
         except Exception as e:
-            logging.error(f"Error interpreting results for analysis {analysis['name']}: {str(e)}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logger.error(f"Error interpreting results for analysis {analysis['name']}: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
             return f"Error in interpretation: {str(e)}"
 
-    def extract_key_findings(self, interpretation: str) -> List[str]:
-        prompt = f"""
-        Given the following interpretation of an analysis:
+    def interpret_all(self, analysis: Dict[str, Any], result: Any, output: str, figure_paths: List[str], completed_analyses: List[Dict], key_findings: List[str]) -> Tuple[str, List[str]]:
+        """
+        Interpret the results of an analysis and extract its key findings with a single JSON mode API call.
 
-        {interpretation}
+        The analysis's figures are attached to the request when the API takes
+        images, and the earlier analyses and key findings are given as context.
+        Falls back to interpret_results followed by extract_key_findings if the
+        call fails or its response does not have the expected shape.
 
-        Extract key findings that are concise and critical to project success. Each finding should:
-        1. Be data-driven
-        2. Align with the project's strategic goals
+        Args:
+        analysis (Dict[str, Any]): The analysis step whose results are interpreted.
+        result (Any): The value of 'result' after running the analysis code.
+        output (str): The printed output of the analysis code.
+        figure_paths (List[str]): Paths of the figures the code saved.
+        completed_analyses (List[Dict]): The analyses completed so far.
+        key_findings (List[str]): The key findings so far.
 
-        Provide the findings as a list, formatted with a dash (-) for each.
+        Returns:
+        Tuple[str, List[str]]: The interpretation and its key findings.
         """
-        
+        logger.info("Interpreting results and extracting key findings for analysis: %s", analysis['name'])
+        # Only the OpenAI API takes images; elsewhere the figures are only counted
+        images = self._encode_figures(figure_paths) if figure_paths and self.api_client.api_type == 'openai' else []
+        earlier_findings = key_findings[-_MAX_CONTEXT_FINDINGS:]
+        prompt = _INTERPRET_ALL_TEMPLATE.format(name=analysis['name'], description=analysis.get('description', ''),
+                                                result=str(result)[:config.MAX_INTERPRETED_RESULT_CHARS],
+                                                output=str(output)[:config.MAX_INTERPRETED_OUTPUT_CHARS],
+                                                num_figures=len(figure_paths), num_attached=len(images),
+                                                completed_names='; '.join(a['name'] for a in completed_analyses) or 'none',
+                                                earlier_findings='\n'.join(f"- {f}" for f in earlier_findings) or 'none')
+
         try:
-            findings = self.api_client.call_api(prompt)
-            key_findings = [finding.strip()[2:] for finding in findings.split('\n') if finding.strip().startswith('-')]
-            logging.info("Extracted key findings successfully.")
-            return key_findings
+            if images:
+                response = self.api_client.call_api_with_images(prompt, images, max_tokens=1000 + 300 * len(images),
+                                                                use_json_mode=True)
+            else:
+                response = self.api_client.call_api(prompt, use_json_mode=True)
+            response = self.api_client.parse_json_response(response)
+            if isinstance(response, dict):
+                interpretation = response.get('interpretation')
+                findings = response.get('key_findings')
+                if isinstance(interpretation, str) and isinstance(findings, list):
+                    return interpretation, [str(finding) for finding in findings]
+            logger.warning("Combined interpretation response has an unexpected shape, interpreting in separate calls")
         except Exception as e:
-            logging.error(f"Error extracting key findings: {str(e)}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
-            return []
+            logger.warning(f"Error in combined interpretation, interpreting in separate calls: {str(e)}")
 
-    def generate_summary_report(self, completed_analyses: List[Dict], key_findings: List[str]) -> str:
-        prompt = f"""
-        Generate a comprehensive project report including the following:
+        interpretation = self.interpret_results(analysis, result, output, figure_paths, completed_analyses, key_findings)
+        return interpretation, self.extract_key_findings(interpretation)
 
-        Completed Analyses:
-        {json.dumps(completed_analyses, indent=2, cls=NumpyEncoder)}
+    def extract_key_findings(self, interpretation: str) -> List[str]:
+        prompt = _KEY_FINDINGS_TEMPLATE.format(interpretation=interpretation)
 
-        Key Findings:
-        {json.dumps(key_findings, indent=2, cls=NumpyEncoder)}
+        try:
+            findings = self.api_client.call_api(prompt, use_json_mode=True)
+            try:
+                response = self.api_client.parse_json_response(findings)
+            except ValueError:
+                response = None
+            if isinstance(response, dict) and isinstance(response.get('key_findings'), list):
+                key_findings = [str(finding) for finding in response['key_findings']]
+            else:
+                # APIs without a JSON mode may still answer with a dash bullet list
+                key_findings = _BULLET_RE.findall(findings)
+            logger.info("Extracted key findings successfully.")
+            return key_findings
+        except Exception as e:
+            logger.error(f"Error extracting key findings: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            return []
 
-        Report must include:
-        1. Executive Summary
-        2. Detailed Analysis Results
-        3. Key Insights and Based Recommendations
-        4. Conclusions and Future Suggestions
-        
-        Format the report using Markdown with clear headings.
-        """
+    def generate_summary_report(self, completed_analyses: List[Dict], key_findings: List[str]) -> str:
+        prompt = self._build_summary_report_prompt(completed_analyses, key_findings)
         
         try:
             report = self.api_client.call_api(prompt)
-            logging.info("Generated summary report successfully.")
+            logger.info("Generated summary report successfully.")
             return report
         except Exception as e:
-            logging.error(f"Error generating summary report: {str(e)}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logger.error(f"Error generating summary report: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
             return "Error generating report."
 
+    def stream_summary_report(self, completed_analyses: List[Dict], key_findings: List[str]) -> Iterator[str]:
+        """
+        Generate the summary report, yielding its text as the API produces it.
+
+        Args:
+        completed_analyses (List[Dict]): The completed analyses.
+        key_findings (List[str]): The key findings.
+
+        Yields:
+        str: Consecutive pieces of the report. If generation fails, an error
+        message is yielded as the final piece.
+        """
+        prompt = self._build_summary_report_prompt(completed_analyses, key_findings)
+
+        try:
+            yield from self.api_client.stream_api(prompt)
+            logger.info("Generated summary report successfully.")
+        except Exception as e:
+            logger.error(f"Error generating summary report: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            yield "Error generating report."
+
+    def _build_summary_report_prompt(self, completed_analyses: List[Dict], key_findings: List[str]) -> str:
+        # Local record file paths mean nothing to the model; compact JSON avoids spending tokens on indentation
+        report_analyses = [{key: value for key, value in analysis.items() if key != 'record_path'}
+                           for analysis in completed_analyses]
+        analyses_json = orjson.dumps(report_analyses, default=_prompt_json_default, option=_PROMPT_JSON_OPTIONS).decode()
+        key_findings_json = orjson.dumps(key_findings, default=_prompt_json_default, option=_PROMPT_JSON_OPTIONS).decode()
+        return _SUMMARY_REPORT_TEMPLATE.format(analyses_json=analyses_json, key_findings_json=key_findings_json)
+
     def save_report(self, report: str, output_path: Path):
         try:
             report_path = output_path / "final_report.md"
             with open(report_path, 'w', encoding='utf-8') as f:
                 f.write(report)
-            logging.info(f"Report saved to {report_path}")
+            logger.info("Report saved to %s", report_path)
         except Exception as e:
-            logging.error(f"Error saving report: {str(e)}")
-            logging.error(f"Traceback: {traceback.format_exc()}")
+            logger.error(f"Error saving report: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
 
 if __name__ == "__main__":
     # Set up logging
@@ -4,6 +4,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 import traceback
 import sys
+import argparse
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,14 +20,20 @@ from data_handling import DataHandler
 logging.config.dictConfig(config.LOGGING_CONFIG)
 logger = logging.getLogger(__name__)
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the Automated Data Scientist")
+    parser.add_argument('--batch', action='store_true',
+                        help="Generate analysis code through the OpenAI Batch API (cheaper, but may take hours)")
+    return parser.parse_args()
+
+def main(batch_mode: bool = False):
     logger.info("Starting Automated Data Scientist application")
     print("Starting Automated Data Scientist application")
 
     try:
         # Initialize APIClient
         api_client = APIClient(api_type=config.DEFAULT_API_TYPE)
-        logger.info(f"Initialized APIClient with {config.DEFAULT_API_TYPE} API")
+        logger.info("Initialized APIClient with %s API", config.DEFAULT_API_TYPE)
         print("Initialized APIClient")
 
         # Initialize CodeGenerator
@@ -36,7 +43,7 @@ def main():
 
         # Initialize NotebookManager
         notebook_manager = NotebookManager(config.NOTEBOOK_PATH)
-        logger.info(f"Initialized NotebookManager with notebook path: {config.NOTEBOOK_PATH}")
+        logger.info("Initialized NotebookManager with notebook path: %s", config.NOTEBOOK_PATH)
         print("Initialized NotebookManager")
 
         # Initialize DataHandler
@@ -52,20 +59,26 @@ def main():
             api_type=config.DEFAULT_API_TYPE,
             code_generator=code_generator,
             notebook_manager=notebook_manager,
-            data_handler=data_handler
+            data_handler=data_handler,
+            batch_mode=batch_mode,
+            api_client=api_client
         )
         logger.info("Initialized AutomatedDataScientist")
         print("Initialized AutomatedDataScientist")
 
         # Run the automated data science process
         print("Running automated data science process")
-        ads.run()
+        try:
+            ads.run()
+        finally:
+            # Release pooled HTTP connections and flush cache statistics to the log
+            api_client.close()
 
         logger.info("Automated data science process completed successfully")
         print("Automated data science process completed successfully")
 
-        logger.info(f"Check the output directory for results: {config.DEFAULT_OUTPUT_DIR}")
-        logger.info(f"Jupyter Notebook saved at: {config.NOTEBOOK_PATH}")
+        logger.info("Check the output directory for results: %s", config.DEFAULT_OUTPUT_DIR)
+        logger.info("Jupyter Notebook saved at: %s", config.NOTEBOOK_PATH)
 
     except Exception as e:
         logger.error(f"An error occurred during execution: {str(e)}")
@@ -77,18 +90,23 @@ def main():
 def setup_directories():
     """Ensure all necessary directories exist."""
     directories = [
+        config.LOGS_DIR,
         config.DEFAULT_OUTPUT_DIR,
-        config.DEFAULT_FIGURE_DIR,
-        config.LOGS_DIR
+        config.DEFAULT_FIGURE_DIR
     ]
+    # On most launches every directory already exists, so a stat is all each one costs
+    created = []
     for directory in directories:
-        directory.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Ensured directory exists: {directory}")
+        if not directory.is_dir():
+            directory.mkdir(parents=True, exist_ok=True)
+            created.append(directory)
+    logger.info("Ensured directories exist: %s (created: %s)", directories, created or "none")
 
 if __name__ == "__main__":
     try:
+        args = parse_args()
         setup_directories()
-        main()
+        main(batch_mode=args.batch)
     except Exception as e:
         logger.critical(f"Critical error in main execution: {str(e)}")
         logger.critical(f"Traceback: {traceback.format_exc()}")
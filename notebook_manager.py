@@ -1,51 +1,70 @@
 import nbformat
 from nbformat.v4 import new_notebook, new_markdown_cell, new_code_cell
+import copy
 import logging
-from typing import Dict, Any
-import json
+from typing import Dict, Any, Optional, Tuple
+import os
+import queue
+import threading
+import orjson
+from pathlib import Path
 import config
 
+# Kernel and language metadata of every generated notebook
+_NOTEBOOK_METADATA = {
+    "kernelspec": {
+        "display_name": "Python 3",
+        "language": "python",
+        "name": "python3"
+    },
+    "language_info": {
+        "codemirror_mode": {
+            "name": "ipython",
+            "version": 3
+        },
+        "file_extension": ".py",
+        "mimetype": "text/x-python",
+        "name": "python",
+        "nbconvert_exporter": "python",
+        "pygments_lexer": "ipython3",
+        "version": "3.8.5"
+    }
+}
+
 class NotebookManager:
     def __init__(self, notebook_path: str = None):
         self.notebook_path = notebook_path or config.NOTEBOOK_PATH
+        # Append-only log of added cells, one JSON object per line, so an interrupted run keeps its cells
+        self.journal_path = Path(self.notebook_path).with_suffix('.ndjson')
+        self._journal_lines = []
+        self._journal_started = False
+        # Journal appends are written by a background thread so they never delay the next analysis step
+        self._journal_queue: "queue.Queue[Tuple[bytes, bool]]" = queue.Queue()
+        self._journal_writer: Optional[threading.Thread] = None
+        # Whether the notebook has cells that the file at notebook_path does not have yet
+        self._dirty = False
+        # On-disk JSON form of the notebook from the last get_notebook_json call, until a cell changes
+        self._notebook_json: Optional[Dict[str, Any]] = None
         self.notebook = new_notebook()
         self._initialize_notebook()
 
     def _initialize_notebook(self):
-        # Set up metadata
-        self.notebook.metadata = {
-            "kernelspec": {
-                "display_name": "Python 3",
-                "language": "python",
-                "name": "python3"
-            },
-            "language_info": {
-                "codemirror_mode": {
-                    "name": "ipython",
-                    "version": 3
-                },
-                "file_extension": ".py",
-                "mimetype": "text/x-python",
-                "name": "python",
-                "nbconvert_exporter": "python",
-                "pygments_lexer": "ipython3",
-                "version": "3.8.5"
-            }
-        }
+        # Set up metadata; a copy, so edits to one notebook's metadata do not leak into the next
+        self.notebook.metadata = copy.deepcopy(_NOTEBOOK_METADATA)
 
         # Add initial markdown cell
         self.add_markdown_cell("# Automated Data Scientist Analysis", level=1)
-        logging.info(f"Initialized notebook with path: {self.notebook_path}")
+        logging.info("Initialized notebook with path: %s", self.notebook_path)
 
     def add_markdown_cell(self, content: str, level: int = 2):
         header = '#' * level
         cell = new_markdown_cell(f"{header} {content}")
-        self.notebook.cells.append(cell)
-        logging.info(f"Added markdown cell: {content}")
+        self._append_cell(cell)
+        logging.info("Added markdown cell: %s", content)
 
     def add_code_cell(self, code: str):
         cell = new_code_cell(code)
-        self.notebook.cells.append(cell)
+        self._append_cell(cell)
         logging.info("Added code cell.")
 
     def add_analysis_step(self, name: str, description: str, goals: str, code: str):
@@ -55,24 +74,112 @@ class NotebookManager:
         self.add_markdown_cell("Goals:", level=3)
         self.add_markdown_cell(goals)
         self.add_code_cell(code)
-        logging.info(f"Added analysis step for: {name}")
+        logging.info("Added analysis step for: %s", name)
+        self._flush_journal()
+
+    def _append_cell(self, cell):
+        self.notebook.cells.append(cell)
+        self._dirty = True
+        self._notebook_json = None
+        self._journal_lines.append(orjson.dumps(cell) + b"\n")
+
+    def _flush_journal(self):
+        """Queue the cells added since the last flush for appending to the journal; the first flush of a run starts a new one."""
+        if not self._journal_lines:
+            return
+        if not self._journal_started:
+            # Starting a new journal truncates the file, so first save the cells an interrupted run left in it
+            self.recover_previous_run()
+        if self._journal_writer is None:
+            self._journal_writer = threading.Thread(target=self._journal_writer_loop, name="notebook-journal-writer", daemon=True)
+            self._journal_writer.start()
+        self._journal_queue.put((b''.join(self._journal_lines), not self._journal_started))
+        self._journal_lines = []
+        self._journal_started = True
+
+    def flush(self):
+        """Wait until all queued journal appends have been written."""
+        if self._journal_writer is not None:
+            self._journal_queue.join()
+
+    def _journal_writer_loop(self):
+        while True:
+            data, truncate = self._journal_queue.get()
+            try:
+                with open(self.journal_path, 'wb' if truncate else 'ab') as f:
+                    f.write(data)
+            except OSError as e:
+                logging.error(f"Error writing notebook journal: {str(e)}")
+            finally:
+                self._journal_queue.task_done()
+
+    def recover_notebook(self):
+        """
+        Rebuild the notebook from the journal left behind by an interrupted run and save it.
+
+        Returns:
+        bool: True if a journal was found and the notebook was rebuilt from it.
+        """
+        self.flush()
+        if not self.journal_path.exists():
+            return False
+        with open(self.journal_path, 'rb') as f:
+            self.notebook.cells = [nbformat.from_dict(orjson.loads(line)) for line in f if line.strip()]
+        self._journal_lines = []
+        self._dirty = True
+        self._notebook_json = None
+        logging.info("Recovered %d cells from %s", len(self.notebook.cells), self.journal_path)
+        self.save_notebook()
+        return True
+
+    def recover_previous_run(self) -> Optional[Path]:
+        """
+        Save the cells journaled by an interrupted earlier run as a notebook next to this one.
+
+        Returns:
+        Optional[Path]: The path of the recovered notebook, or None if no journal was left behind.
+        """
+        if self._journal_started or not self.journal_path.exists():
+            return None
+        recovered_path = Path(self.notebook_path).with_suffix('.recovered.ipynb')
+        recovered = NotebookManager(str(recovered_path))
+        recovered.journal_path = self.journal_path
+        recovered.recover_notebook()
+        if self.journal_path.exists():
+            logging.error("Could not recover the notebook journal at %s; it will be overwritten", self.journal_path)
+            return None
+        logging.info("Saved the notebook of an interrupted run to %s", recovered_path)
+        return recovered_path
 
     def save_notebook(self):
+        if not self._dirty:
+            logging.info("Notebook at %s is up to date, not saving", self.notebook_path)
+            return
         try:
-            # Ensure notebook structure and validate
-            nbformat.validate(self.notebook)
-            
-            # Serialize the notebook content to JSON
-            notebook_json = nbformat.writes(self.notebook, version=4)
+            # Serialize the notebook content to JSON; writes validates the notebook itself, so capture
+            # its validation error rather than validating the whole notebook a second time beforehand
+            validation = {}
+            notebook_json = nbformat.writes(self.notebook, version=4, capture_validation_error=validation)
+            if 'ValidationError' in validation:
+                raise validation['ValidationError']
 
             # Log the entire notebook content
             logging.debug("Serialized Notebook JSON content:\n%s", notebook_json)
 
-            # Write the JSON content to a file
-            with open(self.notebook_path, 'w', encoding='utf-8') as f:
+            # Write to a temporary file and swap it in so readers never see a partial notebook
+            tmp_path = f"{self.notebook_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 f.write(notebook_json)
+            os.replace(tmp_path, self.notebook_path)
+            self._dirty = False
 
-            logging.info(f"Notebook saved to {self.notebook_path}")
+            # The notebook now holds every cell, so the journal is no longer needed
+            self.flush()
+            self._journal_lines = []
+            self._journal_started = False
+            self.journal_path.unlink(missing_ok=True)
+
+            logging.info("Notebook saved to %s", self.notebook_path)
 
         except nbformat.ValidationError as e:
             logging.error(f"Validation error: {e.message}")
@@ -80,7 +187,18 @@ class NotebookManager:
             logging.error(f"Error saving notebook: {str(e)}")
 
     def get_notebook_json(self) -> Dict[str, Any]:
-        return json.loads(nbformat.writes(self.notebook))
+        """
+        Return the notebook as the JSON structure it is saved as.
+
+        The structure is computed once per change to the notebook's cells, so the
+        returned dict is shared between calls and must not be modified.
+
+        Returns:
+        Dict[str, Any]: The notebook in nbformat v4 JSON form.
+        """
+        if self._notebook_json is None:
+            self._notebook_json = orjson.loads(nbformat.writes(self.notebook))
+        return self._notebook_json
 
 if __name__ == "__main__":
     # This block is for testing purposes
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import time
+
+class RateLimiter:
+    """
+    Token bucket limiting how many requests start per time period.
+
+    Use as a context manager around each request, or as an async context
+    manager in async code; entering waits until a token is available. Up to
+    max_rate requests may start in a burst, after which requests are spaced at
+    time_period / max_rate. One limiter can be shared by threads and by
+    successive event loops, so every request path draws from the same budget.
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = float(max_rate)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token, borrowing it from the future if none is left, and return how long to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_rate, self._tokens + (now - self._last_refill) * self.max_rate / self.time_period)
+            self._last_refill = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens) * self.time_period / self.max_rate
+
+    def acquire(self):
+        """Block until a request may start, then take a token."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait until a request may start, then take a token."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        return False
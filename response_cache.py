@@ -0,0 +1,103 @@
+import logging
+import hashlib
+import sqlite3
+import textwrap
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+class ResponseCache:
+    """
+    Persistent store of LLM responses keyed by model name and prompt hash.
+
+    The SQLite database is only opened on first use, so constructing a cache
+    never touches the filesystem. Entries older than ttl seconds are treated
+    as misses; a ttl of None keeps entries forever.
+    """
+
+    def __init__(self, db_path: Path, ttl: Optional[float] = None):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "model TEXT NOT NULL, "
+                "prompt_hash BLOB NOT NULL, "
+                "response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "PRIMARY KEY (model, prompt_hash))"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+            if 'created_at' not in columns:
+                # Caches written before expiry was supported; their entries expire under any ttl
+                self._conn.execute("ALTER TABLE responses ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+            self._conn.commit()
+            logging.info(f"Opened LLM response cache at {self.db_path}")
+        return self._conn
+
+    def make_key(self, prompt: str, max_tokens: int, use_json_mode: bool, system_prompt: str = "") -> bytes:
+        """
+        Build the cache key for a request.
+
+        The prompts are dedented and stripped first, so the same prompt template
+        written at a different indentation maps to the same key. Whitespace inside
+        the prompt is kept: prompts embed code, where indentation and line breaks
+        change its meaning.
+
+        Args:
+        prompt (str): The prompt sent to the API.
+        max_tokens (int): The maximum number of tokens requested.
+        use_json_mode (bool): Whether JSON mode was requested.
+        system_prompt (str): The system prompt sent with the prompt.
+
+        Returns:
+        bytes: A 16-byte digest identifying the request.
+        """
+        normalized_system_prompt = textwrap.dedent(system_prompt).strip()
+        normalized_prompt = textwrap.dedent(prompt).strip()
+        key_source = f"{max_tokens}\x00{int(use_json_mode)}\x00{normalized_system_prompt}\x00{normalized_prompt}"
+        return hashlib.blake2b(key_source.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, model: str, key: bytes) -> Optional[str]:
+        """Return the cached response for (model, key), or None on a miss."""
+        min_created_at = time.time() - self.ttl if self.ttl is not None else 0
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT response FROM responses WHERE model = ? AND prompt_hash = ? AND created_at >= ?",
+                (model, key, min_created_at)
+            ).fetchone()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def set(self, model: str, key: bytes, response: str):
+        """Store a response for (model, key), replacing any previous entry."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (model, prompt_hash, response, created_at) VALUES (?, ?, ?, ?)",
+                (model, key, response, time.time())
+            )
+            conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of cache hits and misses since the cache was created."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """Close the underlying database connection, if open."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
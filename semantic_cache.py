@@ -0,0 +1,112 @@
+import logging
+import threading
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+import orjson
+
+class SemanticCache:
+    """
+    Store of LLM responses matched by prompt embedding similarity.
+
+    Complements ResponseCache: a prompt whose embedding has cosine similarity
+    of at least threshold with a stored prompt for the same model reuses that
+    prompt's response. Entries are persisted to a .npz file, loaded on first use
+    and written by flush.
+    """
+
+    def __init__(self, path: Path, threshold: float):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.hits = 0
+        # Embeddings are rows of a buffer that grows by doubling; only the first _count rows are entries
+        self._vectors: Optional[np.ndarray] = None
+        self._count = 0
+        self._models: List[str] = []
+        self._responses: List[str] = []
+        # Whether entries were added since the cache was last loaded or written
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._vectors is not None:
+            return
+        if self.path.exists():
+            with np.load(self.path) as data:
+                self._vectors = data['vectors']
+                self._models = self._load_strings(data['models'])
+                self._responses = self._load_strings(data['responses'])
+            self._count = len(self._responses)
+            logging.info(f"Loaded {self._count} entries from semantic cache at {self.path}")
+        else:
+            self._vectors = np.empty((0, 0), dtype=np.float32)
+
+    @staticmethod
+    def _load_strings(array: np.ndarray) -> List[str]:
+        # Strings are stored as UTF-8 JSON bytes; caches written before that hold fixed-width unicode arrays
+        if array.dtype.kind == 'U':
+            return array.tolist()
+        return orjson.loads(array.tobytes())
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, model: str, vector) -> Optional[str]:
+        """
+        Return the response of the most similar stored prompt for model, if similar enough.
+
+        Args:
+        model (str): The model the response must come from.
+        vector: The embedding of the prompt.
+
+        Returns:
+        Optional[str]: The cached response, or None if no stored prompt reaches the threshold.
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            self._load()
+            if not self._count or self._vectors.shape[1] != query.shape[0]:
+                return None
+            similarities = self._vectors[:self._count] @ query
+            similarities[np.asarray(self._models) != model] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self.hits += 1
+            logging.info(f"Semantic cache hit with similarity {similarities[best]:.3f}")
+            return self._responses[best]
+
+    def add(self, model: str, vector, response: str):
+        """Store a response under the embedding of its prompt; flush persists it."""
+        query = self._normalize(vector)
+        with self._lock:
+            self._load()
+            if self._count and self._vectors.shape[1] != query.shape[0]:
+                logging.warning("Embedding dimension changed; discarding existing semantic cache entries")
+                self._models, self._responses, self._count = [], [], 0
+            if not self._count or self._vectors.shape[1] != query.shape[0]:
+                self._vectors = np.empty((16, query.shape[0]), dtype=np.float32)
+            elif self._count == len(self._vectors):
+                grown = np.empty((2 * len(self._vectors), query.shape[0]), dtype=np.float32)
+                grown[:self._count] = self._vectors[:self._count]
+                self._vectors = grown
+            self._vectors[self._count] = query
+            self._count += 1
+            self._models.append(model)
+            self._responses.append(response)
+            self._dirty = True
+
+    def flush(self):
+        """Write the entries to the cache file, if any were added since it was last loaded or written."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'wb') as f:
+                np.savez(f, vectors=self._vectors[:self._count],
+                         models=np.frombuffer(orjson.dumps(self._models), dtype=np.uint8),
+                         responses=np.frombuffer(orjson.dumps(self._responses), dtype=np.uint8))
+            self._dirty = False
@@ -1,25 +1,48 @@
 import unittest
 from unittest.mock import Mock, patch, mock_open, MagicMock
+from contextlib import ExitStack
 from pathlib import Path
-import pandas as pd
 import json
+import tempfile
 from automated_data_scientist import AutomatedDataScientist
 
+COMPONENTS = ('DataHandler', 'AnalysisPlanner', 'CodeGenerator', 'CodeExecutor', 'ResultInterpreter', 'NotebookManager')
+
+def _mock_data_sample():
+    # The pipeline only passes the sample through to mocked components, so a DataFrame spec is not needed
+    sample = MagicMock()
+    sample.shape = (100, 10)
+    return sample
+
 class TestAutomatedDataScientist(unittest.TestCase):
     def setUp(self):
         self.test_csv_path = 'test_data.csv'
-        self.test_output_path = 'test_output'
         self.test_data_dict_path = 'test_data_dict.json'
+        # Keep steps/, the response cache and the notebook out of the real output directory
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.test_output_path = temp_dir.name
+        # No test may reach the network or need API keys
+        api_client_patcher = patch('automated_data_scientist.APIClient')
+        api_client_patcher.start()
+        self.addCleanup(api_client_patcher.stop)
+
+    def _patch_components(self):
+        """Patch all six pipeline components for the rest of the test and return their mocks by class name."""
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        return {name: stack.enter_context(patch(f'automated_data_scientist.{name}'))
+                for name in COMPONENTS}
+
+    def test_initialization(self):
+        mocks = self._patch_components()
+        mock_data_handler = mocks['DataHandler']
+        mock_analysis_planner = mocks['AnalysisPlanner']
+        mock_code_generator = mocks['CodeGenerator']
+        mock_code_executor = mocks['CodeExecutor']
+        mock_result_interpreter = mocks['ResultInterpreter']
+        mock_notebook_manager = mocks['NotebookManager']
 
-    @patch('automated_data_scientist.DataHandler')
-    @patch('automated_data_scientist.AnalysisPlanner')
-    @patch('automated_data_scientist.CodeGenerator')
-    @patch('automated_data_scientist.CodeExecutor')
-    @patch('automated_data_scientist.ResultInterpreter')
-    @patch('automated_data_scientist.NotebookManager')
-    def test_initialization(self, mock_notebook_manager, mock_result_interpreter, 
-                            mock_code_executor, mock_code_generator, 
-                            mock_analysis_planner, mock_data_handler):
         ads = AutomatedDataScientist(
             production_csv_path=self.test_csv_path,
             output_path=self.test_output_path,
@@ -29,7 +52,15 @@ class TestAutomatedDataScientist(unittest.TestCase):
         self.assertEqual(ads.production_csv_path, Path(self.test_csv_path))
         self.assertEqual(ads.output_path, Path(self.test_output_path))
         self.assertEqual(ads.data_dict_path, Path(self.test_data_dict_path))
-        
+
+        # Components are only created when first used
+        mock_data_handler.assert_not_called()
+        mock_code_generator.assert_not_called()
+
+        for name in ('data_handler', 'analysis_planner', 'code_generator',
+                     'code_executor', 'result_interpreter', 'notebook_manager'):
+            self.assertIs(getattr(ads, name), getattr(ads, name))
+
         mock_data_handler.assert_called_once()
         mock_analysis_planner.assert_called_once()
         mock_code_generator.assert_called_once()
@@ -37,19 +68,29 @@ class TestAutomatedDataScientist(unittest.TestCase):
         mock_result_interpreter.assert_called_once()
         mock_notebook_manager.assert_called_once()
 
-    @patch('automated_data_scientist.DataHandler')
+    @patch('automated_data_scientist.APIClient')
     @patch('automated_data_scientist.AnalysisPlanner')
-    @patch('automated_data_scientist.CodeGenerator')
-    @patch('automated_data_scientist.CodeExecutor')
-    @patch('automated_data_scientist.ResultInterpreter')
-    @patch('automated_data_scientist.NotebookManager')
-    @patch('pandas.read_csv')
-    def test_run_method(self, mock_read_csv, mock_notebook_manager, mock_result_interpreter, 
-                        mock_code_executor, mock_code_generator, 
-                        mock_analysis_planner, mock_data_handler):
-        mock_df = MagicMock(spec=pd.DataFrame)
-        mock_df.shape = (100, 10)
-        mock_read_csv.return_value = mock_df
+    def test_injected_code_generator_shares_api_client(self, mock_analysis_planner, mock_api_client):
+        code_generator = MagicMock()
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path,
+                                     code_generator=code_generator)
+
+        self.assertIs(ads.api_client, code_generator.api_client)
+        ads.analysis_planner
+        mock_analysis_planner.assert_called_once_with(code_generator.api_client, Path(self.test_output_path))
+        mock_api_client.assert_not_called()
+
+    @patch('automated_data_scientist.AutomatedDataScientist._count_csv_rows', return_value=100)
+    def test_run_method(self, mock_count_rows):
+        mocks = self._patch_components()
+        data_handler = mocks['DataHandler'].return_value
+        analysis_planner = mocks['AnalysisPlanner'].return_value
+        code_generator = mocks['CodeGenerator'].return_value
+        code_executor = mocks['CodeExecutor'].return_value
+        result_interpreter = mocks['ResultInterpreter'].return_value
+        notebook_manager = mocks['NotebookManager'].return_value
+
+        mock_df = _mock_data_sample()
 
         ads = AutomatedDataScientist(
             production_csv_path=self.test_csv_path,
@@ -57,137 +98,238 @@ class TestAutomatedDataScientist(unittest.TestCase):
             data_dict_path=self.test_data_dict_path
         )
         
-        mock_data_handler().initialize_data.return_value = None
-        mock_data_handler().production_data_sample = mock_df
-        mock_data_handler().data_dict = {}
-        mock_data_handler().data_dict_content = ''
-        mock_analysis_planner().generate_initial_plan.return_value = [{'name': 'Test Analysis'}]
-        mock_analysis_planner().enhance_analysis_plan.return_value = [{'name': 'Enhanced Test Analysis'}]
-        mock_code_generator().generate_code.return_value = 'print("Test")'
-        mock_code_executor().execute_code.return_value = ('Result', 'Output', [])
-        mock_result_interpreter().interpret_results.return_value = 'Interpretation'
-        mock_result_interpreter().extract_key_findings.return_value = ['Finding']
-        mock_result_interpreter().generate_summary_report.return_value = "Mock Report"
-
-        with patch('builtins.open', mock_open()) as mock_file:
+        data_handler.initialize_data.return_value = None
+        data_handler.production_data_sample = mock_df
+        data_handler.data_dict = {}
+        data_handler.data_dict_content = ''
+        analysis_planner.generate_initial_plan.return_value = [{'name': 'Test Analysis', 'status': 'pending'}]
+        analysis_planner.enhance_analysis_plan.return_value = [{'name': 'Enhanced Test Analysis', 'status': 'pending'}]
+        # Pregenerated code without an interpretation template is interpreted by a separate call
+        code_generator.generate_code_batch.return_value = [('print("Test")', '')]
+        code_executor.execute_code.return_value = ('Result', 'Output', [])
+        result_interpreter.interpret_all.return_value = ('Interpretation', ['Finding'])
+        result_interpreter.stream_summary_report.return_value = iter(["Mock Report"])
+
+        with patch('builtins.open', mock_open()):
             ads.run()
-        
-        mock_data_handler().initialize_data.assert_called_once()
-        mock_analysis_planner().generate_initial_plan.assert_called_once()
-        mock_analysis_planner().enhance_analysis_plan.assert_called_once()
-        mock_code_generator().generate_code.assert_called_once()
-        mock_code_executor().execute_code.assert_called_once()
-        mock_result_interpreter().interpret_results.assert_called_once()
-        mock_notebook_manager().add_analysis_step.assert_called_once()
-        mock_notebook_manager().save_notebook.assert_called_once()
-
-    @patch('pandas.read_csv')
-    def test_full_data_row_count(self, mock_read_csv):
-        mock_df = MagicMock(spec=pd.DataFrame)
-        mock_df.shape = (100, 10)
-        mock_read_csv.return_value = mock_df
-
-        with patch('automated_data_scientist.AnalysisPlanner') as mock_planner, \
-             patch('automated_data_scientist.DataHandler') as mock_data_handler, \
-             patch('builtins.open', mock_open()):
-            mock_data_handler().production_data_sample = mock_df
-            ads = AutomatedDataScientist(production_csv_path=self.test_csv_path)
+
+        data_handler.initialize_data.assert_called_once()
+        analysis_planner.generate_initial_plan.assert_called_once()
+        analysis_planner.enhance_analysis_plan.assert_called_once()
+        code_generator.generate_code_batch.assert_called_once()
+        code_executor.execute_code.assert_called_once()
+        # One call returns both the interpretation and the key findings
+        result_interpreter.interpret_all.assert_called_once()
+        result_interpreter.interpret_results.assert_not_called()
+        result_interpreter.extract_key_findings.assert_not_called()
+        self.assertEqual(ads.key_findings, ['Finding'])
+        notebook_manager.add_analysis_step.assert_called_once()
+        notebook_manager.save_notebook.assert_called_once()
+
+    @patch('automated_data_scientist.AutomatedDataScientist._count_csv_rows', return_value=100)
+    def test_full_data_row_count(self, mock_count_rows):
+        mocks = self._patch_components()
+        mock_planner = mocks['AnalysisPlanner']
+        mocks['DataHandler']().production_data_sample = _mock_data_sample()
+
+        with patch('builtins.open', mock_open()):
+            ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path)
             ads.run()
 
-            mock_read_csv.assert_called_once_with(Path(self.test_csv_path))
+            mock_count_rows.assert_called_once()
             mock_planner().generate_initial_plan.assert_called_once()
             self.assertEqual(mock_planner().generate_initial_plan.call_args[0][2], 100)
 
-    @patch('automated_data_scientist.CodeExecutor')
-    @patch('pandas.read_csv')
-    @patch('automated_data_scientist.AnalysisPlanner')
-    @patch('automated_data_scientist.DataHandler')
-    @patch('automated_data_scientist.CodeGenerator')
-    @patch('automated_data_scientist.ResultInterpreter')
-    @patch('automated_data_scientist.NotebookManager')
-    def test_code_execution_retry(self, mock_notebook_manager, mock_result_interpreter, 
-                                  mock_code_generator, mock_data_handler, mock_analysis_planner, 
-                                  mock_read_csv, mock_code_executor):
-        mock_df = MagicMock(spec=pd.DataFrame)
-        mock_df.shape = (100, 10)
-        mock_read_csv.return_value = mock_df
-
-        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path)
+    @patch('automated_data_scientist.AutomatedDataScientist._count_csv_rows', return_value=100)
+    def test_code_execution_retry(self, mock_count_rows):
+        mocks = self._patch_components()
+        data_handler = mocks['DataHandler'].return_value
+        analysis_planner = mocks['AnalysisPlanner'].return_value
+        code_generator = mocks['CodeGenerator'].return_value
+        code_executor = mocks['CodeExecutor'].return_value
+        result_interpreter = mocks['ResultInterpreter'].return_value
+
+        mock_df = _mock_data_sample()
+
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path)
         
-        mock_data_handler().production_data_sample = mock_df
-        mock_data_handler().data_dict = {}
-        mock_data_handler().data_dict_content = ''
+        data_handler.production_data_sample = mock_df
+        data_handler.data_dict = {}
+        data_handler.data_dict_content = ''
         
         initial_plan = [{'name': 'Test Analysis', 'status': 'pending'}]
-        mock_analysis_planner().generate_initial_plan.return_value = initial_plan
-        mock_analysis_planner().enhance_analysis_plan.return_value = initial_plan
-        mock_analysis_planner().update_plan.return_value = initial_plan
+        analysis_planner.generate_initial_plan.return_value = initial_plan
+        analysis_planner.enhance_analysis_plan.return_value = initial_plan
+        analysis_planner.update_plan.return_value = initial_plan
         
-        mock_code_generator().generate_code.return_value = 'print("Test")'
+        code_generator.generate_code_and_interpretation_scaffold.return_value = ('print("Test")', 'Stub {result}')
         
-        mock_result_interpreter().interpret_results.return_value = 'Interpretation'
-        mock_result_interpreter().extract_key_findings.return_value = ['Finding']
-        mock_result_interpreter().generate_summary_report.return_value = "Mock Report"
+        result_interpreter.interpret_all.return_value = ('Interpretation', ['Finding'])
+        result_interpreter.stream_summary_report.return_value = iter(["Mock Report"])
+
+        outcomes = iter([Exception("Failure 1"), Exception("Failure 2"), ('Result', 'Output', [])])
 
         def execute_code_side_effect(*args, **kwargs):
-            if mock_code_executor().execute_code.call_count < 3:
-                raise Exception(f"Failure {mock_code_executor().execute_code.call_count}")
-            else:
-                initial_plan[0]['status'] = 'completed'
-                return ('Result', 'Output', [])
+            outcome = next(outcomes)
+            if isinstance(outcome, Exception):
+                raise outcome
+            initial_plan[0]['status'] = 'completed'
+            return outcome
 
-        mock_code_executor().execute_code.side_effect = execute_code_side_effect
+        code_executor.execute_code.side_effect = execute_code_side_effect
 
         with patch('builtins.open', mock_open()):
             ads.run()
 
-        self.assertEqual(mock_code_executor().execute_code.call_count, 3)
+        self.assertEqual(code_executor.execute_code.call_count, 3)
         self.assertEqual(initial_plan[0]['status'], 'completed')
+        result_interpreter.interpret_all.assert_called_once()
+        result_interpreter.extract_key_findings.assert_not_called()
 
-    def test_save_progress(self):
-        ads = AutomatedDataScientist(output_path=self.test_output_path)
-        ads.analysis_plan = [{'name': 'Test Analysis'}]
-        ads.completed_analyses = [{'name': 'Completed Analysis'}]
-        ads.key_findings = ['Key Finding']
+    @patch('automated_data_scientist.AutomatedDataScientist._count_csv_rows', return_value=100)
+    def test_run_uses_pregenerated_interpretation_scaffold(self, mock_count_rows):
+        mocks = self._patch_components()
+        data_handler = mocks['DataHandler'].return_value
+        analysis_planner = mocks['AnalysisPlanner'].return_value
+        code_generator = mocks['CodeGenerator'].return_value
+        code_executor = mocks['CodeExecutor'].return_value
+        result_interpreter = mocks['ResultInterpreter'].return_value
 
-        mock_open_func = mock_open()
-        with patch('builtins.open', mock_open_func):
-            ads.save_progress()
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path)
 
-        mock_open_func.assert_called_once_with(Path(self.test_output_path) / "progress_snapshot.json", 'w', encoding='utf-8')
-        handle = mock_open_func()
-        handle.write.assert_called()
-        written_data = ''.join(call.args[0] for call in handle.write.call_args_list)
-        self.assertIn('"analysis_plan":', written_data)
-        self.assertIn('"completed_analyses":', written_data)
-        self.assertIn('"key_findings":', written_data)
+        data_handler.production_data_sample = _mock_data_sample()
+        plan = [{'name': 'Test Analysis', 'status': 'pending'}]
+        analysis_planner.generate_initial_plan.return_value = plan
+        analysis_planner.enhance_analysis_plan.return_value = plan
+        analysis_planner.update_plan.return_value = plan
+        # Pregeneration returns the code and interpretation template of each pending analysis
+        code_generator.generate_code_batch.return_value = [('print("Test")', 'Mean is {result}')]
+        code_executor.execute_code.return_value = (42, 'Output', [])
+        result_interpreter.extract_key_findings.return_value = ['Finding']
+        result_interpreter.stream_summary_report.return_value = iter(["Mock Report"])
 
+        with patch('builtins.open', mock_open()):
+            ads.run()
+
+        code_generator.generate_code_and_interpretation_scaffold.assert_not_called()
+        code_executor.execute_code.assert_called_once_with('print("Test")', data_handler.production_data_sample)
+        result_interpreter.interpret_all.assert_not_called()
+        result_interpreter.extract_key_findings.assert_called_once_with('Mean is 42')
+        self.assertEqual(ads.key_findings, ['Finding'])
+
+    @patch('automated_data_scientist.CodeExecutor')
     @patch('automated_data_scientist.CodeGenerator')
-    def test_code_generation(self, mock_code_generator):
-        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path)
-        
-        ads.data_handler = MagicMock()
-        ads.data_handler.data_dict = {'column1': 'int', 'column2': 'string'}
-        ads.data_handler.data_dict_content = 'Sample data dictionary content'
-        ads.analysis_plan = [{'name': 'Test Analysis', 'type': 'descriptive'}]
-
-        mock_code_generator().generate_code.return_value = 'print("Generated Code")'
-
-        code = ads.code_generator.generate_code(
-            ads.analysis_plan[0],
-            ads.data_handler.data_dict,
-            ads.analysis_plan,
-            ads.data_handler.data_dict_content
-        )
+    @patch('automated_data_scientist.ResultInterpreter')
+    @patch('automated_data_scientist.NotebookManager')
+    def test_interpretation_scaffold_used_on_first_success(self, mock_notebook_manager, mock_result_interpreter,
+                                                           mock_code_generator, mock_code_executor):
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path,
+                                     data_handler=MagicMock())
+        analysis = {'name': 'Test Analysis', 'status': 'pending'}
+        ads.analysis_plan = [analysis]
+        ads.analysis_planner = MagicMock()
+        ads._full_row_count = 100
 
-        mock_code_generator().generate_code.assert_called_once_with(
-            ads.analysis_plan[0],
-            ads.data_handler.data_dict,
-            ads.analysis_plan,
-            ads.data_handler.data_dict_content
-        )
+        mock_code_generator().generate_code_and_interpretation_scaffold.return_value = ('print("Test")', 'Mean is {result}')
+        mock_code_executor().execute_code.return_value = (42, 'Output', [])
+        mock_result_interpreter().extract_key_findings.return_value = []
+
+        ads.execute_single_analysis(analysis)
+
+        mock_result_interpreter().interpret_all.assert_not_called()
+        mock_code_generator().generate_code.assert_not_called()
+        self.assertEqual(analysis['interpretation'], 'Mean is 42')
+
+    @patch('automated_data_scientist.CodeExecutor')
+    @patch('automated_data_scientist.CodeGenerator')
+    @patch('automated_data_scientist.ResultInterpreter')
+    @patch('automated_data_scientist.NotebookManager')
+    def test_interpretation_scaffold_not_used_after_failed_execution(self, mock_notebook_manager, mock_result_interpreter,
+                                                                     mock_code_generator, mock_code_executor):
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path,
+                                     data_handler=MagicMock())
+        analysis = {'name': 'Test Analysis', 'status': 'pending'}
+        ads.analysis_plan = [analysis]
+        ads.analysis_planner = MagicMock()
+        ads._full_row_count = 100
+
+        # execute_code reports errors in its output instead of raising them
+        mock_code_executor().execute_code.side_effect = [
+            (None, 'Error during code execution: division by zero', []),
+            (42, 'Output', [])
+        ]
+        mock_code_generator().generate_code_and_interpretation_scaffold.return_value = ('print("Test")', 'Mean is {result}')
+        mock_code_generator().refine_code.return_value = 'print("Fixed")'
+        mock_result_interpreter().interpret_all.return_value = ('Interpretation', ['Finding'])
+
+        ads.execute_single_analysis(analysis)
+
+        mock_code_generator().refine_code.assert_called_once()
+        self.assertEqual(mock_code_generator().refine_code.call_args.kwargs['error_message'],
+                         'Error during code execution: division by zero')
+        mock_result_interpreter().interpret_all.assert_called_once()
+        mock_result_interpreter().extract_key_findings.assert_not_called()
+        self.assertEqual(analysis['interpretation'], 'Interpretation')
+        self.assertEqual(analysis['status'], 'completed')
+
+    @patch('automated_data_scientist.CodeExecutor')
+    @patch('automated_data_scientist.CodeGenerator')
+    @patch('automated_data_scientist.ResultInterpreter')
+    @patch('automated_data_scientist.NotebookManager')
+    def test_repeated_failure_stops_refinement(self, mock_notebook_manager, mock_result_interpreter,
+                                               mock_code_generator, mock_code_executor):
+        ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=self.test_output_path,
+                                     data_handler=MagicMock())
+        analysis = {'name': 'Test Analysis', 'status': 'pending'}
+        ads.analysis_plan = [analysis]
+        ads.analysis_planner = MagicMock()
+        ads._full_row_count = 100
+
+        # Refinement hands back the same code, which fails with the same error.
+        # execute_code reports the error in its output rather than raising it.
+        mock_code_generator().refine_code.return_value = 'print("Test")'
+        mock_code_executor().execute_code.return_value = (None, 'Error during code execution: Same failure', [])
+        mock_result_interpreter().interpret_all.return_value = ('Interpretation', [])
+
+        ads.execute_single_analysis(analysis, 'print("Test")')
+
+        self.assertEqual(mock_code_executor().execute_code.call_count, 2)
+        mock_code_generator().refine_code.assert_called_once()
+        self.assertEqual(mock_code_generator().refine_code.call_args.kwargs['error_message'],
+                         'Error during code execution: Same failure')
+        self.assertEqual(analysis['status'], 'pending')
+
+    @patch('automated_data_scientist.ResultInterpreter')
+    @patch('automated_data_scientist.NotebookManager')
+    def test_completed_analysis_record_saved_to_disk(self, mock_notebook_manager, mock_result_interpreter):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ads = AutomatedDataScientist(production_csv_path=self.test_csv_path, output_path=temp_dir)
+            ads.analysis_planner = MagicMock()
+            analysis = {'name': 'Test Analysis', 'result': 42, 'output': 'Output', 'interpretation': 'Interpretation'}
+
+            ads._record_analysis(analysis, 'print("Test")', ['Finding'])
+
+            record = json.loads((Path(temp_dir) / 'steps' / '0.json').read_text())
+            self.assertEqual(record['result'], 42)
+            self.assertEqual(record['code'], 'print("Test")')
+            self.assertNotIn('result', ads.completed_analyses[0])
+            self.assertNotIn('output', analysis)
+            self.assertEqual(ads.completed_analyses[0]['interpretation'], 'Interpretation')
+            self.assertEqual(ads.key_findings, ['Finding'])
+
+    def test_count_csv_rows(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            csv_path = Path(temp_dir) / 'data.csv'
+            ads = AutomatedDataScientist(production_csv_path=csv_path, output_path=temp_dir)
+
+            csv_path.write_bytes(b'a,b\n1,2\n3,4')
+            self.assertEqual(ads._count_csv_rows(), 2)
 
-        self.assertEqual(code, 'print("Generated Code")')
+            # The count is cached after the first pass over the file
+            csv_path.write_bytes(b'a,b\n1,2\n3,4\n5,6\n')
+            self.assertEqual(ads._count_csv_rows(), 2)
+            ads._full_row_count = None
+            self.assertEqual(ads._count_csv_rows(), 3)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,33 @@
+import unittest
+import tempfile
+from pathlib import Path
+import pandas as pd
+from data_handling import DataHandler
+
+class TestDataHandler(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = Path(self.temp_dir.name) / 'data.csv'
+        rows = [
+            'id,name,signup_date,last_seen,score',
+            '1,Alice,2024-01-05,2024-01-05T10:00:00,3.5',
+            '2,,2024-02-11,,',
+            '3,Carol,,2024-03-01T08:30:00,1.0',
+            '4,Dave,2024-04-20,2024-04-20T12:15:00,2.25',
+        ]
+        self.csv_path.write_text('\n'.join(rows) + '\n', encoding='utf-8')
+        self.data_handler = DataHandler(Path(self.temp_dir.name) / 'dict.md', self.csv_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_read_csv_head_matches_read_csv(self):
+        sample = self.data_handler._read_csv_head(3)
+        expected = pd.read_csv(self.csv_path, nrows=3)
+
+        self.assertEqual(len(sample), 3)
+        self.assertEqual(sample.dtypes.to_dict(), expected.dtypes.to_dict())
+        self.assertEqual(sample.isna().sum().to_dict(), expected.isna().sum().to_dict())
+
+if __name__ == '__main__':
+    unittest.main()
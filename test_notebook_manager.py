@@ -1,42 +1,108 @@
 import unittest
+import tempfile
+from pathlib import Path
 from unittest.mock import patch, mock_open, MagicMock
 import nbformat
 from notebook_manager import NotebookManager
 
 class TestNotebookManager(unittest.TestCase):
     def setUp(self):
-        self.notebook_path = 'test_notebook.ipynb'
-        with patch('notebook_manager.config.NOTEBOOK_PATH', self.notebook_path):
-            self.notebook_manager = NotebookManager()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.notebook_path = str(Path(self.temp_dir.name) / 'test_notebook.ipynb')
+        self.notebook_manager = NotebookManager(self.notebook_path)
 
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('notebook_manager.os.replace')
     @patch('nbformat.writes')
-    def test_save_notebook(self, mock_writes):
+    def test_save_notebook(self, mock_writes, mock_replace):
         mock_writes.return_value = '{"cells": []}'
         
         with patch('builtins.open', mock_open()) as mock_file:
             self.notebook_manager.save_notebook()
 
-        mock_writes.assert_called_once_with(self.notebook_manager.notebook)
-        mock_file.assert_called_once_with(self.notebook_path, 'w', encoding='utf-8')
+        mock_writes.assert_called_once_with(self.notebook_manager.notebook, version=4, capture_validation_error={})
+        tmp_path = f"{self.notebook_path}.tmp"
+        mock_file.assert_called_once_with(tmp_path, 'w', encoding='utf-8')
         mock_file().write.assert_called_once_with('{"cells": []}')
+        mock_replace.assert_called_once_with(tmp_path, self.notebook_path)
 
-    def test_add_markdown_cell(self):
-        initial_cell_count = len(self.notebook_manager.notebook.cells)
-        markdown_content = "Test Markdown"
-        self.notebook_manager.add_markdown_cell(markdown_content)
-        
-        self.assertEqual(len(self.notebook_manager.notebook.cells), initial_cell_count + 1)
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].source, f"## {markdown_content}")
+    @patch('notebook_manager.os.replace')
+    @patch('nbformat.writes')
+    def test_save_notebook_skips_unchanged_notebook(self, mock_writes, mock_replace):
+        mock_writes.return_value = '{"cells": []}'
 
-    def test_add_code_cell(self):
-        initial_cell_count = len(self.notebook_manager.notebook.cells)
-        code_content = "print('Hello, World!')"
-        self.notebook_manager.add_code_cell(code_content)
-        
-        self.assertEqual(len(self.notebook_manager.notebook.cells), initial_cell_count + 1)
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].cell_type, 'code')
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].source, code_content)
+        with patch('builtins.open', mock_open()):
+            self.notebook_manager.save_notebook()
+            self.notebook_manager.save_notebook()
+            self.assertEqual(mock_writes.call_count, 1)
+
+            self.notebook_manager.add_code_cell("print(1)")
+            self.notebook_manager.save_notebook()
+            self.assertEqual(mock_writes.call_count, 2)
+
+    def test_save_notebook_does_not_write_invalid_notebook(self):
+        self.notebook_manager.notebook.cells[0]['cell_type'] = 'unknown'
+
+        with patch('notebook_manager.logging.error') as mock_error:
+            self.notebook_manager.save_notebook()
+
+        self.assertFalse(Path(self.notebook_path).exists())
+        self.assertIn("Validation error", mock_error.call_args[0][0])
+
+    def test_journal_appends_cells_and_recovers_notebook(self):
+        journal_path = self.notebook_manager.journal_path
+        self.notebook_manager.add_analysis_step("Step 1", "desc", "goals", "print(1)")
+        self.notebook_manager.add_analysis_step("Step 2", "desc", "goals", "print(2)")
+        self.notebook_manager.flush()
+
+        with open(journal_path, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), len(self.notebook_manager.notebook.cells))
+
+        recovered = NotebookManager(self.notebook_path)
+        self.assertTrue(recovered.recover_notebook())
+        self.assertEqual(recovered.notebook.cells, self.notebook_manager.notebook.cells)
+        self.assertTrue(Path(self.notebook_path).exists())
+        self.assertFalse(journal_path.exists())
+
+    def test_interrupted_run_is_recovered_before_journal_restarts(self):
+        self.notebook_manager.add_analysis_step("Step 1", "desc", "goals", "print(1)")
+        self.notebook_manager.flush()
+        interrupted_sources = [cell.source for cell in self.notebook_manager.notebook.cells]
+
+        next_run = NotebookManager(self.notebook_path)
+        next_run.add_analysis_step("Step 2", "desc", "goals", "print(2)")
+        next_run.flush()
+
+        recovered_path = Path(self.notebook_path).with_suffix('.recovered.ipynb')
+        recovered = nbformat.read(recovered_path, as_version=4)
+        self.assertEqual([cell.source for cell in recovered.cells], interrupted_sources)
+        with open(next_run.journal_path, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), len(next_run.notebook.cells))
+
+    def test_get_notebook_json_reuses_result_until_cells_change(self):
+        notebook_json = self.notebook_manager.get_notebook_json()
+        self.assertIs(self.notebook_manager.get_notebook_json(), notebook_json)
+
+        self.notebook_manager.add_code_cell("print(1)")
+        updated_json = self.notebook_manager.get_notebook_json()
+        self.assertIsNot(updated_json, notebook_json)
+        self.assertEqual(len(updated_json['cells']), len(notebook_json['cells']) + 1)
+
+    def test_add_cell(self):
+        cases = [
+            (self.notebook_manager.add_markdown_cell, "Test Markdown", 'markdown', "## Test Markdown"),
+            (self.notebook_manager.add_code_cell, "print('Hello, World!')", 'code', "print('Hello, World!')"),
+        ]
+        for add_cell, content, cell_type, source in cases:
+            with self.subTest(cell_type=cell_type):
+                initial_cell_count = len(self.notebook_manager.notebook.cells)
+                add_cell(content)
+
+                self.assertEqual(len(self.notebook_manager.notebook.cells), initial_cell_count + 1)
+                self.assertEqual(self.notebook_manager.notebook.cells[-1].cell_type, cell_type)
+                self.assertEqual(self.notebook_manager.notebook.cells[-1].source, source)
 
     def test_add_analysis_step(self):
         initial_cell_count = len(self.notebook_manager.notebook.cells)
@@ -47,20 +113,15 @@ class TestNotebookManager(unittest.TestCase):
 
         self.notebook_manager.add_analysis_step(step_name, step_description, step_goals, code)
 
-        self.assertEqual(len(self.notebook_manager.notebook.cells), initial_cell_count + 6)
-        self.assertEqual(self.notebook_manager.notebook.cells[-6].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-5].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-4].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-3].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-2].cell_type, 'markdown')
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].cell_type, 'code')
-
-        self.assertIn(step_name, self.notebook_manager.notebook.cells[-6].source)
-        self.assertIn("Description:", self.notebook_manager.notebook.cells[-5].source)
-        self.assertIn(step_description, self.notebook_manager.notebook.cells[-4].source)
-        self.assertIn("Goals:", self.notebook_manager.notebook.cells[-3].source)
-        self.assertIn(step_goals, self.notebook_manager.notebook.cells[-2].source)
-        self.assertEqual(self.notebook_manager.notebook.cells[-1].source, code)
+        cells = self.notebook_manager.notebook.cells
+        self.assertEqual(len(cells), initial_cell_count + 6)
+        expected = [('markdown', step_name), ('markdown', "Description:"), ('markdown', step_description),
+                    ('markdown', "Goals:"), ('markdown', step_goals), ('code', code)]
+        for cell, (cell_type, content) in zip(cells[-6:], expected):
+            with self.subTest(content=content):
+                self.assertEqual(cell.cell_type, cell_type)
+                self.assertIn(content, cell.source)
+        self.assertEqual(cells[-1].source, code)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,57 @@
+import unittest
+import asyncio
+from unittest.mock import patch
+from rate_limiter import RateLimiter
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst_up_to_max_rate_does_not_wait(self):
+        async def run():
+            limiter = RateLimiter(max_rate=3, time_period=60)
+            with patch('rate_limiter.asyncio.sleep') as mock_sleep:
+                for _ in range(3):
+                    async with limiter:
+                        pass
+                mock_sleep.assert_not_called()
+
+        asyncio.run(run())
+
+    def test_waits_for_token_when_bucket_is_empty(self):
+        async def run():
+            limiter = RateLimiter(max_rate=2, time_period=60)
+            sleeps = []
+
+            async def fake_sleep(seconds):
+                sleeps.append(seconds)
+
+            with patch('rate_limiter.asyncio.sleep', side_effect=fake_sleep):
+                for _ in range(3):
+                    await limiter.acquire_async()
+            self.assertEqual(len(sleeps), 1)
+            self.assertAlmostEqual(sleeps[0], 30, delta=0.5)
+
+        asyncio.run(run())
+
+    def test_budget_is_shared_by_sync_calls_and_event_loops(self):
+        limiter = RateLimiter(max_rate=2, time_period=60)
+        with patch('rate_limiter.time.sleep') as mock_sleep:
+            with limiter:
+                pass
+        mock_sleep.assert_not_called()
+
+        async def run():
+            async with limiter:
+                pass
+
+        sleeps = []
+
+        async def fake_sleep(seconds):
+            sleeps.append(seconds)
+
+        with patch('rate_limiter.asyncio.sleep', side_effect=fake_sleep):
+            asyncio.run(run())
+            asyncio.run(run())
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 30, delta=0.5)
+
+if __name__ == '__main__':
+    unittest.main()
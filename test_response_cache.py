@@ -0,0 +1,76 @@
+import unittest
+import tempfile
+import time
+from unittest.mock import patch
+from pathlib import Path
+from response_cache import ResponseCache
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.temp_dir.name) / 'cache' / 'llm_cache.sqlite'
+        self.cache = ResponseCache(self.db_path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.temp_dir.cleanup()
+
+    def test_database_created_lazily(self):
+        self.assertFalse(self.db_path.exists())
+        self.cache.get('model', 'key')
+        self.assertTrue(self.db_path.exists())
+
+    def test_set_and_get(self):
+        key = self.cache.make_key("prompt", 1000, False)
+        self.assertIsNone(self.cache.get('gpt', key))
+
+        self.cache.set('gpt', key, 'response')
+
+        self.assertEqual(self.cache.get('gpt', key), 'response')
+        self.assertIsNone(self.cache.get('claude', key))
+
+    def test_key_depends_on_request_parameters(self):
+        base_key = self.cache.make_key("prompt", 1000, False)
+        self.assertEqual(base_key, self.cache.make_key("prompt", 1000, False))
+        self.assertNotEqual(base_key, self.cache.make_key("prompt", 500, False))
+        self.assertNotEqual(base_key, self.cache.make_key("prompt", 1000, True))
+        self.assertNotEqual(base_key, self.cache.make_key("other prompt", 1000, False))
+        self.assertNotEqual(base_key, self.cache.make_key("prompt", 1000, False, "system prompt"))
+
+    def test_key_ignores_prompt_margin(self):
+        key = self.cache.make_key('Fix this code:\nif x:\n    y()', 1000, False)
+        indented_key = self.cache.make_key('\n    Fix this code:\n    if x:\n        y()\n    ', 1000, False)
+        self.assertEqual(key, indented_key)
+        self.assertEqual(len(key), 16)
+
+    def test_key_keeps_internal_whitespace(self):
+        nested_key = self.cache.make_key('Fix this code:\nif x:\n    y()\n    z()', 1000, False)
+        dedented_key = self.cache.make_key('Fix this code:\nif x:\n    y()\nz()', 1000, False)
+        self.assertNotEqual(nested_key, dedented_key)
+
+    def test_expired_entries_are_misses(self):
+        key = self.cache.make_key("prompt", 1000, False)
+        self.cache.set('gpt', key, 'response')
+
+        expiring_cache = ResponseCache(self.db_path, ttl=60)
+        try:
+            self.assertEqual(expiring_cache.get('gpt', key), 'response')
+            with patch('response_cache.time.time', return_value=time.time() + 120):
+                self.assertIsNone(expiring_cache.get('gpt', key))
+            self.assertEqual(expiring_cache.stats(), {'hits': 1, 'misses': 1})
+        finally:
+            expiring_cache.close()
+
+    def test_entries_persist_across_instances(self):
+        key = self.cache.make_key("prompt", 1000, False)
+        self.cache.set('gpt', key, 'response')
+        self.cache.close()
+
+        reopened = ResponseCache(self.db_path)
+        try:
+            self.assertEqual(reopened.get('gpt', key), 'response')
+        finally:
+            reopened.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+from pathlib import Path
+from semantic_cache import SemanticCache
+
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / 'semantic_cache.npz'
+        self.cache = SemanticCache(self.path, threshold=0.95)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_empty_cache_misses(self):
+        self.assertIsNone(self.cache.lookup('gpt', [1.0, 0.0]))
+        self.assertFalse(self.path.exists())
+
+    def test_similar_prompt_hits(self):
+        self.cache.add('gpt', [1.0, 0.0, 0.0], 'response')
+
+        self.assertEqual(self.cache.lookup('gpt', [0.99, 0.05, 0.0]), 'response')
+        self.assertIsNone(self.cache.lookup('gpt', [0.0, 1.0, 0.0]))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_lookup_is_scoped_to_model(self):
+        self.cache.add('gpt', [1.0, 0.0], 'response')
+        self.assertIsNone(self.cache.lookup('claude', [1.0, 0.0]))
+
+    def test_entries_persist_across_instances(self):
+        self.cache.add('gpt', [0.0, 2.0], 'first')
+        self.cache.add('gpt', [2.0, 0.0], 'second')
+        self.assertFalse(self.path.exists())
+        self.cache.flush()
+
+        reopened = SemanticCache(self.path, threshold=0.95)
+        self.assertEqual(reopened.lookup('gpt', [0.0, 1.0]), 'first')
+        self.assertEqual(reopened.lookup('gpt', [1.0, 0.0]), 'second')
+
+    def test_entries_beyond_initial_capacity(self):
+        for i in range(40):
+            self.cache.add('gpt', [1.0, float(i)], f'response {i}')
+        self.cache.flush()
+
+        reopened = SemanticCache(self.path, threshold=0.9999)
+        self.assertEqual(reopened.lookup('gpt', [1.0, 39.0]), 'response 39')
+        self.assertEqual(reopened.lookup('gpt', [1.0, 0.0]), 'response 0')
+
+if __name__ == '__main__':
+    unittest.main()